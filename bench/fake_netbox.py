@@ -0,0 +1,371 @@
+"""
+Local stand-in for the NetBox REST API used by the benchmarks.
+
+1. Objects live in memory per endpoint, list/detail GET, POST, PATCH and DELETE work for single objects and lists
+2. Foreign keys are accepted as ids or lookup dicts ({'name': ...}) and returned nested, the way pynetbox expects them
+3. Every request is counted along with bytes in and out and the new TCP connections, latency adds a delay to every response
+4. Run as a script it serves on its own, GET /_bench/counters and POST /_bench/reset read and clear the counters
+
+python bench/fake_netbox.py --port 8000 --latency 0.01
+"""
+import sys
+import json
+import time
+import argparse
+import threading
+
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from netaddr import IPAddress, IPNetwork
+
+# Field --> endpoint it points at
+FOREIGN_KEYS = {
+    'device': 'dcim/devices',
+    'installed_device': 'dcim/devices',
+    'parent_device': 'dcim/devices',
+    'site': 'dcim/sites',
+    'rack': 'dcim/racks',
+    'role': 'dcim/device-roles',
+    'device_role': 'dcim/device-roles',
+    'device_type': 'dcim/device-types',
+    'manufacturer': 'dcim/manufacturers',
+    'platform': 'dcim/platforms',
+    'tenant': 'tenancy/tenants',
+    'primary_ip4': 'ipam/ip-addresses',
+    'lag': 'dcim/interfaces',
+    'cable': 'dcim/cables',
+}
+
+# Fields a nested object carries, like NetBox's brief representation
+DISPLAY_FIELDS = ('name', 'model', 'address', 'slug')
+
+CHOICE_FIELDS = ('status', 'type')
+
+STATUS_CHOICES = ['offline', 'active', 'planned', 'staged', 'failed', 'inventory', 'decommissioning']
+
+# Query parameters that only shape the response
+IGNORED_PARAMS = ('limit', 'offset', 'brief', 'exclude', 'ordering')
+
+
+class FakeNetBoxHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 so clients can keep the connection open between requests
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def log_message(self, *args):
+        pass
+
+    def route(self):
+        """Split the url into (endpoint, object id or None, query)."""
+        url = urlparse(self.path)
+        parts = [part for part in url.path.split('/') if part][1:]  # drop 'api'
+
+        if parts and parts[-1].isdigit():
+            return '/'.join(parts[:-1]), int(parts[-1]), parse_qs(url.query)
+
+        return '/'.join(parts), None, parse_qs(url.query)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.server.count('bytes_in', length)
+
+        return json.loads(self.rfile.read(length)) if length else None
+
+    def control(self, body):
+        data = json.dumps(body).encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def respond(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+
+        time.sleep(self.server.latency)
+        self.server.count('requests')
+        self.server.count(f"requests_{self.command.lower()}")
+        self.server.count('bytes_out', len(data))
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_call(self, method):
+        endpoint, object_id, query = self.route()
+
+        # Benchmark control calls are answered without being counted
+        if self.path.startswith('/_bench/'):
+            self.body()
+            if self.path.startswith('/_bench/reset'):
+                self.server.reset()
+            return self.control(self.server.counters)
+
+        try:
+            status, body = method(endpoint, object_id, query, self.body())
+        except LookupError as error:
+            status, body = 400, {'detail': str(error)}
+
+        self.respond(status, body)
+
+    def do_GET(self):
+        self.handle_call(self.server.get)
+
+    def do_POST(self):
+        self.handle_call(self.server.post)
+
+    def do_PATCH(self):
+        self.handle_call(self.server.patch)
+
+    def do_PUT(self):
+        self.handle_call(self.server.patch)
+
+    def do_DELETE(self):
+        self.handle_call(self.server.delete)
+
+    def do_OPTIONS(self):
+        self.handle_call(self.server.options)
+
+
+class FakeNetBox(ThreadingHTTPServer):
+    daemon_threads = True
+    # Room for every benchmark thread to connect at once without the kernel dropping SYNs
+    request_queue_size = 256
+
+    def __init__(self, latency=0.0, port=0):
+        super().__init__(('127.0.0.1', port), FakeNetBoxHandler)
+        self.latency = latency
+        self.counters = {}
+        self.objects = {}
+        self.next_id = 1
+        self.lock = threading.RLock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    # Object store
+
+    def table(self, endpoint):
+        return self.objects.setdefault(endpoint, {})
+
+    def lookup(self, endpoint, value):
+        """Resolve an id, a numeric string or a lookup dict to the id of an object in endpoint."""
+        if value is None:
+            return None
+
+        if isinstance(value, dict) and 'id' in value:
+            value = value['id']
+
+        if isinstance(value, (int, str)) and str(value).isdigit():
+            return int(value)
+
+        for obj in self.table(endpoint).values():
+            if all(str(obj.get(key)) == str(expected) for key, expected in value.items()):
+                return obj['id']
+
+        raise LookupError(f"{endpoint} matching {value} not found")
+
+    def store(self, endpoint, data, obj=None):
+        """Create or update an object from a request payload, foreign keys are stored as ids."""
+        obj = obj if obj is not None else {'custom_fields': {}, 'tags': []}
+
+        for key, value in data.items():
+            if key in FOREIGN_KEYS:
+                value = self.lookup(FOREIGN_KEYS[key], value)
+            elif key == 'tags':
+                value = [self.lookup('extras/tags', tag) for tag in value]
+            elif key == 'custom_fields':
+                value = {**obj.get('custom_fields', {}), **value}
+            elif key == 'assigned_object_id' and value is not None:
+                value = int(value)
+            obj[key] = value
+
+        if 'id' not in obj:
+            obj['id'] = self.next_id
+            self.next_id += 1
+
+        obj['last_updated'] = time.strftime('%Y-%m-%dT%H:%M:%S.000000Z', time.gmtime())
+        self.table(endpoint)[obj['id']] = obj
+
+        return obj
+
+    def add(self, endpoint, **data):
+        """Seed an object directly, returns its id."""
+        with self.lock:
+            return self.store(endpoint, data)['id']
+
+    def nested(self, endpoint, object_id):
+        obj = self.table(endpoint).get(object_id)
+
+        if obj is None:
+            return None
+
+        nested = {'id': object_id, 'url': f"{self.url}/api/{endpoint}/{object_id}/"}
+        for key in DISPLAY_FIELDS:
+            if key in obj:
+                nested[key] = obj[key]
+
+        # Nested interfaces carry their device, like NetBox's assigned_object
+        if endpoint == 'dcim/interfaces' and 'device' in obj:
+            nested['device'] = self.nested('dcim/devices', obj['device'])
+
+        return nested
+
+    def render(self, endpoint, obj):
+        """Return an object the way NetBox serializes it, with nested foreign keys and choice dicts."""
+        out = {'url': f"{self.url}/api/{endpoint}/{obj['id']}/"}
+
+        for key, value in obj.items():
+            if key in FOREIGN_KEYS:
+                value = self.nested(FOREIGN_KEYS[key], value)
+            elif key == 'tags':
+                value = [self.nested('extras/tags', tag) for tag in value]
+            elif key in CHOICE_FIELDS and isinstance(value, str):
+                value = {'value': value, 'label': value.title()}
+            out[key] = value
+
+        if obj.get('assigned_object_id') and obj.get('assigned_object_type') == 'dcim.interface':
+            out['assigned_object'] = self.nested('dcim/interfaces', obj['assigned_object_id'])
+
+        return out
+
+    def matches(self, obj, key, values):
+        """Apply one NetBox style filter to an object."""
+        if key == 'q':
+            text = f"{obj.get('name', '')} {obj.get('address', '')} {obj.get('model', '')}".lower()
+            return any(value.lower() in text for value in values)
+
+        if key == 'mask_length':
+            return 'address' in obj and obj['address'].split('/')[1] in values
+
+        if key == 'address':
+            return 'address' in obj and any(obj['address'].split('/')[0] == value.split('/')[0] for value in values)
+
+        if key == 'parent':
+            return 'address' in obj and any(IPAddress(obj['address'].split('/')[0]) in IPNetwork(value) for value in values)
+
+        if key == 'last_updated__gte':
+            return obj.get('last_updated', '') >= values[0]
+
+        if key == 'role' and 'role' not in obj:
+            key = 'device_role'
+
+        if key.endswith('_id') and key[:-3] in FOREIGN_KEYS:
+            return str(obj.get(key[:-3])) in values
+
+        if key in FOREIGN_KEYS:
+            nested = self.nested(FOREIGN_KEYS[key], obj.get(key)) or {}
+            return any(str(nested.get(field)) in values for field in ('id', 'name', 'model', 'slug')) or \
+                str(self.table(FOREIGN_KEYS[key]).get(obj.get(key), {}).get('slug')) in values
+
+        return str(obj.get(key)) in values
+
+    # HTTP methods, each returns (status, body)
+
+    def get(self, endpoint, object_id, query, body):
+        with self.lock:
+            table = self.table(endpoint)
+
+            if object_id is not None:
+                obj = table.get(object_id)
+                return (200, self.render(endpoint, obj)) if obj else (404, {'detail': 'Not found.'})
+
+            results = [obj for obj in table.values()
+                       if all(self.matches(obj, key, values) for key, values in query.items() if key not in IGNORED_PARAMS)]
+
+            return 200, {'count': len(results), 'next': None, 'previous': None,
+                         'results': [self.render(endpoint, obj) for obj in results]}
+
+    def post(self, endpoint, object_id, query, body):
+        with self.lock:
+            created = [self.create(endpoint, item) for item in (body if isinstance(body, list) else [body])]
+
+            return 201, created if isinstance(body, list) else created[0]
+
+    def create(self, endpoint, data):
+        obj = self.store(endpoint, data)
+
+        # Interfaces point back at the cable connected to them
+        if endpoint == 'dcim/cables':
+            for end in ('termination_a', 'termination_b'):
+                if obj.get(f"{end}_type") == 'dcim.interface':
+                    self.table('dcim/interfaces')[int(obj[f"{end}_id"])]['cable'] = obj['id']
+
+        return self.render(endpoint, obj)
+
+    def patch(self, endpoint, object_id, query, body):
+        with self.lock:
+            table = self.table(endpoint)
+
+            if object_id is not None:
+                body = [{**body, 'id': object_id}]
+
+            for item in body:
+                if item['id'] not in table:
+                    return 404, {'detail': f"{endpoint} {item['id']} not found"}
+
+            updated = [self.render(endpoint, self.store(endpoint, item, table[item['id']])) for item in body]
+
+            return 200, updated[0] if object_id is not None else updated
+
+    def delete(self, endpoint, object_id, query, body):
+        with self.lock:
+            ids = [object_id] if object_id is not None else [item['id'] for item in body]
+
+            for object_id in ids:
+                self.table(endpoint).pop(object_id, None)
+
+                # Interfaces forget a cable that is deleted
+                if endpoint == 'dcim/cables':
+                    for interface in self.table('dcim/interfaces').values():
+                        if interface.get('cable') == object_id:
+                            interface['cable'] = None
+
+            return 204, None
+
+    def options(self, endpoint, object_id, query, body):
+        choices = [{'value': value, 'display_name': value.title()} for value in STATUS_CHOICES]
+
+        return 200, {'actions': {'POST': {'status': {'choices': choices}}}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake NetBox API for benchmarks")
+    parser.add_argument('--port', type=int, default=0)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every response")
+    args = parser.parse_args()
+
+    server = FakeNetBox(latency=args.latency, port=args.port)
+
+    # The benchmark reads the port from this line when it starts the server in a subprocess
+    print(f"listening on {server.server_address[1]}", flush=True)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
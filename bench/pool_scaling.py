@@ -0,0 +1,57 @@
+"""
+Show NetBox client throughput scaling with the connection pool size.
+
+Runs a fixed number of GETs from many threads against a local fake NetBox with added latency,
+once per pool size, and prints requests per second and the TCP connections that were opened.
+
+python bench/pool_scaling.py --requests 400 --threads 32 --latency 0.02
+"""
+import os
+import sys
+import time
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from netbox_client import build_session
+from fake_netbox import FakeNetBox
+
+
+def run(server, pool_size, requests, threads):
+    session = build_session(pool_size=pool_size, retries=0)
+    url = f"{server.url}/api/dcim/devices/"
+
+    server.reset()
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(lambda _: session.get(url).raise_for_status(), range(requests)))
+
+    elapsed = time.perf_counter() - start
+    session.close()
+
+    return requests / elapsed, server.counters.get('connections', 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--latency', type=float, default=0.02, help="Seconds added to every response")
+    parser.add_argument('--pool-sizes', default="1,2,4,8,16,32")
+    args = parser.parse_args()
+
+    server = FakeNetBox(latency=args.latency).start()
+
+    print(f"{'pool':>6} {'req/s':>10} {'connections':>12}")
+    for pool_size in [int(size) for size in args.pool_sizes.split(",")]:
+        rate, connections = run(server, pool_size, args.requests, args.threads)
+        print(f"{pool_size:>6} {rate:>10.1f} {connections:>12}")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Offline benchmark of the provision and seed scripts against a fake NetBox and simulated hosts.
+
+Every scenario gets a fresh fake NetBox (bench/fake_netbox.py, run in its own process so it does not share the
+GIL or the memory measurement), seeded with the site, chassis, switches and staged minios a real run expects.
+Hosts and switches are answered by bench/sim_fleet.py instead of SSH/NAPALM.
+
+Scenarios
+    provision   full provision run, facts collected over the simulated SSH connection
+    replay      provision run with every host's facts replayed from a FactStore, no SSH at all
+    rerun       replayed run on a fleet that is already provisioned, unchanged hosts are skipped by their fingerprint
+    seed        minios-to-netbox-seed.py polling every simulated switch and bulk creating the minios
+    cables      minios-to-netbox-seed.py --sync-cables on a provisioned fleet whose cables were all deleted
+
+For each scenario and fleet size it reports wall time, NetBox API calls in total and per host,
+bytes sent and received, TCP connections opened and the peak Python memory of the run.
+
+python bench/run_bench.py --hosts 1,50,1000 --latency 0.005 --json results.json
+"""
+import os
+import sys
+import json
+import time
+import tempfile
+import argparse
+import importlib.util
+import subprocess
+import tracemalloc
+
+from contextlib import redirect_stdout
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+sys.path.insert(0, ROOT)
+
+# The seed script builds its api at import time
+os.environ.setdefault('NB_URL', 'http://127.0.0.1')
+os.environ.setdefault('NB_TOKEN', 'bench')
+
+import requests
+
+from nornir.core import Nornir
+from nornir.core.inventory import Inventory, Hosts, Host, Groups, Defaults, ConnectionOptions
+from nornir.plugins.runners import ThreadedRunner
+
+import sim_fleet
+import provision_server_netbox
+
+from fact_store import FactStore
+from host_facts import PROBES
+from netbox_client import netbox_api
+from cable_sync import sync_cables
+
+SCENARIOS = ('provision', 'replay', 'rerun', 'seed', 'cables')
+
+
+class FakeNetBoxProcess:
+    """Run bench/fake_netbox.py in a subprocess and talk to its /_bench/ control endpoints."""
+
+    def __init__(self, latency):
+        self.process = subprocess.Popen([sys.executable, os.path.join(BENCH, 'fake_netbox.py'), '--latency', str(latency)],
+                                        stdout=subprocess.PIPE, text=True)
+        port = self.process.stdout.readline().split()[-1]
+        self.url = f"http://127.0.0.1:{port}"
+        self.session = requests.Session()
+
+    def post(self, endpoint, payloads):
+        self.session.post(f"{self.url}/api/{endpoint}/", json=payloads).raise_for_status()
+
+    def clear(self, endpoint):
+        """Delete every object in endpoint."""
+        objects = self.session.get(f"{self.url}/api/{endpoint}/").json()['results']
+        self.session.delete(f"{self.url}/api/{endpoint}/", json=[{'id': obj['id']} for obj in objects]).raise_for_status()
+
+    def counters(self):
+        return self.session.get(f"{self.url}/_bench/counters").json()
+
+    def reset(self):
+        self.session.post(f"{self.url}/_bench/reset").raise_for_status()
+
+    def close(self):
+        self.session.close()
+        self.process.terminate()
+        self.process.wait()
+
+
+def load_seed_script():
+    spec = importlib.util.spec_from_file_location('minios_seed', os.path.join(ROOT, 'minios-to-netbox-seed.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+def server_nornir(count, workers):
+    hosts = Hosts()
+
+    for i, (name, data) in enumerate(sim_fleet.fleet(count).items()):
+        hosts[name] = Host(name, hostname=data['ip_address'], platform='linux', data=data,
+                           connection_options={'netmiko': ConnectionOptions(extras={'index': i})})
+
+    return Nornir(inventory=Inventory(hosts=hosts, groups=Groups(), defaults=Defaults()), runner=ThreadedRunner(workers))
+
+
+def switch_nornir(count, workers):
+    cabled = {}
+    for i in range(count):
+        cabled.setdefault(sim_fleet.switch_name(i), []).append(i)
+
+    hosts = Hosts({name: Host(name, platform='eos', connection_options={'napalm': ConnectionOptions(extras={'hosts': indexes})})
+                   for name, indexes in cabled.items()})
+
+    return Nornir(inventory=Inventory(hosts=hosts, groups=Groups(), defaults=Defaults()), runner=ThreadedRunner(workers))
+
+
+def run_provision(server, count, args, store=None):
+    nr = server_nornir(count, args.ssh_workers)
+    provision_server_netbox.setup_netbox(args.netbox_workers, url=server.url, token='bench', verify=False)
+
+    report = provision_server_netbox.provision(nr, store)
+
+    return sum(len(host['errors']) for host in report.values())
+
+
+def run_seed(server, count, args, seed):
+    seed.nb = netbox_api(server.url, 'bench', verify=False, pool_size=args.netbox_workers)
+
+    seed.add_minios(seed.merge_switches(seed.poll_switches(switch_nornir(count, args.ssh_workers))))
+
+    return 0
+
+
+def run_cables(server, count, args, seed):
+    nb = netbox_api(server.url, 'bench', verify=False, pool_size=args.netbox_workers)
+    switches = seed.poll_switches(switch_nornir(count, args.ssh_workers))
+
+    report = sync_cables(nb, {name: lldp for name, (lldp, _) in switches.items()}, sim_fleet.DOMAIN)
+
+    return sum(len(switch['errors']) for switch in report.values())
+
+
+def measure(scenario, count, args, seed):
+    """Run one scenario on a freshly seeded fake NetBox and return its metrics."""
+    server = FakeNetBoxProcess(args.latency)
+
+    try:
+        sim_fleet.seed_netbox(server.post, count, staged=scenario != 'seed')
+        sim_fleet.lldp_enabled.clear()
+
+        store = None
+        if scenario in ('replay', 'rerun'):
+            store = FactStore(tempfile.mkdtemp(prefix='bench-facts-'), PROBES, ttl=0)
+            for i in range(count):
+                store.save(sim_fleet.host_name(i), sim_fleet.probe_outputs(i))
+
+        # The first run provisions the fleet, only the second one is measured
+        if scenario in ('rerun', 'cables'):
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                run_provision(server, count, args, store)
+
+        if scenario == 'cables':
+            server.clear('dcim/cables')
+
+        server.reset()
+
+        if args.memory:
+            tracemalloc.start()
+
+        start = time.perf_counter()
+
+        # The scripts print progress for every host, keep it out of the results
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            if scenario == 'seed':
+                errors = run_seed(server, count, args, seed)
+            elif scenario == 'cables':
+                errors = run_cables(server, count, args, seed)
+            else:
+                errors = run_provision(server, count, args, store)
+
+        elapsed = time.perf_counter() - start
+
+        peak = None
+        if args.memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        counters = server.counters()
+
+    finally:
+        server.close()
+
+    requests_made = counters.get('requests', 0)
+
+    return {'scenario': scenario, 'hosts': count, 'seconds': round(elapsed, 3), 'api_calls': requests_made,
+            'calls_per_host': round(requests_made / count, 2), 'bytes_sent': counters.get('bytes_in', 0),
+            'bytes_received': counters.get('bytes_out', 0), 'connections': counters.get('connections', 0),
+            'peak_memory_mb': round(peak / 2 ** 20, 1) if peak is not None else None, 'errors': errors,
+            'by_method': {key[len('requests_'):]: value for key, value in counters.items() if key.startswith('requests_')}}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--hosts', default="1,50,1000", help="Fleet sizes to run, comma separated")
+    parser.add_argument('--scenarios', default=",".join(SCENARIOS))
+    parser.add_argument('--latency', type=float, default=0.005, help="Seconds the fake NetBox adds to every response")
+    parser.add_argument('--ssh-delay', type=float, default=0.0, help="Seconds the simulated hosts add to every command")
+    parser.add_argument('--lldp-delay', type=float, default=0.0, help="Seconds the simulated hosts take to see their switch after lldpd is enabled")
+    parser.add_argument('--ssh-workers', type=int, default=10)
+    parser.add_argument('--netbox-workers', type=int, default=4)
+    parser.add_argument('--no-memory', dest='memory', action='store_false', help="Skip tracemalloc, it slows the run down")
+    parser.add_argument('--json', help="Also write the results to this file")
+    args = parser.parse_args()
+
+    sim_fleet.SSH_CONNECT_DELAY = sim_fleet.SSH_COMMAND_DELAY = args.ssh_delay
+    sim_fleet.LLDP_CONVERGE_DELAY = args.lldp_delay
+    sim_fleet.register_connections()
+
+    seed = load_seed_script()
+    results = []
+
+    print(f"{'scenario':<10} {'hosts':>6} {'seconds':>9} {'calls':>7} {'calls/host':>11} {'sent':>10} "
+          f"{'received':>10} {'conns':>6} {'peak MB':>8} {'errors':>7}")
+
+    for scenario in args.scenarios.split(","):
+        for count in [int(size) for size in args.hosts.split(",")]:
+            result = measure(scenario, count, args, seed)
+            results.append(result)
+
+            peak = result['peak_memory_mb'] if result['peak_memory_mb'] is not None else '-'
+            print(f"{scenario:<10} {count:>6} {result['seconds']:>9.2f} {result['api_calls']:>7} {result['calls_per_host']:>11} "
+                  f"{result['bytes_sent']:>10} {result['bytes_received']:>10} {result['connections']:>6} {peak:>8} {result['errors']:>7}",
+                  flush=True)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Synthetic servers and switches for the offline benchmarks.
+
+1. Host i gets a deterministic identity: name, IPs, MACs, serials, chassis/node and the switch port it is cabled to
+2. probe_outputs() renders what each probe command prints on a real host, in the formats host_facts parses
+3. SimulatedSSH and SimulatedNapalm replace the netmiko and napalm connection plugins, commands are answered from the
+   synthetic device named in the connection extras, with an optional delay per connection and per command
+4. seed_netbox() creates the objects a provision run expects to already be in NetBox
+"""
+import json
+import time
+
+from nornir.core.plugins.connections import ConnectionPluginRegister
+
+from host_facts import PROBES, MARKER
+
+SITE = '1103 Platform Engineering Lab'
+RACK = '0102'
+DEVICE_TYPE = 'SYS-6029TP-H-EI012'
+PORTS_PER_SWITCH = 48
+NODES = ('NODE-A', 'NODE-B', 'NODE-C', 'NODE-D')
+DOMAIN = '.local.domain'
+
+# Seconds added when a connection is opened and to every command, set by the benchmark
+SSH_CONNECT_DELAY = 0.0
+SSH_COMMAND_DELAY = 0.0
+
+# Seconds after lldpd is enabled before a host sees its switch, like a real lldpd waiting for the switch's next frame
+LLDP_CONVERGE_DELAY = 0.0
+
+NO_NEIGHBORS = json.dumps({'lldp': {}})
+
+# Host index --> when lldpd was first enabled on it, enabling it again does not restart it
+lldp_enabled = {}
+
+# Host indexes that refuse SSH connections, for runs where part of the fleet is down
+unreachable = set()
+
+
+def host_name(i):
+    return f"minios-{i:04d}"
+
+
+def switch_name(i):
+    return f"leaf-{i // PORTS_PER_SWITCH:02d}"
+
+
+def host_ip(i):
+    # Last octet is always three digits so a NetBox q= search for one IP never matches another
+    return f"10.1.{i // 100}.{100 + i % 100}"
+
+
+def bmc_ip(i):
+    return f"10.2.{i // 100}.{100 + i % 100}"
+
+
+def mac(prefix, i):
+    return f"{prefix}:{(i >> 16) & 0xff:02x}:{(i >> 8) & 0xff:02x}:{i & 0xff:02x}"
+
+
+def chassis_serial(i):
+    return f"CHS{i // len(NODES):05d}"
+
+
+def switch_port(i):
+    return f"Ethernet1/{i % PORTS_PER_SWITCH + 1}"
+
+
+def fleet(count):
+    """{hostname: {'ip_address': ..., 'node': ...}} for the first count synthetic hosts, the provision script's fleet format."""
+    return {host_name(i): {'ip_address': host_ip(i), 'node': NODES[i % len(NODES)]} for i in range(count)}
+
+
+def probe_outputs(i):
+    """Output of every probe in PROBES for host i."""
+    ip_addr = [
+        {'ifname': 'lo', 'link_type': 'loopback', 'address': '00:00:00:00:00:00', 'mtu': 65536,
+         'addr_info': [{'family': 'inet', 'local': '127.0.0.1', 'prefixlen': 8}]},
+        {'ifname': 'eno1', 'link_type': 'ether', 'address': mac('3c:ec:ef', i), 'mtu': 9000,
+         'addr_info': [{'family': 'inet', 'local': host_ip(i), 'prefixlen': 16}]},
+        {'ifname': 'eno2', 'link_type': 'ether', 'address': mac('3c:ec:ee', i), 'mtu': 9000, 'master': 'bond0', 'addr_info': []},
+        {'ifname': 'eno3', 'link_type': 'ether', 'address': mac('3c:ec:ed', i), 'mtu': 9000, 'master': 'bond0', 'addr_info': []},
+        {'ifname': 'bond0', 'link_type': 'ether', 'address': mac('3c:ec:ee', i), 'mtu': 9000,
+         'linkinfo': {'info_kind': 'bond'}, 'addr_info': [{'family': 'inet', 'local': f"172.16.{i // 100}.{100 + i % 100}", 'prefixlen': 24}]},
+        {'ifname': 'docker0', 'link_type': 'ether', 'address': '02:42:00:00:00:01', 'mtu': 1500,
+         'linkinfo': {'info_kind': 'bridge'}, 'addr_info': [{'family': 'inet', 'local': '172.17.0.1', 'prefixlen': 16}]},
+    ]
+
+    lldp = {'lldp': {'interface': {'eno1': {
+        'via': 'LLDP',
+        'chassis': {switch_name(i): {'id': {'type': 'mac', 'value': mac('00:1c:73', i // PORTS_PER_SWITCH)}}},
+        'port': {'id': {'type': 'ifname', 'value': switch_port(i)}, 'descr': switch_port(i)}}}}}
+
+    dmidecode = "\n".join([
+        "# dmidecode 3.3",
+        "Handle 0x0000, DMI type 0, 26 bytes",
+        "BIOS Information",
+        "\tVendor: American Megatrends Inc.",
+        "\tVersion: 3.4",
+        "\tRelease Date: 11/01/2021",
+        "\tCharacteristics:",
+        "\t\tPCI is supported",
+        "\tBIOS Revision: 5.14",
+        "",
+        "Handle 0x0001, DMI type 1, 27 bytes",
+        "System Information",
+        "\tManufacturer: Supermicro",
+        f"\tProduct Name: {DEVICE_TYPE}",
+        f"\tSerial Number: S{i:07d}",
+        "\tSKU Number: SKU-6029",
+        "",
+        "Handle 0x0002, DMI type 2, 15 bytes",
+        "Base Board Information",
+        "\tManufacturer: Supermicro",
+        f"\tAsset Tag: {100000 + i}",
+        "",
+        "Handle 0x0003, DMI type 3, 22 bytes",
+        "Chassis Information",
+        "\tManufacturer: Supermicro",
+        f"\tSerial Number: {chassis_serial(i)}",
+        "\tAsset Tag: To Be Filled By O.E.M.",
+        "",
+        "Handle 0x0027, DMI type 39, 22 bytes",
+        "System Power Supply",
+        "\tMax Power Capacity: 2200 W",
+        "",
+        "Handle 0x0028, DMI type 39, 22 bytes",
+        "System Power Supply",
+        "\tMax Power Capacity: 2200 W",
+    ])
+
+    # lshw -json tree with 2 CPUs, 16 of 24 DIMM slots filled, 2 NVMe drives and the NICs above
+    cpus = [{'id': f"cpu:{n}", 'class': 'processor', 'slot': f"CPU{n + 1}", 'vendor': 'Intel Corp.',
+             'product': 'Intel(R) Xeon(R) Gold 6230 CPU @ 2.10GHz'} for n in range(2)]
+    banks = [{'id': f"bank:{n}", 'class': 'memory', 'slot': f"DIMM_{'ABCDEF'[n // 4]}{n % 4 + 1}", 'description': '[empty]'}
+             if n % 3 == 2 else
+             {'id': f"bank:{n}", 'class': 'memory', 'slot': f"DIMM_{'ABCDEF'[n // 4]}{n % 4 + 1}", 'vendor': 'Samsung',
+              'product': 'M393A4K40DB2-CVF', 'serial': f"M{i:06X}{n:02X}", 'size': 32 * 2 ** 30, 'units': 'bytes',
+              'description': 'DIMM DDR4 Synchronous Registered (Buffered) 2933 MHz (0.3 ns)'} for n in range(24)]
+    drives = [{'id': f"nvme{n}", 'class': 'storage', 'vendor': 'Samsung', 'product': 'MZQLB960HAJR-00007', 'serial': f"NV{i:07d}{n}",
+               'children': [{'id': 'namespace', 'class': 'disk', 'description': 'NVMe disk', 'logicalname': f"/dev/nvme{n}n1",
+                             'size': 960197124096, 'units': 'bytes'}]} for n in range(2)]
+    nics = [{'id': f"network:{n}", 'class': 'network', 'businfo': f"pci@0000:18:00.{n}", 'logicalname': nic, 'vendor': 'Mellanox Technologies',
+             'product': 'MT27800 Family [ConnectX-5]', 'serial': mac(prefix, i)}
+            for n, (nic, prefix) in enumerate([('eno1', '3c:ec:ef'), ('eno2', '3c:ec:ee'), ('eno3', '3c:ec:ed')])]
+    lshw = {'id': host_name(i), 'class': 'system', 'children': [{'id': 'core', 'class': 'bus', 'children': [
+        *cpus, {'id': 'memory', 'class': 'memory', 'children': banks}, *drives, *nics]}]}
+
+    outputs = {
+        'lspci': "18:00.0 Ethernet controller: Mellanox Technologies MT27800 Family [ConnectX-5]",
+        'lshw_network': "\n".join([
+            "Bus info          Device     Class          Description",
+            "========================================================",
+            "pci@0000:18:00.0  eno1       network        MT27800 Family [ConnectX-5]",
+            "pci@0000:18:00.1  eno2       network        MT27800 Family [ConnectX-5]",
+        ]),
+        'ip_route': json.dumps([{'dst': 'default', 'gateway': f"10.1.{i // 100}.1", 'dev': 'eno1', 'flags': []}]),
+        'ip_addr': json.dumps(ip_addr),
+        'ethtool_all': "\n".join(f"Settings for {nic}:\n\tSpeed: 25000Mb/s\n\tDuplex: Full\n\tLink detected: yes"
+                                 for nic in ('eno1', 'eno2', 'eno3')),
+        'lldp_neighbors': json.dumps(lldp),
+        'ipmi_lan': "\n".join([
+            "Set in Progress         : Set Complete",
+            "IP Address Source       : DHCP Address",
+            f"IP Address              : {bmc_ip(i)}",
+            "Subnet Mask             : 255.255.0.0",
+            f"MAC Address             : {mac('ac:1f:6b', i)}",
+        ]),
+        'ipmi_mc': "\n".join([
+            "Device ID                 : 32",
+            "Firmware Revision         : 1.73",
+            "IPMI Version              : 2.0",
+        ]),
+        'dmidecode': dmidecode,
+        'os_release': 'NAME="CentOS Linux"\nPRETTY_NAME="CentOS Linux 7 (Core)"',
+        'lshw_json': json.dumps(lshw),
+    }
+
+    # Probes added later without a synthetic output answer like a command that printed nothing
+    return {probe: outputs.get(probe, '') for probe in PROBES}
+
+
+def answer(i, command, lldp_ready=True):
+    """What host i prints for a command sent by the provision tasks, lldp_ready=False answers with no neighbors yet."""
+    outputs = probe_outputs(i)
+
+    if not lldp_ready:
+        outputs['lldp_neighbors'] = NO_NEIGHBORS
+
+    # Composite command from build_composite_command, every marker is followed by that probe's output
+    if MARKER in command:
+        return "\n".join(f"{MARKER}{probe}@@\n{outputs[probe]}" for probe in PROBES if f"{MARKER}{probe}@@" in command)
+
+    # Single probe sent by run_probe or collect_facts(batched=False)
+    for probe, probe_command in PROBES.items():
+        if command == probe_command:
+            return outputs[probe]
+
+    # systemctl, lldpcli configure etc print nothing
+    return ''
+
+
+class SimulatedSSH:
+    """Stand-in for the netmiko connection plugin, extras={'index': i} picks the synthetic host."""
+
+    def open(self, hostname, username, password, port, platform, extras=None, configuration=None):
+        time.sleep(SSH_CONNECT_DELAY)
+
+        if extras['index'] in unreachable:
+            raise ConnectionRefusedError(f"{hostname}: connection refused")
+
+        self.connection = self
+        self.index = extras['index']
+
+    def close(self):
+        pass
+
+    def send_command(self, command_string, **kwargs):
+        time.sleep(SSH_COMMAND_DELAY)
+
+        if 'enable lldpd' in command_string:
+            lldp_enabled.setdefault(self.index, time.monotonic())
+
+        # A host lldpd was never enabled on by the benchmark is taken to have it running already
+        enabled = lldp_enabled.get(self.index)
+        lldp_ready = enabled is None or time.monotonic() - enabled >= LLDP_CONVERGE_DELAY
+
+        return answer(self.index, command_string, lldp_ready)
+
+
+class SimulatedNapalm:
+    """Stand-in for the napalm connection plugin, extras={'hosts': [i, ...]} are the hosts cabled to the switch."""
+
+    def open(self, hostname, username, password, port, platform, extras=None, configuration=None):
+        time.sleep(SSH_CONNECT_DELAY)
+        self.connection = self
+        self.hosts = extras['hosts']
+
+    def close(self):
+        pass
+
+    def get_lldp_neighbors_detail(self):
+        time.sleep(SSH_COMMAND_DELAY)
+        return {switch_port(i): [{'remote_system_name': host_name(i) + DOMAIN, 'remote_port_description': 'eno1',
+                                  'remote_port': 'eno1', 'remote_chassis_id': mac('3c:ec:ef', i)}] for i in self.hosts}
+
+    def get_arp_table(self):
+        time.sleep(SSH_COMMAND_DELAY)
+        return [{'interface': f"{switch_port(i)}.100", 'mac': mac('3c:ec:ef', i), 'ip': host_ip(i), 'age': 0.0}
+                for i in self.hosts]
+
+
+def register_connections():
+    """Swap the netmiko and napalm connection plugins for the simulated ones."""
+    for name, plugin in (('netmiko', SimulatedSSH), ('napalm', SimulatedNapalm)):
+        if name in ConnectionPluginRegister.available:
+            ConnectionPluginRegister.deregister(name)
+        ConnectionPluginRegister.register(name, plugin)
+
+
+def seed_netbox(post, count, staged=True):
+    """
+    Create the site, references, chassis, switches and host IPs a provision run of count hosts expects.
+
+    post(endpoint, payloads) sends one bulk create, staged=False leaves the minios devices for the seed script to add
+    """
+    post('dcim/sites', [{'name': SITE, 'slug': 'lab'}])
+    post('dcim/racks', [{'name': RACK, 'site': {'name': SITE}}])
+    post('tenancy/tenants', [{'name': 'HWE', 'slug': 'hwe'}])
+    post('dcim/device-roles', [{'name': role, 'slug': role} for role in ('server', 'minios', 'switch', 'chassis')])
+    post('dcim/platforms', [{'name': 'linux', 'slug': 'linux'}])
+    post('dcim/manufacturers', [{'name': 'Supermicro', 'slug': 'supermicro'}])
+    post('dcim/device-types', [
+        {'model': DEVICE_TYPE, 'slug': DEVICE_TYPE.lower(), 'manufacturer': {'name': 'Supermicro'}, 'u_height': 0},
+        {'model': 'SYS-6029TP-CHASSIS', 'slug': 'sys-6029tp-chassis', 'manufacturer': {'name': 'Supermicro'}, 'u_height': 2},
+        {'model': 'DCS-7050SX3', 'slug': 'dcs-7050sx3', 'manufacturer': {'name': 'Supermicro'}, 'u_height': 1}])
+
+    common = {'site': {'name': SITE}, 'rack': {'name': RACK}, 'tenant': {'name': 'HWE'}}
+
+    chassis = range((count + len(NODES) - 1) // len(NODES))
+    post('dcim/devices', [{'name': f"chassis-{c:05d}", 'serial': chassis_serial(c * len(NODES)), 'status': 'active',
+                           'device_role': {'name': 'chassis'}, 'device_type': {'model': 'SYS-6029TP-CHASSIS'}, **common}
+                          for c in chassis])
+    post('dcim/device-bays', [{'device': {'name': f"chassis-{c:05d}"}, 'name': node, 'installed_device': None}
+                              for c in chassis for node in NODES])
+
+    switches = sorted({switch_name(i) for i in range(count)})
+    post('dcim/devices', [{'name': switch, 'status': 'active', 'device_role': {'name': 'switch'},
+                           'device_type': {'model': 'DCS-7050SX3'}, **common} for switch in switches])
+    post('dcim/interfaces', [{'device': {'name': switch}, 'name': f"Ethernet1/{port}", 'type': '25gbase-x-sfp28'}
+                             for switch in switches for port in range(1, PORTS_PER_SWITCH + 1)])
+
+    if staged:
+        post('dcim/devices', [{'name': host_name(i), 'status': 'staged', 'device_role': {'name': 'minios'},
+                               'device_type': {'model': DEVICE_TYPE}, 'platform': {'name': 'linux'}, **common}
+                              for i in range(count)])
+
+    post('ipam/ip-addresses', [{'address': f"{host_ip(i)}/16", 'status': 'active'} for i in range(count)])
+
+    return switches
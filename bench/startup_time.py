@@ -0,0 +1,124 @@
+"""
+Time from starting provision_server_netbox.py to its first SSH connection, against the fake NetBox.
+
+Each run is a fresh interpreter so imports are paid the way they are on the command line. The netmiko plugin is
+replaced by one that reports when it is opened and exits, so only startup is measured.
+
+Runs
+    cold    no inventory snapshot, the devices are looked up in NetBox
+    warm    snapshot written by the cold run and still inside its TTL, no device lookups
+    stale   snapshot past its TTL, revalidated with one last_updated__gte query
+
+python bench/startup_time.py --hosts 1 --latency 0.005 --repeat 5
+"""
+import os
+import sys
+import time
+import tempfile
+import argparse
+import threading
+import subprocess
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+sys.path.insert(0, ROOT)
+
+RUNS = {'cold': 3600, 'warm': 3600, 'stale': 0}
+
+
+class FirstConnection:
+    """Connection plugin that prints when it is opened and ends the process."""
+
+    opened = threading.Lock()
+
+    def open(self, hostname, username, password, port, platform, extras=None, configuration=None):
+        # Other worker threads may reach open() before the process is gone, only the first one reports
+        self.opened.acquire()
+        print("connected", file=sys.__stdout__, flush=True)
+        os._exit(0)
+
+
+def child(argv):
+    """Run provision_server_netbox.main() in this process with FirstConnection as the netmiko plugin."""
+    from nornir.core.plugins.connections import ConnectionPluginRegister
+
+    ConnectionPluginRegister.register('netmiko', FirstConnection)
+
+    import provision_server_netbox
+
+    with open(os.devnull, 'w') as devnull:
+        sys.stdout, stdout = devnull, sys.stdout
+        try:
+            provision_server_netbox.main(argv)
+        finally:
+            sys.stdout = stdout
+
+    print("no connection opened", flush=True)
+
+
+def first_connection(url, argv):
+    """Seconds from spawning the provision script to its first connection."""
+    env = {**os.environ, 'NB_URL': url, 'NB_TOKEN': 'bench'}
+    start = time.perf_counter()
+
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--child', *argv], cwd=ROOT, env=env,
+                               stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline().strip()
+    elapsed = time.perf_counter() - start
+    process.wait()
+
+    if line != "connected":
+        raise RuntimeError(f"provision run did not connect: {line or process.returncode}")
+
+    return elapsed
+
+
+def main():
+    if sys.argv[1:2] == ['--child']:
+        return child(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument('--hosts', type=int, default=1, help="Hosts in the fleet file")
+    parser.add_argument('--latency', type=float, default=0.005, help="Seconds the fake NetBox adds to every response")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs of each kind, the best and median are reported")
+    args = parser.parse_args()
+
+    from run_bench import FakeNetBoxProcess
+    import sim_fleet
+
+    server = FakeNetBoxProcess(args.latency)
+    workdir = tempfile.mkdtemp(prefix='bench-startup-')
+    fleet = os.path.join(workdir, 'fleet.csv')
+    cache = os.path.join(workdir, 'inventory.json')
+
+    try:
+        sim_fleet.seed_netbox(server.post, args.hosts)
+
+        with open(fleet, 'w') as fleet_file:
+            fleet_file.write("hostname,ip_address,node\n")
+            for i in range(args.hosts):
+                fleet_file.write(f"{sim_fleet.host_name(i)},{sim_fleet.host_ip(i)},\n")
+
+        print(f"{'run':<6} {'best':>8} {'median':>8} {'api calls':>10}")
+
+        for run, ttl in RUNS.items():
+            times, calls = [], 0
+
+            for _ in range(args.repeat):
+                if run == 'cold' and os.path.exists(cache):
+                    os.remove(cache)
+
+                server.reset()
+                times.append(first_connection(server.url, ['user', 'password', '--fleet', fleet, '--inventory-cache', cache,
+                                                           '--inventory-ttl', str(ttl)]))
+                calls = server.counters().get('requests', 0)
+
+            times.sort()
+            print(f"{run:<6} {times[0]:>8.3f} {times[len(times) // 2]:>8.3f} {calls:>10}", flush=True)
+
+    finally:
+        server.close()
+
+
+if __name__ == "__main__":
+    main()
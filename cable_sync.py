@@ -0,0 +1,112 @@
+"""
+Reconcile NetBox cables with the LLDP tables of the switches.
+
+1. Each switch's LLDP table is read once with NAPALM (get_lldp_neighbors_detail, as the seed script polls it)
+2. Switch ports, the neighbor devices and their interfaces are loaded with a few list queries and indexed in memory
+3. Every switch port whose neighbor NetBox knows is sorted as correct, missing (no cable) or stale (cabled to something else)
+4. Stale cables are deleted and missing ones created through the WriteBuffer, one bulk request each for the whole run
+"""
+from collections import namedtuple
+
+from netbox_cache import SwitchInterfaceCache, filter_in
+from netbox_writes import WriteBuffer
+
+# A switch port and the server interface LLDP says is on the other end of it
+Link = namedtuple('Link', ['switch', 'switch_interface', 'system', 'interface'])
+
+
+def lldp_links(switches, domain_extension=''):
+    """
+    Flatten {switch: get_lldp_neighbors_detail()} into (switch, local port, remote system, remote ports) tuples.
+
+    Hosts are provisioned with portidsubtype ifname, so remote_port is the interface name. remote_port_description
+    is kept as a second guess for neighbors that advertise their MAC instead
+    """
+    links = []
+
+    for switch, interfaces in switches.items():
+        for port, neighbors in interfaces.items():
+            for neighbor in neighbors:
+                system = (neighbor.get('remote_system_name') or '').replace(domain_extension, '').strip()
+
+                if system:
+                    links.append((switch, port, system, (neighbor.get('remote_port'), neighbor.get('remote_port_description'))))
+
+    return links
+
+
+def cable_id(interface):
+    return (dict(interface).get('cable') or {}).get('id')
+
+
+def plan_cables(nb, switches, domain_extension=''):
+    """
+    Work out the cables NetBox needs to match the LLDP tables in switches.
+
+    Returns (correct, missing, stale, unmatched): Links that are already cabled, Links that need a cable,
+    {cable id: switch} to delete and (switch, port, system) neighbors NetBox has no interface for
+    """
+    links = lldp_links(switches, domain_extension)
+
+    # Every interface of every neighbor, one list query per FILTER_CHUNK devices
+    devices = {device.id: device.name for device in filter_in(nb.dcim.devices, 'name', {system for _, _, system, _ in links})}
+    interfaces = {(devices[interface.device.id], interface.name): interface
+                  for interface in filter_in(nb.dcim.interfaces, 'device_id', devices)}
+
+    # One interface query per switch
+    switch_interfaces = SwitchInterfaceCache(nb)
+
+    correct, missing, stale, unmatched = [], [], {}, []
+
+    for switch, port, system, remote_ports in links:
+        switch_interface = switch_interfaces.get(switch, port)
+        interface = next((interfaces[(system, name)] for name in remote_ports if (system, name) in interfaces), None)
+
+        if switch_interface is None or interface is None:
+            unmatched.append((switch, port, system))
+            continue
+
+        link = Link(switch, switch_interface, system, interface)
+
+        # Both ends on the same cable is the only way the cable can be the right one
+        if cable_id(switch_interface) is not None and cable_id(switch_interface) == cable_id(interface):
+            correct.append(link)
+            continue
+
+        for end in (switch_interface, interface):
+            if cable_id(end) is not None:
+                stale[cable_id(end)] = switch
+
+        missing.append(link)
+
+    return correct, missing, stale, unmatched
+
+
+def sync_cables(nb, switches, domain_extension='', dry_run=False):
+    """
+    Make NetBox's cables match the LLDP tables in switches, {switch: get_lldp_neighbors_detail()}.
+
+    Ports without an LLDP neighbor are left alone, the neighbor may only be down. Returns the write report per switch
+    """
+    correct, missing, stale, unmatched = plan_cables(nb, switches, domain_extension)
+
+    for switch, port, system in unmatched:
+        print(f"{switch} {port}: neighbor {system} has no matching interface in NetBox")
+
+    for link in missing:
+        print(f"{link.switch} {link.switch_interface.name} --> {link.system} {link.interface.name}: missing")
+
+    print(f"{len(correct)} cables correct, {len(missing)} missing, {len(stale)} stale, {len(unmatched)} neighbors not in NetBox")
+
+    if dry_run:
+        return {}
+
+    writes = WriteBuffer(nb)
+
+    for cable, switch in stale.items():
+        writes.delete_cable(switch, cable)
+
+    for link in missing:
+        writes.create_cable(link.switch, link.switch_interface.id, link.interface.id)
+
+    return writes.flush()
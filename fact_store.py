@@ -0,0 +1,73 @@
+"""
+On-disk record of the raw probe output collected from each host.
+
+1. Entries are gzipped JSON keyed by host and a hash of the probe commands, changing a probe invalidates old entries
+2. Entries older than the TTL are ignored, invalidate() removes them on request
+3. Recorded hosts can be loaded without SSH so the NetBox side can be run and profiled offline against a recorded fleet
+"""
+import os
+import gzip
+import json
+import time
+import hashlib
+
+
+def command_set_hash(commands):
+    """Short hash of the probe commands, entries recorded with different commands are not replayed."""
+    return hashlib.sha1(json.dumps(commands, sort_keys=True).encode()).hexdigest()[:12]
+
+
+class FactStore:
+    """
+    Directory of recorded probe output, one file per host and command set.
+
+    ttl is in seconds, 0 or None keeps entries forever
+    """
+
+    def __init__(self, path, commands, ttl=86400):
+        self.path = path
+        self.commands = command_set_hash(commands)
+        self.ttl = ttl
+
+        os.makedirs(path, exist_ok=True)
+
+    def filename(self, host):
+        return os.path.join(self.path, f"{host}-{self.commands}.json.gz")
+
+    def load(self, host, ignore_ttl=False):
+        """Return the recorded probes for host, None if there is no entry or it has expired."""
+        try:
+            with gzip.open(self.filename(host), 'rt') as entry:
+                record = json.load(entry)
+        except (OSError, ValueError):
+            return None
+
+        if self.ttl and not ignore_ttl and time.time() - record['recorded'] > self.ttl:
+            return None
+
+        return record['probes']
+
+    def save(self, host, probes):
+        """Record the probes for host, written to a temp file first so a crash never leaves half an entry."""
+        filename = self.filename(host)
+
+        with gzip.open(filename + '.tmp', 'wt') as entry:
+            json.dump({'host': host, 'recorded': time.time(), 'commands': self.commands, 'probes': probes}, entry)
+
+        os.replace(filename + '.tmp', filename)
+
+    def invalidate(self, host=None):
+        """Remove the entries for host, or every entry in the store when host is None."""
+        for name in os.listdir(self.path):
+            if name.endswith('.json.gz') and (host is None or name.rsplit('-', 1)[0] == host):
+                os.remove(os.path.join(self.path, name))
+
+    def hosts(self):
+        """Names of the hosts recorded with the current command set."""
+        suffix = f"-{self.commands}.json.gz"
+
+        return sorted(name[:-len(suffix)] for name in os.listdir(self.path) if name.endswith(suffix))
+
+    def load_all(self):
+        """Every recorded host and its probes regardless of age, for offline runs against a recorded fleet."""
+        return {host: self.load(host, ignore_ttl=True) for host in self.hosts()}
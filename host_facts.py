@@ -0,0 +1,559 @@
+"""
+Collect the read-only facts the provision tasks need from a host.
+
+1. Every probe is sent as one composite command with delimited sections, so a host costs one SSH round-trip and one sudo
+2. The probe output is parsed once into a HostFacts object stored in host.data['facts'], the NetBox tasks only read that object
+3. Machine readable sources are preferred (lldpcli -f json, ip -j, lshw -json, ipmitool key/value, dmidecode sections) over fixed line indexes
+4. With a FactStore the probe output is recorded, and replayed on later runs instead of reconnecting to the host
+5. facts_fingerprint() hashes the parsed facts so a later run can tell whether anything NetBox cares about changed
+"""
+import json
+import re
+import shlex
+import hashlib
+
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+
+from netaddr import IPAddress
+from nornir.core.task import Task, Result
+
+# Probe name --> command, commands that need root start with sudo
+PROBES = {
+    'lspci': "sudo lspci",
+    'lshw_network': "lshw -class network -businfo",
+    'ip_route': "ip -j route show default",
+    'ip_addr': "ip -j -d addr",
+    # Every NIC backed by a device (no bonds, bridges or veths), one ethtool section each
+    'ethtool_all': 'for dev in /sys/class/net/*/device; do dev=${dev%/device}; ethtool "${dev##*/}"; done',
+    'lldp_neighbors': "sudo lldpcli -f json show neighbors",
+    'ipmi_lan': "sudo ipmitool lan print",
+    'ipmi_mc': "sudo ipmitool mc info",
+    'dmidecode': "sudo dmidecode -t 0,1,2,3,39",
+    'os_release': "cat /etc/os-release",
+    # Whole hardware tree, the CPUs, DIMMs, disks and NICs recorded as inventory items come from here
+    'lshw_json': "sudo lshw -json -quiet",
+}
+
+MARKER = '@@probe:'
+MARKER_PATTERN = re.compile(r'^@@probe:(\w+)@@$')
+DMI_HANDLE_PATTERN = re.compile(r'^Handle 0x[0-9A-Fa-f]+, DMI type (\d+)')
+SPEED_PATTERN = re.compile(r'(\d+)\s*Mb/s')
+ETHTOOL_HEADER_PATTERN = re.compile(r'^Settings for (\S+):')
+
+# Values firmware reports for a serial or part number it does not have
+PLACEHOLDERS = {'', 'none', 'unknown', 'not specified', 'not available', 'to be filled by o.e.m.', 'default string', 'no dimm',
+                '0', '00000000', 'ffffffff'}
+
+
+@dataclass(slots=True)
+class NetInterface:
+    name: str
+    mac_address: Optional[str] = None
+    mtu: Optional[int] = None
+    addresses: list = field(default_factory=list)  # address/prefix strings
+    speed: Optional[int] = None  # Mb/s
+    kind: Optional[str] = None  # bond, vlan, bridge... None for plain ethernet
+    master: Optional[str] = None  # bond the interface is a member of
+    physical: bool = False  # backed by a NIC, it showed up in the ethtool sweep
+
+
+@dataclass(slots=True)
+class LldpNeighbor:
+    interface: str
+    system_name: Optional[str] = None
+    chassis_mac: Optional[str] = None
+    port: Optional[str] = None
+
+
+@dataclass(slots=True)
+class HardwareComponent:
+    kind: str  # cpu, memory, disk or nic
+    name: str  # slot, device or interface name, unique per host
+    vendor: Optional[str] = None
+    part_id: Optional[str] = None
+    serial: Optional[str] = None
+    description: Optional[str] = None
+
+
+@dataclass(slots=True)
+class HostFacts:
+    # Primary NIC, the one that carries the default route
+    default_interface: Optional[str] = None
+    gateway: Optional[str] = None
+    ip_address: Optional[str] = None
+    prefix_length: Optional[int] = None
+    mac_address: Optional[str] = None
+    mtu: Optional[int] = None
+    speed: Optional[int] = None  # Mb/s
+    interfaces: list = field(default_factory=list)
+    lldp_neighbors: list = field(default_factory=list)
+
+    # Intel NICs need LLDP turned off in firmware, so keep the vendor and the (bus, name) pairs
+    nic_vendor: Optional[str] = None
+    nic_buses: list = field(default_factory=list)
+
+    bmc_ip: Optional[str] = None
+    bmc_prefix_length: Optional[int] = None
+    bmc_mac: Optional[str] = None
+    bmc_version: Optional[str] = None
+    bmc_firmware: Optional[str] = None
+
+    bios_version: Optional[str] = None
+    bios_revision: Optional[str] = None
+    sku: Optional[str] = None
+    manufacturer: Optional[str] = None
+    product_name: Optional[str] = None
+    serial: Optional[str] = None
+    chassis_serial: Optional[str] = None
+    baseboard_asset_tag: Optional[str] = None
+    chassis_asset_tag: Optional[str] = None
+    max_power: Optional[int] = None  # Watts
+
+    os_version: Optional[str] = None
+
+    components: list = field(default_factory=list)
+
+    def lldp_neighbor(self, interface=None, fallback=True):
+        """Return the LLDP neighbor seen on interface, or with fallback the first one found if that interface has none."""
+        interface = interface or self.default_interface
+
+        for neighbor in self.lldp_neighbors:
+            if neighbor.interface == interface:
+                return neighbor
+
+        return self.lldp_neighbors[0] if self.lldp_neighbors and fallback else None
+
+    def discovered_interfaces(self):
+        """Physical NICs and the bonds built from them, the interfaces worth recording in NetBox."""
+        return [interface for interface in self.interfaces if interface.physical or interface.kind == 'bond']
+
+
+def load_json(text, default):
+    """Parse JSON probe output, returning default when the command failed or printed nothing."""
+    try:
+        return json.loads(text)
+    except ValueError:
+        return default
+
+
+def parse_key_values(text, separator=':'):
+    """
+    Parse 'Key : Value' output such as ipmitool lan print and mc info.
+
+    Continuation lines (no key before the separator) are skipped, the first value for a key wins
+    """
+    values = {}
+
+    for line in text.splitlines():
+        key, sep, value = line.partition(separator)
+        key = key.strip()
+
+        if sep and key and key not in values:
+            values[key] = value.strip()
+
+    return values
+
+
+def parse_dmidecode(text):
+    """
+    Parse dmidecode output into {DMI type: [section, ...]} where each section is a dict of its top level keys.
+
+    Lists nested under a key (Characteristics etc.) are ignored
+    """
+    sections = {}
+    section = None
+
+    for line in text.splitlines():
+        match = DMI_HANDLE_PATTERN.match(line)
+
+        if match:
+            section = {}
+            sections.setdefault(int(match.group(1)), []).append(section)
+
+        elif section is not None and line.startswith("\t") and not line.startswith("\t\t"):
+            key, sep, value = line.strip().partition(':')
+
+            if sep and value.strip():
+                section[key] = value.strip()
+
+    return sections
+
+
+def parse_os_release(text):
+    """Return the PRETTY_NAME from /etc/os-release without the CentOS '(Core)' suffix."""
+    for line in text.splitlines():
+        key, sep, value = line.partition('=')
+
+        if key == 'PRETTY_NAME':
+            return value.strip().strip('"').replace("(Core)", "").strip()
+
+    return None
+
+
+def parse_speed(text):
+    """Return the link speed in Mb/s from ethtool output, None when the link is down or unknown."""
+    match = SPEED_PATTERN.search(text)
+
+    return int(match.group(1)) if match else None
+
+
+def parse_ethtool_sweep(text):
+    """Return {interface: speed in Mb/s or None} from several ethtool outputs run back to back."""
+    speeds = {}
+    name = None
+
+    for line in text.splitlines():
+        match = ETHTOOL_HEADER_PATTERN.match(line)
+
+        if match:
+            name = match.group(1)
+            speeds[name] = None
+        elif name is not None and speeds[name] is None:
+            speeds[name] = parse_speed(line)
+
+    return speeds
+
+
+def parse_ip_addr(text):
+    """Build NetInterface entries from ip -j -d addr, skipping loopback."""
+    interfaces = []
+
+    for link in load_json(text, []):
+        if link.get('link_type') == 'loopback':
+            continue
+
+        addresses = [f"{a['local']}/{a['prefixlen']}" for a in link.get('addr_info', []) if a.get('family') == 'inet']
+        interfaces.append(NetInterface(name=link['ifname'], mac_address=link.get('address'), mtu=link.get('mtu'), addresses=addresses,
+                                       kind=link.get('linkinfo', {}).get('info_kind'), master=link.get('master')))
+
+    return interfaces
+
+
+def parse_default_route(text):
+    """Return (gateway, interface) of the first default route in ip -j route output."""
+    for route in load_json(text, []):
+        return route.get('gateway'), route.get('dev')
+
+    return None, None
+
+
+def parse_lldp_neighbors(text):
+    """
+    Build LldpNeighbor entries from lldpcli -f json show neighbors.
+
+    lldpcli returns a dict for a single interface and a list of single key dicts for several
+    """
+    interfaces = load_json(text, {}).get('lldp', {}).get('interface', [])
+
+    if isinstance(interfaces, dict):
+        interfaces = [{name: value} for name, value in interfaces.items()]
+
+    neighbors = []
+
+    for entry in interfaces:
+        for name, details in entry.items():
+            neighbor = LldpNeighbor(interface=name)
+
+            # chassis is keyed by system name when the neighbor advertises one
+            chassis = details.get('chassis', {})
+            if chassis and 'id' not in chassis:
+                neighbor.system_name, chassis = next(iter(chassis.items()))
+
+            chassis_id = chassis.get('id', {})
+            if chassis_id.get('type') == 'mac':
+                neighbor.chassis_mac = chassis_id.get('value')
+
+            port = details.get('port', {})
+            neighbor.port = port.get('id', {}).get('value') or port.get('descr')
+
+            neighbors.append(neighbor)
+
+    return neighbors
+
+
+def parse_lspci_vendor(text):
+    """Return the lower case vendor of the first ethernet controller, the first word after 'controller:'."""
+    for line in text.splitlines():
+        if 'ethernet' in line.lower() and 'controller:' in line:
+            return line.split('controller:', 1)[1].split()[0].lower()
+
+    return None
+
+
+def parse_lshw_businfo(text):
+    """Return (pci bus, interface name) pairs from lshw -class network -businfo."""
+    buses = []
+
+    for line in text.splitlines():
+        columns = line.split()
+
+        # Devices without a logical name have the class in the second column
+        if len(columns) > 2 and columns[0].startswith('pci@') and columns[1] != 'network':
+            buses.append((columns[0].replace("pci@0000:", ""), columns[1]))
+
+    return buses
+
+
+def parse_watts(text):
+    """Return the integer wattage from a value like '1600 W', None when unknown."""
+    value = text.strip().rstrip('W').strip()
+
+    return int(value) if value.isdigit() else None
+
+
+def firmware_value(value):
+    """Strip a value reported by firmware, None for the placeholders boards fill empty fields with."""
+    value = str(value).strip() if value is not None else ''
+
+    return None if value.lower() in PLACEHOLDERS else value
+
+
+def format_gib(size):
+    """Format a byte count in GiB, how DIMMs and disks are told apart at a glance."""
+    return f"{size / 2 ** 30:.0f}GiB"
+
+
+def lshw_nodes(node, parent=None):
+    """Yield (node, parent) for every node in an lshw -json tree."""
+    yield node, parent
+
+    for child in node.get('children', []):
+        yield from lshw_nodes(child, node)
+
+
+def parse_lshw_components(text):
+    """
+    Build HardwareComponent entries for the CPUs, populated DIMMs, disks and PCI NICs in lshw -json output.
+
+    Older lshw prints one tree, newer versions a list of them. NVMe namespaces report no serial of their own,
+    they take the controller's vendor, product and serial, and a controller with several namespaces is listed once
+    """
+    trees = load_json(text, [])
+    components, names, serials = [], set(), set()
+
+    for tree in trees if isinstance(trees, list) else [trees]:
+        for node, parent in lshw_nodes(tree):
+            kind = None
+            source = node
+            logicalname = node.get('logicalname')
+            if isinstance(logicalname, list):
+                logicalname = logicalname[0]
+
+            if node.get('class') == 'processor' and not node.get('disabled') and node.get('product'):
+                kind, name = 'cpu', node.get('slot') or node['id']
+
+            elif node.get('class') == 'memory' and node.get('id', '').startswith('bank') and node.get('size'):
+                kind, name = 'memory', node.get('slot') or node['id']
+
+            elif node.get('class') == 'disk' and node.get('size'):
+                kind, name = 'disk', (logicalname or node['id']).rsplit('/', 1)[-1]
+                if not firmware_value(node.get('serial')) and parent and parent.get('class') == 'storage':
+                    source = parent
+
+            elif node.get('class') == 'network' and node.get('businfo', '').startswith('pci@'):
+                kind, name = 'nic', logicalname or node['businfo']
+
+            if kind is None:
+                continue
+
+            serial = firmware_value(source.get('serial'))
+            if serial and (kind, serial) in serials:
+                continue
+
+            # Boards that leave the slot names empty or repeat them still need a unique name per item
+            unique, count = name, 1
+            while unique in names:
+                count += 1
+                unique = f"{name}-{count}"
+
+            description = node.get('description')
+            if kind in ('memory', 'disk') and node.get('units') == 'bytes':
+                description = ", ".join(filter(None, [description, format_gib(node['size'])]))
+
+            names.add(unique)
+            serials.add((kind, serial))
+            components.append(HardwareComponent(kind=kind, name=unique, vendor=firmware_value(source.get('vendor')),
+                                                part_id=firmware_value(source.get('product')), serial=serial, description=description))
+
+    return components
+
+
+def netmask_bits(netmask):
+    """Convert a dotted netmask to a prefix length, None if it is missing or invalid."""
+    try:
+        return IPAddress(netmask).netmask_bits()
+    except Exception:
+        return None
+
+
+def build_host_facts(probes):
+    """Parse the raw probe outputs into a HostFacts object."""
+    facts = HostFacts()
+
+    facts.gateway, facts.default_interface = parse_default_route(probes.get('ip_route', ''))
+    facts.interfaces = parse_ip_addr(probes.get('ip_addr', ''))
+    speeds = parse_ethtool_sweep(probes.get('ethtool_all', ''))
+
+    for interface in facts.interfaces:
+        interface.physical = interface.name in speeds
+        interface.speed = speeds.get(interface.name)
+
+        if interface.name == facts.default_interface:
+            facts.mac_address = interface.mac_address
+            facts.mtu = interface.mtu
+            facts.speed = interface.speed
+            if interface.addresses:
+                address, prefix_length = interface.addresses[0].split('/')
+                facts.ip_address, facts.prefix_length = address, int(prefix_length)
+    facts.lldp_neighbors = parse_lldp_neighbors(probes.get('lldp_neighbors', ''))
+    facts.nic_vendor = parse_lspci_vendor(probes.get('lspci', ''))
+    facts.nic_buses = parse_lshw_businfo(probes.get('lshw_network', ''))
+
+    lan = parse_key_values(probes.get('ipmi_lan', ''))
+    facts.bmc_ip = lan.get('IP Address')
+    facts.bmc_prefix_length = netmask_bits(lan.get('Subnet Mask'))
+    facts.bmc_mac = lan.get('MAC Address')
+
+    mc = parse_key_values(probes.get('ipmi_mc', ''))
+    facts.bmc_version = mc.get('IPMI Version')
+    facts.bmc_firmware = mc.get('Firmware Revision')
+
+    dmi = parse_dmidecode(probes.get('dmidecode', ''))
+    bios = (dmi.get(0) or [{}])[0]
+    system = (dmi.get(1) or [{}])[0]
+    baseboard = (dmi.get(2) or [{}])[0]
+    chassis = (dmi.get(3) or [{}])[0]
+
+    facts.bios_version = bios.get('Version')
+    facts.bios_revision = bios.get('BIOS Revision')
+    facts.sku = system.get('SKU Number')
+    facts.manufacturer = system.get('Manufacturer')
+    facts.product_name = system.get('Product Name')
+    facts.serial = system.get('Serial Number')
+    facts.chassis_serial = chassis.get('Serial Number')
+    facts.baseboard_asset_tag = baseboard.get('Asset Tag')
+    facts.chassis_asset_tag = chassis.get('Asset Tag')
+
+    # Every power supply reports its capacity, use the largest one
+    capacities = [parse_watts(supply.get('Max Power Capacity', '')) for supply in dmi.get(39, [])]
+    capacities = [c for c in capacities if c is not None]
+    facts.max_power = max(capacities) if capacities else None
+
+    facts.os_version = parse_os_release(probes.get('os_release', ''))
+    facts.components = parse_lshw_components(probes.get('lshw_json', ''))
+
+    return facts
+
+
+def facts_fingerprint(facts, **context):
+    """
+    Hash of the parsed facts plus anything else the NetBox writes depend on (node, tenant...).
+
+    Raw probe output is not hashed, counters and timestamps in it would change the hash on every run
+    """
+    data = {'facts': asdict(facts), **context}
+
+    return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def build_composite_command(probes=PROBES):
+    """
+    Join the probes into a single sudo shell command.
+
+    Each probe's output is preceded by a marker line so split_composite_output can cut it back apart
+    """
+    steps = []
+
+    for name, command in probes.items():
+        command = command[len('sudo '):] if command.startswith('sudo ') else command
+        steps.append(f"echo '{MARKER}{name}@@'; {command} 2>&1")
+
+    return "sudo sh -c " + shlex.quote("; ".join(steps))
+
+
+def split_composite_output(output):
+    """Split the output of a composite command into {probe name: output}."""
+    sections = {}
+    name = None
+
+    for line in output.splitlines():
+        match = MARKER_PATTERN.match(line.strip())
+
+        if match:
+            name = match.group(1)
+            sections[name] = []
+        elif name is not None:
+            sections[name].append(line)
+
+    return {name: "\n".join(lines).rstrip("\n") for name, lines in sections.items()}
+
+
+def send_command(task: Task, command_string, **kwargs):
+    """Run a command on the host with netmiko, imported on first use so startup does not pay for netmiko."""
+    from nornir_netmiko.tasks import netmiko_send_command
+
+    return task.run(netmiko_send_command, command_string=command_string, **kwargs)
+
+
+def replay_facts(task: Task, store=None) -> Result:
+    """
+    Load the host's probes from the fact store when it has a fresh entry.
+
+    Replayed hosts are marked with host.data['replayed'] so enable_lldp and collect_facts do not reconnect
+    """
+    probes = store.load(task.host.name) if store else None
+
+    if probes is None:
+        return Result(host=task.host, result="No recorded facts, collecting from the host")
+
+    task.host.data['probes'] = probes
+    task.host.data['facts'] = build_host_facts(probes)
+    task.host.data['replayed'] = True
+
+    return Result(host=task.host, result=task.host.data['facts'])
+
+
+def collect_facts(task: Task, batched=True, store=None) -> Result:
+    """
+    Run the read-only probes on the host and store the parsed HostFacts in host.data['facts'].
+
+    Probes already gathered by an earlier task are not sent again, and nothing is sent for replayed hosts.
+    With batched=False each probe is sent as its own command, which is slower but easier to debug
+    """
+    if task.host.data.get('replayed'):
+        return Result(host=task.host, result=task.host.data['facts'])
+
+    probes = task.host.data.get('probes', {})
+    pending = {name: command for name, command in PROBES.items() if name not in probes}
+
+    if batched and pending:
+        result = send_command(task, build_composite_command(pending), read_timeout=120)
+        probes.update(split_composite_output(result[0].result))
+    else:
+        for name in pending:
+            probes[name] = send_command(task, PROBES[name])[0].result
+
+    missing = [name for name in PROBES if name not in probes]
+    if missing:
+        print(f"{task.host.name} did not return output for probes: {', '.join(missing)}")
+
+    task.host.data['probes'] = probes
+    task.host.data['facts'] = build_host_facts(probes)
+
+    # Only complete collections are recorded, a partial one would be replayed as if the probes had run
+    if store and not missing:
+        store.save(task.host.name, probes)
+
+    return Result(host=task.host, result=task.host.data['facts'])
+
+
+def run_probe(task: Task, name, refresh=False):
+    """Return the output of a probe, running it on its own if collect_facts did not already gather it or refresh is set."""
+    probes = task.host.data.get('probes', {})
+
+    if refresh or name not in probes:
+        probes[name] = send_command(task, PROBES[name])[0].result
+        task.host.data['probes'] = probes
+
+    return probes[name]
@@ -0,0 +1,149 @@
+"""
+Nornir inventory for just the hosts being provisioned, built in memory instead of through InitNornir.
+
+1. Devices are looked up by name with a few list queries, not by pulling every staged minios through NetBoxInventory2
+2. The lookups are kept in a local JSON snapshot, entries younger than the TTL are used without asking NetBox
+3. Older entries are revalidated with one last_updated__gte query, only devices NetBox changed since are fetched again
+4. Connection plugins are registered by name and only imported when the first connection is opened, so startup
+   does not pay for netmiko and napalm
+"""
+import os
+import json
+import time
+import threading
+
+from importlib import metadata
+
+from nornir.core import Nornir
+from nornir.core.inventory import Inventory, Hosts, Host, Groups, Defaults
+from nornir.core.plugins.connections import ConnectionPluginRegister
+from nornir.plugins.runners import ThreadedRunner
+
+from netbox_cache import filter_in
+
+CONNECTION_PLUGINS = 'nornir.plugins.connections'
+
+# The devices NetBoxInventory2 was filtered to in inventory/nornir_nb_minios.yaml
+INVENTORY_FILTER = {'role': 'minios', 'status': 'staged'}
+
+DEFAULT_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'netbox-provision', 'inventory.json')
+
+
+def register_connections():
+    """
+    Register every installed connection plugin under its name without importing it.
+
+    The plugin module is imported the first time a host opens that connection. Names that are already
+    registered, such as the benchmark's simulated plugins, are left alone
+    """
+    for entry_point in metadata.entry_points(group=CONNECTION_PLUGINS):
+        if entry_point.name not in ConnectionPluginRegister.available:
+            ConnectionPluginRegister.register(entry_point.name, lambda entry_point=entry_point: entry_point.load()())
+
+
+def device_entry(record):
+    """The fields of a NetBox device the inventory needs, as plain data for the snapshot."""
+    device = dict(record)
+
+    def slug(field):
+        return (device.get(field) or {}).get('slug')
+
+    status = device.get('status')
+
+    return {
+        'id': device['id'],
+        'name': device['name'],
+        'role': slug('role') or slug('device_role'),
+        'status': status.get('value') if isinstance(status, dict) else status,
+        'platform': slug('platform'),
+        'primary_ip4': ((device.get('primary_ip4') or {}).get('address') or '').split('/')[0] or None,
+        'last_updated': device.get('last_updated'),
+        'fetched': time.time(),
+    }
+
+
+class InventoryCache:
+    """
+    Local snapshot of the NetBox devices looked up by name, at path.
+
+    ttl is in seconds, 0 always revalidates. Every device looked up is kept whatever its status so a
+    device that leaves staged is noticed by its last_updated like any other change.
+    Safe to share between threads, the daemon checks jobs from its API threads against it
+    """
+
+    def __init__(self, path=DEFAULT_CACHE, ttl=3600):
+        self.path = path
+        self.ttl = ttl
+        self.entries = self.load()
+        self.lock = threading.RLock()
+
+    def load(self):
+        try:
+            with open(self.path) as snapshot:
+                return json.load(snapshot)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        # Written next to the snapshot and renamed so a concurrent run never reads half of it
+        with open(self.path + '.tmp', 'w') as snapshot:
+            json.dump(self.entries, snapshot)
+
+        os.replace(self.path + '.tmp', self.path)
+
+    def forget(self, names):
+        """Drop names from the snapshot, for devices this run changed."""
+        with self.lock:
+            dropped = [self.entries.pop(name, None) for name in names]
+
+            if any(dropped):
+                self.save()
+
+    def devices(self, nb, names, match=INVENTORY_FILTER):
+        """
+        Return {name: entry} for the names NetBox has with the role and status in match, staged minios by default.
+
+        An empty match returns every name NetBox has, whatever its status. Fresh entries cost nothing, stale ones one last_updated__gte query and unknown names one name query
+        """
+        with self.lock:
+            now = time.time()
+            names = list(names)
+            stale = [name for name in names if name in self.entries and now - self.entries[name]['fetched'] >= self.ttl]
+            missing = [name for name in names if name not in self.entries]
+
+            if stale:
+                # Anything NetBox did not return has not changed since the oldest stale entry was fetched
+                since = min(self.entries[name]['last_updated'] or '' for name in stale)
+                for record in filter_in(nb.dcim.devices, 'name', stale, last_updated__gte=since):
+                    self.entries[record.name] = device_entry(record)
+
+                for name in stale:
+                    self.entries[name]['fetched'] = now
+
+            if missing:
+                for record in filter_in(nb.dcim.devices, 'name', missing):
+                    self.entries[record.name] = device_entry(record)
+
+            if stale or missing:
+                self.save()
+
+            return {name: self.entries[name] for name in names if name in self.entries and
+                    all(self.entries[name][key] == value for key, value in match.items())}
+
+
+def build_nornir(fleet, devices, workers, username=None, password=None):
+    """
+    In memory Nornir for the hosts in both fleet and devices.
+
+    Hosts are reached on the fleet IP, falling back to the device's primary IP and then its name
+    """
+    hosts = Hosts()
+
+    for name, device in devices.items():
+        data = dict(fleet[name])
+        hosts[name] = Host(name, hostname=data.get('ip_address') or device['primary_ip4'] or name,
+                           platform=device['platform'] or 'linux', username=username, password=password, data=data)
+
+    return Nornir(inventory=Inventory(hosts=hosts, groups=Groups(), defaults=Defaults()), runner=ThreadedRunner(workers))
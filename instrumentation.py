@@ -0,0 +1,242 @@
+"""
+Timing for every stage, SSH command and NetBox API call in a provision run.
+
+1. A nornir processor times each task per host and each netmiko/napalm subtask it runs
+2. A requests response hook on the NetBox session times every API call and attributes it to the task and host running it
+3. Calls are aggregated per (task, host, call) as they happen, so a large fleet only keeps counters and not every call
+4. At the end of a run the aggregates are written as a JSON report and a Prometheus textfile, calls slower than the
+   threshold are also printed as they happen
+"""
+import os
+import re
+import json
+import time
+import threading
+
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from host_facts import MARKER
+
+ID_PATTERN = re.compile(r'/\d+(?=/|$)')
+
+# Host and task used for API calls made outside a nornir task (setup, flush)
+NO_HOST = '-'
+
+
+class Stats:
+    __slots__ = ('count', 'seconds', 'max', 'errors', 'bytes')
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.bytes = 0
+
+    def add(self, seconds, failed=False, size=0):
+        self.count += 1
+        self.seconds += seconds
+        self.max = max(self.max, seconds)
+        self.errors += failed
+        self.bytes += size
+
+    def merge(self, other):
+        self.count += other.count
+        self.seconds += other.seconds
+        self.max = max(self.max, other.max)
+        self.errors += other.errors
+        self.bytes += other.bytes
+
+    def as_dict(self):
+        return {'count': self.count, 'seconds': round(self.seconds, 6), 'max': round(self.max, 6),
+                'errors': self.errors, 'bytes': self.bytes}
+
+
+def command_label(command):
+    """Short name for a command sent over SSH: the program it runs, or 'probes' for a composite probe command."""
+    if MARKER in command:
+        return 'probes'
+
+    words = [word for word in command.split() if word != 'sudo']
+
+    return words[0] if words else command
+
+
+def api_label(request):
+    """Method and endpoint of an API call with object ids removed, GET dcim/interfaces."""
+    path = ID_PATTERN.sub('', urlparse(request.url).path).strip('/')
+
+    return f"{request.method} {path[len('api/'):] if path.startswith('api/') else path}"
+
+
+class Instrumentation:
+    """
+    Nornir processor and NetBox session hook that aggregate timings per task, host and call.
+
+    slow_call is in seconds, calls that take longer are printed when they finish, None disables it
+    """
+
+    def __init__(self, slow_call=None):
+        self.slow_call = slow_call
+        self.lock = threading.Lock()
+        self.context = threading.local()
+        self.tasks = {}
+        self.calls = {}
+        self.slow_calls = []
+        self.started = time.time()
+
+    # Attribution of calls to the task and host running in this thread
+
+    def current(self):
+        stack = getattr(self.context, 'stack', None)
+
+        if not stack:
+            return NO_HOST, getattr(self.context, 'stage', 'main')
+
+        return stack[0][1], stack[0][0]
+
+    @contextmanager
+    def stage(self, name):
+        """Attribute the API calls made in this thread outside of nornir, such as the final flush, to name."""
+        previous = getattr(self.context, 'stage', 'main')
+        self.context.stage = name
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.context.stage = previous
+            self.record_task(name, NO_HOST, time.perf_counter() - start)
+
+    def record_task(self, task, host, seconds, failed=False):
+        with self.lock:
+            self.tasks.setdefault((task, host), Stats()).add(seconds, failed)
+
+    def record_call(self, kind, name, seconds, failed=False, size=0, status=None):
+        host, task = self.current()
+
+        with self.lock:
+            self.calls.setdefault((kind, task, host, name), Stats()).add(seconds, failed, size)
+
+            if self.slow_call is not None and seconds >= self.slow_call:
+                self.slow_calls.append({'kind': kind, 'task': task, 'host': host, 'call': name,
+                                        'seconds': round(seconds, 3), 'status': status})
+                print(f"SLOW {kind} call {name} for {host} in {task}: {seconds:.2f}s (status {status})")
+
+    # Nornir processor interface
+
+    def task_started(self, task):
+        pass
+
+    def task_completed(self, task, result):
+        pass
+
+    def task_instance_started(self, task, host):
+        self.context.stack = [(task.name, host.name, time.perf_counter())]
+
+    def task_instance_completed(self, task, host, result):
+        name, _, start = self.context.stack.pop()
+        self.record_task(name, host.name, time.perf_counter() - start, result.failed)
+
+    def subtask_instance_started(self, task, host):
+        self.context.stack.append((task.name, host.name, time.perf_counter()))
+
+    def subtask_instance_completed(self, task, host, result):
+        name, _, start = self.context.stack.pop()
+        seconds = time.perf_counter() - start
+
+        if 'command_string' in task.params:
+            call = command_label(task.params['command_string'])
+        else:
+            call = name
+
+        output = result[0].result if result else None
+        size = len(output) if isinstance(output, str) else 0
+
+        self.record_call('ssh', call, seconds, result.failed, size, 'failed' if result.failed else 'ok')
+
+    # NetBox session hook
+
+    def attach(self, session):
+        """Time every request sent through a requests session, safe to call more than once."""
+        if self.on_response not in session.hooks['response']:
+            session.hooks['response'].append(self.on_response)
+
+    def on_response(self, response, *args, **kwargs):
+        body = response.request.body or b''
+        size = len(body) + len(response.content or b'')
+
+        self.record_call('api', api_label(response.request), response.elapsed.total_seconds(),
+                         response.status_code >= 400, size, response.status_code)
+
+    # Export
+
+    def report(self):
+        """Every aggregate as plain data, per task and host and rolled up per task and per call."""
+        with self.lock:
+            by_task = {}
+            for (task, host), stats in self.tasks.items():
+                by_task.setdefault(task, Stats()).merge(stats)
+
+            by_call = {}
+            for (kind, task, host, call), stats in self.calls.items():
+                by_call.setdefault((kind, task, call), Stats()).merge(stats)
+
+            return {
+                'started': self.started,
+                'seconds': round(time.time() - self.started, 3),
+                'tasks': [{'task': task, **stats.as_dict()} for task, stats in by_task.items()],
+                'calls': [{'kind': kind, 'task': task, 'call': call, **stats.as_dict()}
+                          for (kind, task, call), stats in sorted(by_call.items(), key=lambda item: -item[1].seconds)],
+                'hosts': [{'task': task, 'host': host, **stats.as_dict()} for (task, host), stats in self.tasks.items()],
+                'host_calls': [{'kind': kind, 'task': task, 'host': host, 'call': call, **stats.as_dict()}
+                               for (kind, task, host, call), stats in self.calls.items()],
+                'slow_calls': list(self.slow_calls),
+            }
+
+    def write_json(self, path):
+        with open(path, 'w') as output:
+            json.dump(self.report(), output, indent=2)
+
+    def write_textfile(self, path, prefix='netbox_provision'):
+        """
+        Write the per task and per call totals in the Prometheus text format, for node_exporter's textfile collector.
+
+        Hosts are left out of the labels so a large fleet does not create a series per host
+        """
+        report = self.report()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for labels, value in samples:
+                label_text = ",".join(f'{key}="{escape(value)}"' for key, value in labels.items())
+                lines.append(f"{prefix}_{name}{{{label_text}}} {value}" if label_text else f"{prefix}_{name} {value}")
+
+        tasks = [({'task': row['task']}, row) for row in report['tasks']]
+        calls = [({'kind': row['kind'], 'task': row['task'], 'call': row['call']}, row) for row in report['calls']]
+
+        metric('task_seconds_total', 'counter', "Seconds spent in each task across all hosts",
+               [(labels, row['seconds']) for labels, row in tasks])
+        metric('task_runs_total', 'counter', "Task runs across all hosts", [(labels, row['count']) for labels, row in tasks])
+        metric('task_failures_total', 'counter', "Task runs that failed", [(labels, row['errors']) for labels, row in tasks])
+        metric('task_max_seconds', 'gauge', "Slowest single run of each task", [(labels, row['max']) for labels, row in tasks])
+        metric('call_seconds_total', 'counter', "Seconds spent in SSH commands and NetBox API calls",
+               [(labels, row['seconds']) for labels, row in calls])
+        metric('calls_total', 'counter', "SSH commands and NetBox API calls made", [(labels, row['count']) for labels, row in calls])
+        metric('call_errors_total', 'counter', "Calls that failed or returned an HTTP error", [(labels, row['errors']) for labels, row in calls])
+        metric('call_bytes_total', 'counter', "Bytes sent and received by the calls", [(labels, row['bytes']) for labels, row in calls])
+        metric('call_max_seconds', 'gauge', "Slowest single call", [(labels, row['max']) for labels, row in calls])
+        metric('run_seconds', 'gauge', "Wall time of the run", [({}, report['seconds'])])
+
+        # Written next to the target and renamed so the collector never reads a half written file
+        with open(path + '.tmp', 'w') as output:
+            output.write("\n".join(lines) + "\n")
+
+        os.replace(path + '.tmp', path)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,97 @@
+"""
+Reconcile a device's NetBox inventory items with the hardware the host reports.
+
+1. lshw -json is parsed into HardwareComponent entries (CPUs, DIMMs, disks, NICs) by host_facts
+2. The device's inventory items are loaded with one query and matched to the components by serial, or by name and part
+   number for parts that report no serial
+3. Matched items only get the fields that differ, components without an item are created and items the script created
+   earlier (discovered) that match no component are deleted. Items added by hand are left alone
+4. The changes are queued on the WriteBuffer, so the whole fleet costs one bulk create, update and delete
+"""
+from netbox_writes import changed_fields
+
+# Longest values NetBox accepts for these inventory item fields
+FIELD_LENGTHS = {'name': 64, 'part_id': 50, 'serial': 50, 'description': 200}
+
+# Component kind --> item label, so the device's inventory tells CPUs, DIMMs, disks and NICs apart
+KIND_LABELS = {'cpu': 'CPU', 'memory': 'DIMM', 'disk': 'Disk', 'nic': 'NIC'}
+
+
+def item_fields(component, references=None):
+    """
+    Inventory item fields for a component.
+
+    The manufacturer is only set when NetBox already has one by that name, vendor strings from firmware would
+    otherwise fill the manufacturer table with spellings of the same company
+    """
+    fields = {'name': component.name, 'label': KIND_LABELS.get(component.kind), 'part_id': component.part_id or '',
+              'serial': component.serial or '', 'description': component.description or '', 'discovered': True}
+
+    for key, length in FIELD_LENGTHS.items():
+        fields[key] = fields[key][:length]
+
+    manufacturer = references.get('manufacturers', component.vendor) if references and component.vendor else None
+    if manufacturer is not None:
+        fields['manufacturer'] = {'id': manufacturer.id}
+
+    return fields
+
+
+def plan_inventory(items, components, references=None):
+    """
+    Work out the changes that make a device's inventory items match its components.
+
+    Returns (creates, updates, deletes): field dicts for new items, (item, changed fields) for existing ones
+    and the discovered items no component matches any more
+    """
+    # Read as dicts, attribute access on a pynetbox Record fetches it again for a missing key
+    records = {item.id: dict(item) for item in items}
+    by_serial, by_name = {}, {}
+
+    for item in items:
+        record = records[item.id]
+        if record.get('serial'):
+            by_serial[record['serial']] = item
+        by_name[(record.get('name'), record.get('part_id') or '')] = item
+    matched = set()
+
+    creates, updates = [], []
+
+    for component in components:
+        fields = item_fields(component, references)
+
+        # A part moved to another slot keeps its item, the name follows it
+        item = by_serial.get(fields['serial']) if fields['serial'] else None
+        if item is None:
+            item = by_name.get((fields['name'], fields['part_id']))
+
+        if item is None or item.id in matched:
+            creates.append(fields)
+            continue
+
+        matched.add(item.id)
+        changes = changed_fields(item, fields)
+
+        if changes:
+            updates.append((item, changes))
+
+    deletes = [item for item in items if item.id not in matched and records[item.id].get('discovered')]
+
+    return creates, updates, deletes
+
+
+def sync_inventory_items(nb, writes, host, device, components, references=None):
+    """Queue the inventory item changes for device on writes, returns the (creates, updates, deletes) counts."""
+    items = list(nb.dcim.inventory_items.filter(device_id=device.id))
+    creates, updates, deletes = plan_inventory(items, components, references)
+
+    for item in deletes:
+        writes.delete_inventory_item(host, item)
+
+    for item, changes in updates:
+        writes.update_inventory_item(host, item, changes)
+
+    for fields in creates:
+        writes.create_inventory_item(host, {'device': device.id, **fields})
+
+    return len(creates), len(updates), len(deletes)
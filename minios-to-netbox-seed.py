@@ -3,89 +3,171 @@ Seed Script to add minios systems to netbox to be provisioned.
 
 1. Adds all minios systems that have an IP from ARP
 2. Script outputs IP and MINIOS so you can paste into /etc/hosts so the main script knows IP for SSH
+3. --all-switches seeds from every switch in the layer-3 inventory at once, each switch is polled in its own thread
+4. --sync-cables makes the NetBox cables of the polled switches match their LLDP tables instead of adding systems
 """
 
-import os
 import sys
-import requests
-import pynetbox
+import argparse
 import warnings
 
 from nornir import InitNornir
-from nornir_utils.plugins.functions import print_result
 from nornir_napalm.plugins.tasks import napalm_get
 from nornir.core.filter import F
-from nornir.core.task import Task, Result
-from urllib3.exceptions import InsecureRequestWarning
+from netbox_client import netbox_api
+from netbox_cache import filter_in
+from cable_sync import sync_cables
 
 warnings.filterwarnings('ignore')
 
-session = requests.Session()
-session.verify = False
-
-nb = pynetbox.api(os.getenv('NB_URL'), os.getenv('NB_TOKEN'))
-nb.http_session = session
-
-nr = InitNornir(config_file="../inventory/nornir_nb_layer-3.yaml")
-
-nr.inventory.defaults.username = input("Enter Username: ")
-nr.inventory.defaults.password = input("Enter Password: ")
+nb = netbox_api(verify=False)
 
 # User variables
 domain_extension = '.local.domain'
 switch = 'switch-name'
 rack_name = '0102'
 
-nr = nr.filter(F(name__contains=switch))
-nr.inventory.hosts
 
-lldp_neighbors = nr.run(task=napalm_get, getters=["get_lldp_neighbors_detail"])
-interfaces = lldp_neighbors[switch][0].result['get_lldp_neighbors_detail']
+def poll_switches(nr):
+    """
+    Fetch LLDP neighbors and the ARP table from every switch in nr.
+
+    Both getters share one NAPALM session per switch, returns {switch: (lldp interfaces, arp table)}
+    """
+    results = nr.run(task=napalm_get, getters=["get_lldp_neighbors_detail", "get_arp_table"])
+    switches = {}
+
+    for name, result in results.items():
+        if result.failed:
+            print(f"Could not poll {name}: {result[0].exception}")
+            continue
+
+        facts = result[0].result
+        switches[name] = (facts['get_lldp_neighbors_detail'], facts['get_arp_table'])
+
+    return switches
 
-arp_table = nr.run(task=napalm_get, getters=["get_arp_table"])
 
+def index_arp_table(arp_table):
+    """
+    Index a switch's ARP entries by interface once: {interface: [ip, ...]}.
 
-def add_minios(task: Task, minios_system, ip, eth) -> Result:
+    Sub-interfaces (Ethernet1/1.100) are folded into their parent port so they match the LLDP interface name
     """
-    Send commands using netmiko to update the server info .
+    arp_index = {}
+
+    for arp in arp_table:
+        port = arp['interface'].split('.')[0]
+        arp_index.setdefault(port, []).append(arp['ip'])
+
+    return arp_index
+
+
+def find_minios(interfaces, arp_index):
+    """
+    Join the LLDP neighbors against the ARP index in a single pass.
+
+    Returns {minios system: (ips, remote port description)}
+    """
+    systems = {}
+
+    for k in interfaces.keys():
+        remote_port_description = interfaces[k][0]['remote_port_description']
+        remote_system = interfaces[k][0]['remote_system_name']
+
+        if remote_system is not None and 'minios' in remote_system:
+            remote_system = remote_system.replace(domain_extension, "").strip()
+            ips, _ = systems.setdefault(remote_system, ([], remote_port_description))
+            ips.extend(ip for ip in arp_index.get(k, []) if ip not in ips)
+
+    # Systems without an ARP entry have no IP to ssh to, so they can not be provisioned yet
+    return {system: found for system, found in systems.items() if found[0]}
+
+
+def merge_switches(switches):
+    """
+    Join each switch's LLDP neighbors with its own ARP table and merge the results.
+
+    A system seen by more than one switch (dual homed) is only created once, with the IPs from all of them
+    """
+    merged = {}
+
+    for name, (interfaces, arp_table) in switches.items():
+        for system, (ips, port_description) in find_minios(interfaces, index_arp_table(arp_table)).items():
+            merged_ips, _ = merged.setdefault(system, ([], port_description))
+            merged_ips.extend(ip for ip in ips if ip not in merged_ips)
+
+    return merged
+
+
+def add_minios(systems):
+    """
+    Create every discovered minios system in NetBox with one bulk request.
+
     Seed file for the real provision script
     """
     if not nb.dcim.racks.get(name=rack_name):
         print(f"Rack Name: {rack_name} is not valid, exiting")
         sys.exit()
 
-    device = nb.dcim.devices.get(name=task.host.name)
+    existing = {d.name for d in filter_in(nb.dcim.devices, 'name', systems)}
+    new_systems = [system for system in systems if system not in existing]
+
+    payloads = [{'name': system, 'device_role': {'name': 'minios'},
+                 'device_type': {'model': 'SYS-6029TP-H-EI012'}, 'status': 'staged', 'rack': {'name': rack_name},
+                 'site': {'name': '1103 Platform Engineering Lab'}, 'platform': {'name': 'linux'},
+                 'tenant': '1'} for system in new_systems]
+
+    if payloads:
+        try:
+            nb.dcim.devices.create(payloads)
+        except:
+            # One bad system fails the whole bulk request, fall back to creating them one at a time
+            for payload in payloads:
+                try:
+                    nb.dcim.devices.create(payload)
+                except:
+                    new_systems.remove(payload['name'])
+
+    # IP and name so they can be pasted into /etc/hosts
+    for system in new_systems:
+        for ip in systems[system][0]:
+            print(f"{ip}  {system} ")
+
 
-    try:
+def main():
+    parser = argparse.ArgumentParser(description="Seed NetBox with minios systems found through LLDP and ARP")
+    parser.add_argument('--switch', default=switch, help="Only seed from switches whose name contains this")
+    parser.add_argument('--all-switches', action='store_true', help="Seed from every switch in the layer-3 inventory")
+    parser.add_argument('--sync-cables', action='store_true', help="Create and delete cables so NetBox matches the switches' LLDP tables")
+    parser.add_argument('--dry-run', action='store_true', help="With --sync-cables only print what would change")
+    parser.add_argument('--workers', type=int, default=10, help="Switches polled at the same time")
+    args = parser.parse_args()
 
-        system = nb.dcim.devices.create({'name': minios_system, 'device_role': {'name': 'minios'},
-                                         'device_type': {'model': 'SYS-6029TP-H-EI012'}, 'status': 'staged', 'rack': {'name': rack_name},
-                                         'site': {'name': '1103 Platform Engineering Lab'}, 'platform': {'name': 'linux'},
-                                         'tenant': '1'})
+    nr = InitNornir(config_file="../inventory/nornir_nb_layer-3.yaml",
+                    runner={'plugin': 'threaded', 'options': {'num_workers': args.workers}})
 
-        print(f"{ip}  {system} ")
+    nr.inventory.defaults.username = input("Enter Username: ")
+    nr.inventory.defaults.password = input("Enter Password: ")
 
-    except:
-        pass
+    if not args.all_switches:
+        nr = nr.filter(F(name__contains=args.switch))
 
-for k in interfaces.keys():
-    remote_port = interfaces[k][0]['remote_port']
-    remote_port_description = interfaces[k][0]['remote_port_description']
-    remote_system = interfaces[k][0]['remote_system_name']
+    if not nr.inventory.hosts:
+        print("No Switches Found!")
+        sys.exit(0)
 
-    if remote_system is not None:
-        if 'minios' in remote_system:
-            remote_system = remote_system.replace(domain_extension, " ")
+    switches = poll_switches(nr)
 
-            for i in arp_table:
-                arps = arp_table[i][0].result['get_arp_table']
+    if args.sync_cables:
+        for name, report in sync_cables(nb, {name: lldp for name, (lldp, _) in switches.items()}, domain_extension, args.dry_run).items():
+            print(f"{name}: created {report['created']} deleted {report['deleted']} cables")
+            for error in report['errors']:
+                print(f"{name}: {error}")
+        return
 
-                j = 0
+    add_minios(merge_switches(switches))
 
-                for a in arps:
-                    interface = arps[j]['interface']
 
-                    if k in interface:
-                        address = arps[j]['ip']
-                        nr.run(task=add_minios, minios_system=remote_system, ip=address, eth=remote_port_description)
-                    j += 1
+if __name__ == "__main__":
+    main()
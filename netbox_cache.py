@@ -0,0 +1,263 @@
+"""
+Per-run caches for NetBox lookups used by the provision scripts.
+
+1. Switch interfaces are fetched once per switch with a filtered query and indexed by normalized port name
+2. Reference tables (roles, platforms, tenants, manufacturers, device types, tags) are prefetched once and kept up to date in place
+3. filter_in() looks up many objects by one field with a few list queries instead of one query per object
+4. IP addresses are loaded per prefix (or by exact address for a few stragglers) and answered locally by address
+"""
+import re
+import threading
+
+from netaddr import IPNetwork, IPSet
+
+# LLDP and NetBox do not always agree on how a port is spelled, so map the short forms to the long ones
+PORT_PREFIXES = {
+    'eth': 'ethernet',
+    'et': 'ethernet',
+    'te': 'tengigabitethernet',
+    'gi': 'gigabitethernet',
+    'fo': 'fortygigabitethernet',
+    'hu': 'hundredgige',
+}
+
+PORT_PATTERN = re.compile(r'^([a-z\-]+?)(\d.*)$')
+
+# What may follow a port's name in the name of its breakout lanes (ethernet1/1/1) or subinterfaces (ethernet1/1.100)
+ALIAS_SEPARATORS = ('/', '.', ':')
+
+# Values per list query, keeps the url well under the length web servers accept
+FILTER_CHUNK = 100
+
+# A prefix is loaded whole once a run needs at least this many addresses from it, fewer are looked up one by one
+PREFIX_LOAD_MIN = 20
+
+
+def filter_in(endpoint, field, values, chunk=FILTER_CHUNK, **filters):
+    """Yield the records of endpoint whose field matches any of values, chunk values per request, narrowed by filters."""
+    values = list(values)
+
+    for start in range(0, len(values), chunk):
+        yield from endpoint.filter(**{field: values[start:start + chunk]}, **filters)
+
+
+def normalize_port_name(name):
+    """
+    Normalize a port name so LLDP and NetBox spellings compare equal.
+
+    Ethernet1/1, ethernet 1/1 and Eth1/1 all become ethernet1/1
+    """
+    port = name.strip().lower().replace(" ", "")
+    match = PORT_PATTERN.match(port)
+
+    if match:
+        prefix, number = match.groups()
+        port = PORT_PREFIXES.get(prefix, prefix) + number
+
+    return port
+
+
+class SwitchInterfaceCache:
+    """
+    Resolve (neighbor device, port name) to a NetBox interface.
+
+    Each switch costs one filtered interface query per run, no matter how many servers are cabled to it
+    """
+
+    def __init__(self, nb):
+        self.nb = nb
+        self.switches = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def interfaces(self, device_name):
+        """Return the interfaces of a switch keyed by normalized port name, fetching them on first use."""
+        with self.lock:
+            lock = self.locks.setdefault(device_name, threading.Lock())
+
+        # Held while fetching so hosts cabled to the same switch wait for one query, other switches are fetched alongside
+        with lock:
+            if device_name not in self.switches:
+                self.switches[device_name] = {normalize_port_name(i.name): i for i in self.nb.dcim.interfaces.filter(device=device_name)}
+
+            return self.switches[device_name]
+
+    def clear(self):
+        with self.lock:
+            self.switches = {}
+            self.locks = {}
+
+    def get(self, device_name, port_name):
+        """
+        Find the interface on device_name that matches the LLDP port_name.
+
+        Exact matches win, otherwise the port's first breakout lane or subinterface, the shortest then lowest name.
+        Anything else returns None, ethernet1/1 must never end up cabled to ethernet1/10
+        """
+        interfaces = self.interfaces(device_name)
+        port = normalize_port_name(port_name)
+
+        if port in interfaces:
+            return interfaces[port]
+
+        matches = [name for name in interfaces if name.startswith(port) and name[len(port):len(port) + 1] in ALIAS_SEPARATORS]
+
+        if matches:
+            return interfaces[min(matches, key=lambda name: (len(name), name))]
+
+        return None
+
+
+class ReferenceCache:
+    """
+    Small reference tables (roles, platforms, tenants, manufacturers, device types and tags) fetched once per run.
+
+    Records are keyed by name and by slug, device types use their model as the name.
+    Records created through ensure() are added in place so later hosts find them without another request
+    """
+
+    ENDPOINTS = {
+        'device_roles': ('dcim', 'device_roles'),
+        'platforms': ('dcim', 'platforms'),
+        'tenants': ('tenancy', 'tenants'),
+        'manufacturers': ('dcim', 'manufacturers'),
+        'device_types': ('dcim', 'device_types'),
+        'tags': ('extras', 'tags'),
+    }
+
+    def __init__(self, nb):
+        self.nb = nb
+        self.tables = {}
+        self.statuses = None
+        self.lock = threading.RLock()
+
+    def endpoint(self, table):
+        app, name = self.ENDPOINTS[table]
+        return getattr(getattr(self.nb, app), name)
+
+    def prefetch(self):
+        """Load every reference table and the device status choices."""
+        with self.lock:
+            for table in self.ENDPOINTS:
+                self.tables[table] = {}
+                for record in self.endpoint(table).all():
+                    self.add(table, record)
+
+            self.statuses = {choice['value'] for choice in self.nb.dcim.devices.choices().get('status', [])}
+
+    def add(self, table, record):
+        """Index a record by name (model for device types) and slug."""
+        with self.lock:
+            index = self.tables.setdefault(table, {})
+            index[record.model if table == 'device_types' else record.name] = record
+            index[record.slug] = record
+
+    def get(self, table, name):
+        """Return the record with this name or slug, None if NetBox does not have one."""
+        with self.lock:
+            if table not in self.tables:
+                self.prefetch()
+
+            return self.tables[table].get(name)
+
+    def valid_status(self, status):
+        with self.lock:
+            if self.statuses is None:
+                self.prefetch()
+
+            return status in self.statuses
+
+    def ensure(self, table, name, payload):
+        """
+        Return the record for name, creating it from payload if it does not exist yet.
+
+        The lock is held over the create so two hosts can not create the same manufacturer or tag at once
+        """
+        with self.lock:
+            record = self.get(table, name)
+
+            if record is None:
+                record = self.endpoint(table).create(payload)
+                self.add(table, record)
+
+            return record
+
+
+class IpamCache:
+    """
+    NetBox IP addresses keyed by address, for the prefixes and addresses a run asked for.
+
+    Lookups are exact on the address whatever mask NetBox stores it with. Anything not loaded yet is fetched on
+    first use, and addresses NetBox does not have are remembered as missing too. Hosts claim the addresses they
+    assign so two hosts reporting the same IP in one batch do not both create it
+    """
+
+    def __init__(self, nb):
+        self.nb = nb
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.loaded = IPSet()
+            self.records = {}
+            self.claims = {}
+
+    def add(self, record):
+        """Index a NetBox IP record, also used by the WriteBuffer for the IPs it creates and updates."""
+        with self.lock:
+            self.records[IPNetwork(record.address).ip] = record
+
+    def load(self, addresses, min_per_prefix=PREFIX_LOAD_MIN):
+        """
+        Fetch the records for addresses (address/prefix strings) in as few list queries as possible.
+
+        Prefixes holding at least min_per_prefix of the addresses are loaded whole with parent=, the rest by address
+        """
+        by_prefix = {}
+        for address in addresses:
+            network = IPNetwork(address)
+            by_prefix.setdefault(network.cidr, set()).add(network.ip)
+
+        with self.lock:
+            prefixes = [prefix for prefix, ips in by_prefix.items() if len(ips) >= min_per_prefix and prefix not in self.loaded]
+            singles = [ip for prefix, ips in by_prefix.items() if prefix not in prefixes for ip in ips if ip not in self.loaded]
+
+            for record in filter_in(self.nb.ipam.ip_addresses, 'parent', [str(prefix) for prefix in prefixes]):
+                self.add(record)
+
+            for record in filter_in(self.nb.ipam.ip_addresses, 'address', [str(ip) for ip in singles]):
+                self.add(record)
+
+            for network in prefixes + singles:
+                self.loaded.add(network)
+
+    def get(self, address):
+        """Return the NetBox record for address, with or without a mask, None if NetBox does not have it."""
+        ip = IPNetwork(address).ip
+
+        with self.lock:
+            if ip not in self.loaded:
+                self.load([str(ip)])
+
+            return self.records.get(ip)
+
+    def claim(self, address, host):
+        """Claim address for host in this batch, returns the host that claimed it first."""
+        with self.lock:
+            return self.claims.setdefault(IPNetwork(address).ip, host)
+
+    def assign(self, writes, host, address, interface, status=None):
+        """
+        Queue assigning address to interface through writes, creating the IP if NetBox does not have it.
+
+        Returns False without queuing anything when another host already claimed the address in this batch
+        """
+        owner = self.claim(address, host)
+
+        if owner != host:
+            print(f"{address} on {host} is already assigned to {owner} in this run, skipping it")
+            return False
+
+        writes.assign_ip(host, address, interface, record=self.get(address), status=status)
+        return True
@@ -0,0 +1,129 @@
+"""
+Shared NetBox client for the provision and seed scripts.
+
+1. Connection pool sized for concurrent provisioning, connections are kept alive and reused instead of opened per request
+2. Every request gets a timeout, idempotent requests are retried with jittered backoff on 429/5xx and connection errors
+3. Optional caps on requests in flight and requests per second so a fleet run can not overload NetBox
+
+Defaults can be overridden with NB_POOL_SIZE, NB_MAX_REQUESTS, NB_TIMEOUT, NB_RETRIES and NB_RATE_LIMIT
+"""
+import os
+import time
+import random
+import threading
+
+import pynetbox
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class JitteredRetry(Retry):
+    """Retry that spreads its backoff randomly so concurrent workers do not retry in lock step."""
+
+    def get_backoff_time(self):
+        backoff = super().get_backoff_time()
+
+        return backoff + random.uniform(0, backoff) if backoff else 0
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread using the session, allows bursts up to one second of requests.
+
+    The bucket holds at least one token, a rate below 1 per second could never fill it up to a request otherwise
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+
+class NetBoxSession(requests.Session):
+    """
+    requests.Session with a default timeout and optional limits on concurrency and request rate.
+
+    The limits are applied before the request is sent, retries done by the adapter count as one request
+    """
+
+    def __init__(self, timeout, max_requests=None, rate=None):
+        super().__init__()
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_requests) if max_requests else None
+        self.limiter = RateLimiter(rate) if rate else None
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+
+        if self.limiter:
+            self.limiter.wait()
+
+        if self.slots is None:
+            return super().request(method, url, **kwargs)
+
+        with self.slots:
+            return super().request(method, url, **kwargs)
+
+
+def env_number(name, default, cast=int):
+    value = os.getenv(name)
+
+    return cast(value) if value else default
+
+
+def build_session(pool_size=None, max_requests=None, timeout=None, retries=None, backoff=0.5, rate=None, verify=True):
+    """
+    Build a pooled, retrying session.
+
+    pool_size      connections kept open to NetBox, requests wait for a free one instead of opening throwaway connections
+    max_requests   requests in flight at once across all threads, None for no limit
+    timeout        seconds to wait for NetBox, a number or a (connect, read) tuple
+    retries        attempts for idempotent requests (GET, PUT, DELETE...) that hit a 429/5xx or connection error
+    rate           requests per second ceiling, None for no limit
+    """
+    pool_size = pool_size or env_number('NB_POOL_SIZE', 20)
+    max_requests = max_requests or env_number('NB_MAX_REQUESTS', None)
+    timeout = timeout or (5, env_number('NB_TIMEOUT', 60, float))
+    retries = env_number('NB_RETRIES', 3) if retries is None else retries
+    rate = rate or env_number('NB_RATE_LIMIT', None, float)
+
+    retry = JitteredRetry(total=retries, backoff_factor=backoff, status_forcelist=RETRY_STATUSES,
+                          respect_retry_after_header=True, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+
+    session = NetBoxSession(timeout, max_requests=max_requests, rate=rate)
+    session.verify = verify
+    session.headers['Connection'] = 'keep-alive'
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+def netbox_api(url=None, token=None, **session_options):
+    """Return a pynetbox api for NB_URL/NB_TOKEN that uses a session from build_session()."""
+    nb = pynetbox.api(url or os.getenv('NB_URL'), token or os.getenv('NB_TOKEN'))
+    nb.http_session = build_session(**session_options)
+
+    return nb
@@ -0,0 +1,350 @@
+"""
+Buffer NetBox writes from every task and host and flush them as bulk requests.
+
+1. Tasks queue interfaces, IP assignments, device updates, bay installs, inventory items, cables and power ports instead of
+   writing them one at a time
+2. flush() sends one list request per object type in dependency order: interfaces, interface updates, IPs, devices, bays,
+   inventory item deletes, updates and creates, cable deletes, cables, power ports, interface deletes
+3. Interfaces that do not exist yet are referenced by InterfaceRef and resolved to their new id once they are created
+4. In reconcile mode updates are compared with the current record first, only changed fields are sent
+"""
+import re
+import threading
+
+from collections import namedtuple, defaultdict
+
+# Stands in for the id of an interface that is queued but not created yet
+InterfaceRef = namedtuple('InterfaceRef', ['device', 'name'])
+
+MAC_PATTERN = re.compile(r'^[0-9A-Fa-f]{2}([:-][0-9A-Fa-f]{2}){5}$')
+
+
+class UnresolvedRef(Exception):
+    pass
+
+
+def ref_key(value):
+    """Name of a nested object (tag etc) whether it came from a payload dict or a pynetbox Record."""
+    if isinstance(value, dict):
+        return value.get('name') or value.get('id')
+
+    return getattr(value, 'name', None) or getattr(value, 'id', value)
+
+
+def field_differs(current, desired):
+    """
+    Compare a desired payload value with the current value on a NetBox record.
+
+    Nested lookups like {'name': 'server'} only compare the keys that are given, choice fields compare their value,
+    MAC addresses compare case insensitively
+    """
+    if isinstance(desired, dict):
+        if current is None:
+            return any(value is not None for value in desired.values())
+
+        for key, value in desired.items():
+            current_value = current.get(key) if isinstance(current, dict) else getattr(current, key, None)
+            if field_differs(current_value, value):
+                return True
+
+        return False
+
+    if isinstance(desired, list):
+        return sorted(map(str, map(ref_key, desired))) != sorted(map(str, map(ref_key, current or [])))
+
+    # Choice fields (status etc) come back as {'value': ..., 'label': ...}
+    current = getattr(current, 'value', current)
+    if isinstance(current, dict):
+        current = current.get('value')
+
+    if current is None or desired is None:
+        return current != desired
+
+    current, desired = str(current), str(desired)
+
+    # NetBox returns MACs upper case, ip -j lower case
+    if MAC_PATTERN.match(current) and MAC_PATTERN.match(desired):
+        return current.lower().replace('-', ':') != desired.lower().replace('-', ':')
+
+    return current != desired
+
+
+def changed_fields(record, fields):
+    """
+    Return only the fields whose desired value differs from what the record has now.
+
+    The record is compared as a dict, attribute access on a pynetbox Record fetches it again for missing keys
+    """
+    current = dict(record)
+
+    return {key: value for key, value in fields.items() if field_differs(current.get(key), value)}
+
+
+class WriteBuffer:
+    """
+    Collect the mutations the tasks want to make and apply them in bulk.
+
+    Every queued write remembers the host it belongs to so created ids and errors are reported back per host.
+    IPs that are created or updated are added to ipam, an IpamCache, when one is given
+    """
+
+    def __init__(self, nb, reconcile=False, ipam=None):
+        self.nb = nb
+        self.reconcile = reconcile
+        self.ipam = ipam
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.interfaces = {}
+        self.interface_updates = {}
+        self.ip_creates = {}
+        self.ip_updates = {}
+        self.device_updates = {}
+        self.bay_updates = {}
+        self.inventory_deletes = {}
+        self.inventory_updates = {}
+        self.inventory_creates = {}
+        self.cable_deletes = {}
+        self.cables = {}
+        self.power_port_creates = {}
+        self.power_port_updates = {}
+        self.interface_deletes = {}
+        self.created = {}
+        self.report = defaultdict(lambda: {'created': 0, 'updated': 0, 'deleted': 0, 'avoided': 0, 'errors': [], 'ids': {}})
+
+    def unchanged(self, host, record, fields):
+        """
+        In reconcile mode drop the fields that already match the record.
+
+        Returns the fields left to send, an empty dict means the write was avoided
+        """
+        if not self.reconcile:
+            return fields
+
+        fields = changed_fields(record, fields)
+
+        if not fields:
+            with self.lock:
+                self.report[host]['avoided'] += 1
+
+        return fields
+
+    def create_interface(self, host, payload):
+        """Queue an interface create and return the InterfaceRef other writes can point at."""
+        ref = InterfaceRef(payload['device'], payload['name'])
+
+        with self.lock:
+            self.interfaces.setdefault(ref, (host, payload))
+
+        return ref
+
+    def update_interface(self, host, interface, fields):
+        """
+        Queue fields to PATCH on an interface, a pynetbox record or an InterfaceRef for one queued for creation.
+
+        Updates run right after the creates, so a bond member can point its lag at a bond created in the same flush
+        """
+        if isinstance(interface, InterfaceRef):
+            key = interface
+        else:
+            fields = self.unchanged(host, interface, fields)
+            key = interface.id
+
+        if not fields:
+            return
+
+        with self.lock:
+            _, payload = self.interface_updates.setdefault(key, (host, {'id': key}))
+            payload.update(fields)
+
+    def assign_ip(self, host, address, interface, record=None, status=None):
+        """
+        Assign an IP to an interface (an id or an InterfaceRef).
+
+        record is the existing NetBox IP, when there is none the IP is created with the assignment in one go
+        """
+        assignment = {'assigned_object_type': 'dcim.interface', 'assigned_object_id': interface}
+
+        with self.lock:
+            if record is None:
+                self.ip_creates[address] = (host, {'address': address, 'status': status, **assignment})
+                return
+
+        if isinstance(interface, InterfaceRef):
+            changes = assignment
+        else:
+            changes = self.unchanged(host, record, assignment)
+
+        if changes:
+            with self.lock:
+                self.ip_updates[record.id] = (host, {'id': record.id, **changes})
+
+    def update_device(self, host, device, fields):
+        """Queue fields to PATCH on a device, several calls for the same device end up in one update."""
+        fields = self.unchanged(host, device, fields)
+
+        if not fields:
+            return
+
+        with self.lock:
+            _, payload = self.device_updates.setdefault(device.id, (host, {'id': device.id}))
+
+            for key, value in fields.items():
+                if key == 'custom_fields' and key in payload:
+                    payload[key].update(value)
+                else:
+                    payload[key] = value
+
+    def install_device(self, host, bay, device_id):
+        """Queue installing a device into a device bay, sent after the device updates so the child is set up first."""
+        with self.lock:
+            self.bay_updates[bay.id] = (host, {'id': bay.id, 'installed_device': device_id})
+
+    def create_inventory_item(self, host, payload):
+        """Queue an inventory item create, keyed by device and name as NetBox keeps them unique."""
+        with self.lock:
+            self.inventory_creates.setdefault((payload['device'], payload['name']), (host, payload))
+
+    def update_inventory_item(self, host, item, fields):
+        """Queue fields to PATCH on an inventory item, the caller has already left out the ones that match."""
+        with self.lock:
+            _, payload = self.inventory_updates.setdefault(item.id, (host, {'id': item.id}))
+            payload.update(fields)
+
+    def delete_inventory_item(self, host, item):
+        """Queue an inventory item delete, sent before the updates and creates so a replaced part frees its name."""
+        with self.lock:
+            self.inventory_deletes[item.id] = (host, item.id)
+
+    def create_cable(self, host, a_interface, b_interface):
+        """Queue a cable between two interfaces, either may be an id or an InterfaceRef."""
+        with self.lock:
+            self.cables.setdefault((a_interface, b_interface), (host, {
+                'termination_a_type': 'dcim.interface', 'termination_a_id': a_interface,
+                'termination_b_type': 'dcim.interface', 'termination_b_id': b_interface}))
+
+    def delete_cable(self, host, cable_id):
+        """Queue a cable delete, sent before the cable creates so the ports are free for their new cables."""
+        with self.lock:
+            self.cable_deletes[cable_id] = (host, cable_id)
+
+    def create_power_port(self, host, payload):
+        """Queue a power port, children of the same chassis asking for the same port only create it once."""
+        with self.lock:
+            self.power_port_creates.setdefault((payload['device'], payload['name']), (host, payload))
+
+    def update_power_port(self, host, port, fields):
+        fields = self.unchanged(host, port, fields)
+
+        if not fields:
+            return
+
+        with self.lock:
+            self.power_port_updates.setdefault(port.id, (host, {'id': port.id, **fields}))
+
+    def delete_interface(self, host, interface):
+        """Queue an interface delete, deletes run last so IPs have moved off the interface first."""
+        with self.lock:
+            self.interface_deletes[interface.id] = (host, interface.id)
+
+    def resolve(self, payload):
+        """Swap InterfaceRefs in a payload for the ids NetBox gave the new interfaces."""
+        resolved = {}
+
+        for key, value in payload.items():
+            if isinstance(value, InterfaceRef):
+                if value not in self.created:
+                    raise UnresolvedRef(f"interface {value.name} on device {value.device} was not created")
+                value = self.created[value]
+            resolved[key] = value
+
+        return resolved
+
+    def apply(self, endpoint, method, queued, action):
+        """
+        Send one bulk request for the queued (host, payload) items and return the records in the same order.
+
+        NetBox rolls back the whole list if one item is bad, so on failure the items are retried one at a time
+        to find the bad one and let the rest through
+        """
+        items = []
+
+        for host, payload in queued:
+            try:
+                items.append((host, payload if method == 'delete' else self.resolve(payload)))
+            except UnresolvedRef as error:
+                self.report[host]['errors'].append(str(error))
+
+        if not items:
+            return []
+
+        try:
+            records = self.send(endpoint, method, [payload for _, payload in items])
+            for host, _ in items:
+                self.report[host][action] += 1
+            results = list(zip(items, records))
+
+        except Exception as error:
+            print(f"Bulk {method} of {len(items)} {endpoint.name} failed, retrying one at a time: {error}")
+
+            results = []
+
+            for host, payload in items:
+                try:
+                    results.append(((host, payload), self.send(endpoint, method, [payload])[0]))
+                    self.report[host][action] += 1
+                except Exception as error:
+                    self.report[host]['errors'].append(f"{method} {endpoint.name} {payload}: {error}")
+
+        # The ids of new objects are reported per host and endpoint, the run journal keeps them
+        if method == 'create':
+            for (host, _), record in results:
+                self.report[host]['ids'].setdefault(endpoint.name, []).append(record.id)
+
+        return results
+
+    def send(self, endpoint, method, payloads):
+        if method == 'create':
+            return endpoint.create(payloads)
+
+        if method == 'update':
+            return endpoint.update(payloads)
+
+        endpoint.delete(payloads)
+        return payloads
+
+    def flush(self):
+        """
+        Apply everything that was queued, in dependency order, and return the per host report.
+
+        The buffer is empty again afterwards
+        """
+        with self.lock:
+            dcim, ipam = self.nb.dcim, self.nb.ipam
+
+            for (host, payload), record in self.apply(dcim.interfaces, 'create', self.interfaces.values(), 'created'):
+                self.created[InterfaceRef(payload['device'], payload['name'])] = record.id
+
+            self.apply(dcim.interfaces, 'update', self.interface_updates.values(), 'updated')
+            ips = self.apply(ipam.ip_addresses, 'create', self.ip_creates.values(), 'created')
+            ips += self.apply(ipam.ip_addresses, 'update', self.ip_updates.values(), 'updated')
+
+            if self.ipam is not None:
+                for _, record in ips:
+                    self.ipam.add(record)
+            self.apply(dcim.devices, 'update', self.device_updates.values(), 'updated')
+            self.apply(dcim.device_bays, 'update', self.bay_updates.values(), 'updated')
+            self.apply(dcim.inventory_items, 'delete', self.inventory_deletes.values(), 'deleted')
+            self.apply(dcim.inventory_items, 'update', self.inventory_updates.values(), 'updated')
+            self.apply(dcim.inventory_items, 'create', self.inventory_creates.values(), 'created')
+            self.apply(dcim.cables, 'delete', self.cable_deletes.values(), 'deleted')
+            self.apply(dcim.cables, 'create', self.cables.values(), 'created')
+            self.apply(dcim.power_ports, 'create', self.power_port_creates.values(), 'created')
+            self.apply(dcim.power_ports, 'update', self.power_port_updates.values(), 'updated')
+            self.apply(dcim.interfaces, 'delete', self.interface_deletes.values(), 'deleted')
+
+            report = {host: dict(counts) for host, counts in self.report.items()}
+            self.clear()
+
+            return report
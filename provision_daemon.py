@@ -0,0 +1,409 @@
+"""
+Service that keeps NetBox connections and caches warm and provisions servers as they show up.
+
+1. Jobs come from polling NetBox for staged minios devices (the same filter as inventory/nornir_nb_minios.yaml),
+   from POST /jobs, or from a NetBox webhook sent to POST /webhook
+2. One dispatcher takes every queued job as a batch and provisions it on nornir's threaded runner, --workers hosts at once
+3. GET /jobs and GET /jobs/<id> report job status, the pynetbox session, TLS connections and reference caches are set up
+   once at startup instead of once per server
+
+SSH credentials are read from PROVISION_USERNAME and PROVISION_PASSWORD, NetBox from NB_URL and NB_TOKEN
+
+python provision_daemon.py --workers 10 --poll-interval 60 --listen 127.0.0.1:8080
+"""
+import os
+import sys
+import hmac
+import json
+import time
+import queue
+import socket
+import hashlib
+import argparse
+import itertools
+import threading
+
+from dataclasses import dataclass, field, asdict
+from typing import Optional
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import provision_server_netbox as provisioner
+
+from fact_store import FactStore
+from host_facts import PROBES
+from instrumentation import Instrumentation
+from host_inventory import InventoryCache, DEFAULT_CACHE, INVENTORY_FILTER, register_connections, build_nornir
+
+ACTIVE_STATUSES = ('queued', 'running')
+
+
+@dataclass(slots=True)
+class Job:
+    id: int
+    hostname: str
+    ip_address: str
+    node: str
+    source: str  # poll, api or webhook
+    status: str = 'queued'  # queued, running, done, unchanged or failed
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    result: Optional[dict] = None
+
+
+class JobQueue:
+    """
+    Every job by id and the queue of ids waiting to run.
+
+    A host only has one queued or running job at a time, submitting it again returns that job
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.pending = queue.Queue()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def submit(self, hostname, ip_address, node=None, source='api'):
+        with self.lock:
+            for job in self.jobs.values():
+                if job.hostname == hostname and job.status in ACTIVE_STATUSES:
+                    return job
+
+            job = Job(next(self.ids), hostname, ip_address, node or provisioner.default_node, source)
+            self.jobs[job.id] = job
+
+        self.pending.put(job.id)
+        print(f"Job {job.id}: {hostname} queued from {source}")
+
+        return job
+
+    def take(self, limit, timeout=1.0):
+        """Wait up to timeout for a job, then return it with the others already waiting, at most limit."""
+        try:
+            ids = [self.pending.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        while len(ids) < limit:
+            try:
+                ids.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+
+        with self.lock:
+            return [self.jobs[job_id] for job_id in ids]
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def last(self, hostname):
+        """Most recent job for hostname, None if it never had one."""
+        with self.lock:
+            jobs = [job for job in self.jobs.values() if job.hostname == hostname]
+
+        return jobs[-1] if jobs else None
+
+    def snapshot(self):
+        with self.lock:
+            return [asdict(job) for job in self.jobs.values()]
+
+    def counts(self):
+        counts = {}
+
+        with self.lock:
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+
+        return counts
+
+    def prune(self, max_age):
+        """Forget finished jobs older than max_age seconds so a long running service does not grow forever."""
+        cutoff = time.time() - max_age
+
+        with self.lock:
+            for job_id in [job.id for job in self.jobs.values() if job.finished and job.finished < cutoff]:
+                del self.jobs[job_id]
+
+
+def device_ip(device):
+    """
+    IP to ssh to a device: its primary IPv4, else whatever its name resolves to.
+
+    The seed script prints IP and name for /etc/hosts, so a staged minios normally resolves through that
+    """
+    primary = (device.get('primary_ip4') or {}).get('address')
+
+    if primary:
+        return primary.split('/')[0]
+
+    try:
+        return socket.gethostbyname(device['name'])
+    except OSError:
+        return None
+
+
+def poll_staged(jobs, interval, retry_after, stop):
+    """
+    Queue every staged minios device NetBox has, every interval seconds.
+
+    Hosts whose last job failed are left alone for retry_after seconds instead of being retried on every poll
+    """
+    unresolved = set()
+
+    while not stop.is_set():
+        try:
+            devices = [dict(device) for device in provisioner.nb.dcim.devices.filter(**INVENTORY_FILTER)]
+        except Exception as error:
+            print(f"Polling NetBox for staged devices failed: {error}")
+            devices = []
+
+        for device in devices:
+            last = jobs.last(device['name'])
+
+            if last is not None and last.status == 'failed' and time.time() - last.finished < retry_after:
+                continue
+
+            ip_address = device_ip(device)
+
+            if ip_address is None:
+                if device['name'] not in unresolved:
+                    print(f"{device['name']} is staged but has no primary IP and does not resolve, skipping it")
+                    unresolved.add(device['name'])
+                continue
+
+            jobs.submit(device['name'], ip_address, source='poll')
+
+        stop.wait(interval)
+
+
+def run_batch(batch, args, inventory, fact_store, instrumentation):
+    """
+    Provision a batch of jobs together and record each job's outcome.
+
+    Jobs are checked against NetBox again when they run, a device that left staged while queued fails its job
+    """
+    for job in batch:
+        job.status, job.started = 'running', time.time()
+
+    fleet = {job.hostname: {'ip_address': job.ip_address, 'node': job.node} for job in batch}
+    devices = inventory.devices(provisioner.nb, fleet)
+    nr = build_nornir(fleet, devices, args.workers, args.username, args.password)
+
+    try:
+        report = provisioner.provision(nr, fact_store, instrumentation, args.force, args.discover_nics) if devices else {}
+    except Exception as error:
+        print(f"Batch of {len(batch)} failed: {error}")
+        report = {job.hostname: {'errors': [f"batch failed: {error}"]} for job in batch}
+
+    for name in fleet:
+        if name not in devices:
+            report[name] = {'errors': [f"{name} is not a staged minios in NetBox"]}
+
+    # Provisioned hosts are no longer staged, the next job for them looks them up again
+    inventory.forget([name for name, result in report.items() if not result.get('errors')])
+
+    for job in batch:
+        job.result = report.get(job.hostname, {})
+        job.finished = time.time()
+
+        if job.result.get('errors'):
+            job.status = 'failed'
+        elif nr.inventory.hosts[job.hostname].data.get('unchanged'):
+            job.status = 'unchanged'
+        else:
+            job.status = 'done'
+
+        print(f"Job {job.id}: {job.hostname} {job.status} in {job.finished - job.started:.1f}s")
+
+    if instrumentation is not None and args.metrics_textfile:
+        instrumentation.write_textfile(args.metrics_textfile)
+
+
+def dispatch(jobs, args, inventory, fact_store, instrumentation, stop):
+    """Run queued jobs in batches until stop is set, refreshing the reference caches every refresh_interval."""
+    refreshed = time.monotonic()
+
+    while not stop.is_set():
+        batch = jobs.take(args.batch_size)
+
+        if time.monotonic() - refreshed > args.refresh_interval:
+            provisioner.refresh_caches()
+            refreshed = time.monotonic()
+
+        if batch:
+            run_batch(batch, args, inventory, fact_store, instrumentation)
+
+        jobs.prune(args.keep_jobs)
+
+
+class DaemonHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        data = json.dumps(body, default=str).encode()
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        jobs = self.server.jobs
+        path = self.path.rstrip('/')
+
+        if path == '/health':
+            return self.reply(200, {'jobs': jobs.counts(), 'queued': jobs.pending.qsize()})
+
+        if path == '/jobs':
+            return self.reply(200, jobs.snapshot())
+
+        if path.startswith('/jobs/') and path[len('/jobs/'):].isdigit():
+            job = jobs.get(int(path[len('/jobs/'):]))
+            return self.reply(200, asdict(job)) if job else self.reply(404, {'detail': 'Not found.'})
+
+        self.reply(404, {'detail': 'Not found.'})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        path = self.path.rstrip('/')
+
+        try:
+            payload = json.loads(body or b'{}')
+        except ValueError:
+            return self.reply(400, {'detail': 'Body is not JSON'})
+
+        if path == '/jobs':
+            return self.submit(payload.get('hostname'), payload.get('ip_address'), payload.get('node'), 'api')
+
+        if path == '/webhook':
+            return self.webhook(body, payload)
+
+        self.reply(404, {'detail': 'Not found.'})
+
+    def submit(self, hostname, ip_address, node, source):
+        if not hostname:
+            return self.reply(400, {'detail': 'hostname is required'})
+
+        ip_address = ip_address or device_ip({'name': hostname})
+
+        if ip_address is None:
+            return self.reply(400, {'detail': f"{hostname} does not resolve, give its ip_address"})
+
+        # Polled and webhook devices were seen staged already, a job from the API could name any device in NetBox
+        if source == 'api' and hostname not in self.server.inventory.devices(provisioner.nb, [hostname]):
+            return self.reply(422, {'detail': f"{hostname} is not a staged minios in NetBox"})
+
+        self.reply(202, asdict(self.server.jobs.submit(hostname, ip_address, node, source)))
+
+    def webhook(self, body, payload):
+        """Queue a device from a NetBox webhook when it is a staged minios, anything else is acknowledged and ignored."""
+        secret = self.server.webhook_secret
+
+        # NetBox signs the body with HMAC-SHA512 of the webhook's secret
+        if secret:
+            expected = hmac.new(secret.encode(), body, hashlib.sha512).hexdigest()
+            if not hmac.compare_digest(expected, self.headers.get('X-Hook-Signature', '')):
+                return self.reply(403, {'detail': 'Bad signature'})
+
+        device = payload.get('data') or {}
+        status = device.get('status')
+        status = status.get('value') if isinstance(status, dict) else status
+        role = device.get('role') or device.get('device_role') or {}
+
+        if payload.get('model') != 'device' or status != INVENTORY_FILTER['status'] or \
+                INVENTORY_FILTER['role'] not in (role.get('slug'), role.get('name')):
+            return self.reply(200, {'detail': 'Ignored, not a staged minios device'})
+
+        self.submit(device.get('name'), device_ip(device), None, 'webhook')
+
+
+class DaemonServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, jobs, inventory, webhook_secret=None):
+        super().__init__(address, DaemonHandler)
+        self.jobs = jobs
+        self.inventory = inventory
+        self.webhook_secret = webhook_secret
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Provision servers/minios into NetBox as a long running service")
+    parser.add_argument('--listen', default='127.0.0.1:8080', help="Address for the job API and webhook, host:port")
+    parser.add_argument('--workers', type=int, default=10, help="Hosts provisioned at the same time")
+    parser.add_argument('--batch-size', type=int, default=50, help="Most jobs provisioned together in one batch")
+    parser.add_argument('--netbox-workers', type=int, default=4, help="NetBox requests in flight at the same time")
+    parser.add_argument('--poll-interval', type=int, default=60, help="Seconds between polls for staged devices, 0 disables polling")
+    parser.add_argument('--retry-after', type=int, default=900, help="Seconds before a polled host that failed is tried again")
+    parser.add_argument('--refresh-interval', type=int, default=3600, help="Seconds between reloads of the reference caches")
+    parser.add_argument('--keep-jobs', type=int, default=86400, help="Seconds finished jobs stay in the job API")
+    parser.add_argument('--webhook-secret', default=os.getenv('PROVISION_WEBHOOK_SECRET'), help="Secret of the NetBox webhook")
+    parser.add_argument('--inventory-cache', default=os.getenv('NB_INVENTORY_CACHE', DEFAULT_CACHE),
+                        help="JSON snapshot of the NetBox devices jobs are checked against")
+    parser.add_argument('--inventory-ttl', type=int, default=0, help="Seconds a device in the snapshot is used without asking NetBox, 0 always asks")
+    parser.add_argument('--reconcile', action='store_true', help="Only write fields that differ from what NetBox already has")
+    parser.add_argument('--discover-nics', action='store_true', help="Record every NIC and bond, not only the default route interface")
+    parser.add_argument('--force', action='store_true', help="Provision hosts even when their facts match the last run")
+    parser.add_argument('--fact-store', default=os.getenv('NB_FACT_STORE'), help="Directory to record host facts in and replay them from")
+    parser.add_argument('--fact-ttl', type=int, default=86400, help="Seconds recorded facts are replayed for, 0 never expires")
+    parser.add_argument('--metrics-textfile', help="Prometheus textfile rewritten with the running totals after every batch")
+    parser.add_argument('--slow-call', type=float, help="Print every SSH command or API call that takes longer than this many seconds")
+
+    args = parser.parse_args(argv)
+    args.username = os.getenv('PROVISION_USERNAME')
+    args.password = os.getenv('PROVISION_PASSWORD')
+
+    if not args.username or not args.password:
+        parser.error("set PROVISION_USERNAME and PROVISION_PASSWORD")
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    # InitNornir normally registers the connection plugins, batches build their nornir directly
+    register_connections()
+
+    # Paid once: pooled session, TLS connections and the reference caches stay warm between jobs
+    provisioner.setup_netbox(args.netbox_workers, args.reconcile)
+    provisioner.references.prefetch()
+
+    fact_store = FactStore(args.fact_store, PROBES, ttl=args.fact_ttl) if args.fact_store else None
+
+    instrumentation = None
+    if args.metrics_textfile or args.slow_call is not None:
+        instrumentation = Instrumentation(slow_call=args.slow_call)
+
+    # Jobs from the API are only queued for staged minios devices, every batch is checked again before it runs
+    inventory = InventoryCache(args.inventory_cache, ttl=args.inventory_ttl)
+
+    jobs = JobQueue()
+    stop = threading.Event()
+
+    host, port = args.listen.rsplit(':', 1)
+    server = DaemonServer((host, int(port)), jobs, inventory, args.webhook_secret)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Job API listening on {args.listen}")
+
+    if args.poll_interval:
+        threading.Thread(target=poll_staged, args=(jobs, args.poll_interval, args.retry_after, stop), daemon=True).start()
+
+    try:
+        dispatch(jobs, args, inventory, fact_store, instrumentation, stop)
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        stop.set()
+        server.shutdown()
+
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,220 +4,424 @@ Script to update a server/minios details in NetBox.
 1. LLDP needs to be enabled on the host for this script to properly make the network connections.
 """
 import os
+import csv
 import sys
-import requests
-import pynetbox
+import time
+import argparse
 
-from netaddr import IPAddress
-from nornir import InitNornir
+from netaddr import IPNetwork, AddrFormatError
 from nornir.core.task import Task, Result
-from nornir_napalm.plugins.tasks import napalm_get
-from nornir_netmiko.tasks import netmiko_send_command
+from netbox_client import netbox_api
+from netbox_cache import SwitchInterfaceCache, ReferenceCache, IpamCache, filter_in
+from netbox_writes import WriteBuffer, InterfaceRef, field_differs
+from host_facts import PROBES, replay_facts, collect_facts, run_probe, send_command, facts_fingerprint, parse_lldp_neighbors, \
+    build_host_facts
+from fact_store import FactStore
+from instrumentation import Instrumentation
+from host_inventory import InventoryCache, DEFAULT_CACHE, register_connections, build_nornir
+from run_journal import RunJournal
+from inventory_sync import sync_inventory_items
 
-session = requests.Session()
-session.verify = '/etc/ssl/certs'
-
-nb = pynetbox.api(os.getenv('NB_URL'), os.getenv('NB_TOKEN'))
-nb.http_session = session
+# END Tentant Name
+tenant_name = 'HWE'
 
-nr = InitNornir(config_file="nornir_nb_provision.yaml")
+# END ROLE of device
+device_role_name = 'server'
 
-nr.inventory.defaults.username = sys.argv[1]
-nr.inventory.defaults.password = sys.argv[2]
-ip_address = sys.argv[3]
-hostname = sys.argv[4]
-node = sys.argv[5]
+# END STATUS of device
+device_status = 'active'
 
-node = ''
+# END Platform of device
+platform_type = 'linux'
 
 # Default to Node A if choice is not made
-if not node:
-    node = 'NODE-A'
+default_node = 'NODE-A'
+
+# NIC speed in Mb/s --> NetBox interface type, unknown speeds are recorded as 10G SFP+
+INTERFACE_TYPES = {
+    1000: '1000base-t',
+    10000: '10gbase-x-sfpp',
+    25000: '25gbase-x-sfp28',
+    40000: '40gbase-x-qsfpp',
+    50000: '50gbase-x-sfp56',
+    100000: '100gbase-x-qsfp28',
+    200000: '200gbase-x-qsfp56',
+}
+
+# Seconds after lldpd is enabled that connect_cables waits for neighbors, and its first and longest poll interval.
+# lldpd sends every 30 seconds by default, so a switch may take that long to show up
+LLDP_TIMEOUT = 60
+LLDP_POLL_START = 1
+LLDP_POLL_MAX = 8
+
+# Seconds before the first retry of a stage that failed on a host, doubled for every retry after it
+RETRY_DELAY = 5
+
+# Set by setup_netbox() so every task shares one session and the same per-run caches
+nb = None
+switch_interfaces = None
+references = None
+ipam = None
+writes = None
+
+
+def setup_netbox(netbox_workers, reconcile=False, url=None, token=None, verify='/etc/ssl/certs'):
+    """
+    Create the shared pynetbox api and per-run caches used by the tasks.
 
-# Code to get an IP onto the box so we can ssh via nornir
-nb_ips = nb.ipam.ip_addresses.filter(q=ip_address)
+    url and token default to NB_URL and NB_TOKEN
+    """
+    global nb, switch_interfaces, references, ipam, writes
 
-# Code returns a record set so we need to grab the IP object so we can run update on it
-for i in nb_ips:
-    nb_ip = i
+    # Pooled, retrying session that never has more than netbox_workers requests in flight
+    nb = netbox_api(url, token, verify=verify, pool_size=netbox_workers, max_requests=netbox_workers)
 
-# setup a dummy interface so nornir can ssh to the device without DNS
-dummy_int = nb.dcim.interfaces.create({'device': {'name': hostname}, 'name': 'eth0', 'type': '1000base-t'})
+    # Switch interfaces are looked up once per switch for the whole run
+    switch_interfaces = SwitchInterfaceCache(nb)
 
-# add IP address to system
-nb_ip.update({'assigned_object_type': 'dcim.interface', "assigned_object_id": dummy_int.id, "assigned_object": dummy_int.name, 'address': nb_ip.address})
+    # Roles, platforms, tenants etc are the same for every host, fetched once the first time a host needs them
+    references = ReferenceCache(nb)
 
-# END Tentant Name
-tenant_name = 'HWE'
+    # IPs are looked up per prefix by provision() and answered from memory, the IPs the writes create are added to it
+    ipam = IpamCache(nb)
 
-host = nr.inventory.hosts
+    # Interfaces, IPs, cables, power ports and device updates are queued by the tasks and sent in bulk
+    # reconcile compares each update with the current record and only sends what changed
+    writes = WriteBuffer(nb, reconcile=reconcile, ipam=ipam)
 
-# END ROLE of device
-device_role_name = 'server'
 
-# END STATUS of device
-device_status = 'active'
+def refresh_caches():
+    """Reload the reference tables and forget the switch interfaces, for long running processes that reuse setup_netbox()."""
+    references.prefetch()
+    switch_interfaces.clear()
+
+
+def load_fleet(path):
+    """
+    Read a fleet file, a CSV with hostname,ip_address,node columns.
+
+    node may be left empty to use the default node
+    """
+    with open(path, newline='') as fleet_file:
+        return {row['hostname']: {'ip_address': row['ip_address'], 'node': row.get('node') or default_node}
+                for row in csv.DictReader(fleet_file)}
+
+
+def find_host_ips(nr):
+    """
+    Look up the NetBox IP of every host with a few list queries, kept in host.data['nb_ip'] for prepare_host.
+
+    Returns {host: error} for the hosts whose IP is missing or not an address, provision() fails them
+    """
+    addresses, failed = {}, {}
+
+    for name, host in nr.inventory.hosts.items():
+        try:
+            addresses[name] = str(IPNetwork(host.data.get('ip_address')).ip)
+        except (AddrFormatError, TypeError, ValueError):
+            failed[name] = f"no valid IP address to look up in NetBox: {host.data.get('ip_address')!r}"
+
+    ipam.load(addresses.values())
+
+    for name, host in nr.inventory.hosts.items():
+        host.data['nb_ip'] = ipam.get(addresses[name]) if name in addresses else None
+
+    return failed
 
-# END Platform of device
-platform_type = 'linux'
 
+def recorded_nics(facts, discover=False):
+    """The NICs a run records, every physical NIC and bond with discover, otherwise the default route interface."""
+    if discover:
+        return facts.discovered_interfaces()
+
+    return [nic for nic in facts.interfaces if nic.name == facts.default_interface]
+
+
+def load_addresses(nr, discover=False, failed=()):
+    """
+    Load the NetBox IPs of every NIC and BMC address the hosts in nr report, per prefix where there are many.
+
+    Hosts that failed a stage, and so may have no facts, are left out
+    """
+    addresses = []
+
+    for name, host in nr.inventory.hosts.items():
+        if name in failed or 'facts' not in host.data:
+            continue
+
+        facts = host.data['facts']
+        addresses += [address for nic in recorded_nics(facts, discover) for address in nic.addresses]
+
+        if facts.bmc_ip and facts.bmc_prefix_length is not None:
+            addresses.append(f"{facts.bmc_ip}/{facts.bmc_prefix_length}")
+
+    ipam.load(addresses)
+
+
+def prepare_host(task: Task) -> Result:
+    """
+    Get the host IP onto a dummy interface so nornir can ssh to the device without DNS.
+
+    The dummy interface is kept in host.data and removed again by create_interface
+    """
+    ip_address = task.host.data['ip_address']
+    nb_ip = task.host.data['nb_ip']
+
+    if nb_ip is None:
+        return Result(host=task.host, failed=True, result=f"IP Address {ip_address} not found in NetBox")
+
+    # Hosts provisioned before already have the IP on one of their own interfaces
+    assigned = dict(nb_ip).get('assigned_object') or {}
+    if (assigned.get('device') or {}).get('name') == task.host.name:
+        return Result(host=task.host, result=f"{ip_address} already assigned to {assigned.get('name')}")
+
+    dummy_int = nb.dcim.interfaces.create({'device': {'name': task.host.name}, 'name': 'eth0', 'type': '1000base-t'})
+
+    # add IP address to system
+    nb_ip.update({'assigned_object_type': 'dcim.interface', "assigned_object_id": dummy_int.id, "assigned_object": dummy_int.name, 'address': nb_ip.address})
+
+    task.host.data['dummy_int'] = dummy_int
+
+    return Result(host=task.host, result=f"{ip_address} assigned to dummy interface {dummy_int.id}")
 
-# exit if no hosts found
-if len(host) < 1:
-    print("No Hosts Found!")
-    sys.exit(0)
-else:
-    print(host)
 
 def enable_lldp(task: Task) -> Result:
-  
-    device = nb.dcim.devices.get(name=task.host.name)
+
+    # Replayed hosts had LLDP enabled on the run that recorded their facts
+    if task.host.data.get('replayed'):
+        return Result(host=task.host, result="Facts replayed from the fact store, LLDP already enabled")
 
     # Try and enable LLDP for all hosts
-    lldp_enable = task.run(netmiko_send_command, command_string = "sudo systemctl --now enable lldpd")
+    lldp_enable = send_command(task, "sudo systemctl --now enable lldpd")
     print(lldp_enable.result)
+
+    # connect_cables waits for neighbors counting from here, the stages in between run while LLDP converges
+    task.host.data['lldp_enabled'] = time.monotonic()
     
     # Configure LLDP to use ifname instead of the default --> mac address 
-    lldp_ifname = task.run(netmiko_send_command, command_string = "sudo lldpcli configure lldp portidsubtype ifname") 
+    lldp_ifname = send_command(task, "sudo lldpcli configure lldp portidsubtype ifname")
     
     # Intel NIC's Hijack LLDP packets so we need to find the bus used
-    result = task.run(netmiko_send_command, command_string="sudo lspci | grep -i 'ethernet'")
-    nics = result[0].result.split("\n")[0]
-    
-    controller = nics.find('controller')
-    vendor = nics[controller:].split(" ")[1].lower()  # get first word after "controller:"
+    # collect_facts ran first, the NIC vendor and buses came with the other probes
+    facts = task.host.data['facts']
+    vendor = facts.nic_vendor or ''
     print(vendor)
-    
-    result = task.run(netmiko_send_command, command_string="lshw -class network -businfo")
-    bus_info = result[0].result
 
-    index = bus_info.find('pci@')                 # stores the index of a substring or char
-    interface = bus_info[index:].split("\n")      # returns the chars AFTER the seen char or substring
-    interface.pop()                               # WARNING: output may be incomplete or inaccurate 
-    
-    for i in interface:
-        interface_bus = (i.split()[0].replace("pci@0000:", ""))
-        interface_name = (i.split()[1].replace("pci@0000:", ""))
-        
+    for interface_bus, interface_name in facts.nic_buses:
         if 'intel' in vendor:
             # Stop Intel from Hijacking the LLDP Packets
             FU_INTEL = (f" echo lldp stop | sudo tee -a /sys/kernel/debug/i40e/0000:{interface_bus}/command > /dev/null")
         
-            task.run(netmiko_send_command, command_string = FU_INTEL)
+            send_command(task, FU_INTEL)
             print(FU_INTEL)
 
 
-def create_interface(task: Task) -> Result:
+def host_fingerprint(host, discover=False):
+    """Fingerprint of the host's facts and everything else the run writes for it."""
+    # A discovery run writes more than a normal one, so it only matches fingerprints stored by another discovery run
+    return facts_fingerprint(host.data['facts'], node=host.data.get('node'), tenant=tenant_name, role=device_role_name,
+                             status=device_status, platform=platform_type, **({'discover': True} if discover else {}))
+
+
+def device_drifted(device):
+    """True when the device's status, role or tenant is no longer what update_netbox sets them to."""
+    current = dict(device)
+
+    # NetBox 3.6 renamed device_role to role
+    role = current.get('role') or current.get('device_role')
+
+    return field_differs(current.get('status'), device_status) or field_differs(role, {'name': device_role_name}) or \
+        field_differs(current.get('tenant'), {'name': tenant_name})
+
+
+def check_fingerprint(task: Task, force=False, discover=False) -> Result:
     """
-    Create Interface, Add IP and Connect to host interface to switch interface.
+    Compare the host's facts with the fingerprint the last successful run stored on the device.
 
-    LLDP Needs to be enabled on the switch AND the host for the connection to be made
+    Matching hosts are marked unchanged and provision() leaves them out of the remaining stages, force runs them anyway.
+    The device is kept in host.data['device'], the NetBox stages after this one use it instead of fetching it again
     """
-    # Call the Device for the host since we are going to need device.id in order to apply the interface to it
     device = nb.dcim.devices.get(name=task.host.name)
+    fingerprint = host_fingerprint(task.host, discover)
 
-    route = task.run(task=netmiko_send_command, command_string="route -n | grep -m 1 0.0.0.0")
-    gateway = route[0].result.replace('0.0.0.0', "").strip().split(" ")[0]
-    int_name = route[0].result.replace('0.0.0.0', "").strip().split(" ")[-1]
-    
-    # Find IP Address and NetMask
-    ip_mask_info = task.run(netmiko_send_command, command_string=f"ifconfig -a {int_name} | grep inet")
-    ip_addy = ip_mask_info[0].result.split()[1]
-    netmask = ip_mask_info[0].result.split()[3]
+    task.host.data['device'] = device
+    task.host.data['device_id'] = device.id
+    task.host.data['fingerprint'] = fingerprint
 
-    # convert dotted netmask to proper format for NetBox
-    mask = IPAddress(netmask).netmask_bits()
+    # A host that needed the dummy interface is not fully provisioned, whatever its fingerprint says,
+    # nor is a device someone reset since, to staged/minios for a reinstall say
+    if not force and 'dummy_int' not in task.host.data and not device_drifted(device) and \
+            dict(device).get('custom_fields', {}).get('facts_fingerprint') == fingerprint:
+        task.host.data['unchanged'] = True
+        return Result(host=task.host, result="Facts match the last run, nothing to update")
 
-    # format IP for NetBox
-    nb_ip = str(ip_addy) + "/" + str(mask)
+    return Result(host=task.host, result=f"Facts changed since the last run, fingerprint {fingerprint}")
 
-    if not nb.ipam.ip_addresses.get(q=ip_addy, mask_length=mask):
-        try:
-            nb.ipam.ip_addresses.create({'address': nb_ip, 'status': 'reserved'})
-            print(f"ETH Address {nb_ip} added to NetBox")
-        except:
-            print(f"Error creating ETH address {nb_ip} in NetBox")
-    else:
-        print(f"ETH address: {nb_ip} already exists in NetBox")
 
-    # Find mac address
-    eth_mac_address = task.run(netmiko_send_command, command_string=f"ifconfig -a {int_name} | grep ether")
-    eth_mac = eth_mac_address[0].result.split()[1]
+def interface_type(nic):
+    """NetBox interface type for a NIC from its link speed, bonds are LAGs."""
+    if nic.kind == 'bond':
+        return 'lag'
 
-    # Find active interface speed
-    eth_speed = task.run(netmiko_send_command, command_string=f"ethtool {int_name} | grep Speed")
-    speed = eth_speed[0].result.split(":")[-1]
+    return INTERFACE_TYPES.get(nic.speed, '10gbase-x-sfpp')
 
-    # Define the various interface types based on the speed
-    if '25000' in speed:
-        int_type = '25gbase-x-sfp28'
 
-    elif '100000' in speed:
-        int_type = '100gbase-x-qsfp28'
+def create_interface(task: Task, discover=False) -> Result:
+    """
+    Create Interfaces and Add IPs, the cables to the switch are left to connect_cables.
 
-    else:
-        int_type = '10gbase-x-sfpp'
+    Only the interface with the default route is handled unless discover is set, then every physical NIC and bond is.
+    Existing interfaces and IPs are fetched with one query each, creates and updates go through the write buffer
+    """
+    # The device check_fingerprint fetched, we are going to need device.id in order to apply the interface to it
+    device = task.host.data['device']
 
-    eth_mtu_setting = task.run(netmiko_send_command, command_string=f"ifconfig -a {int_name} | grep mtu")
-    eth_mtu = eth_mtu_setting[0].result.split()[-1]
+    facts = task.host.data['facts']
 
-    interface = nb.dcim.interfaces.get(device=device.name, name=int_name)
+    nics = recorded_nics(facts, discover)
 
-    if interface is None:
-        try:
-            interface = nb.dcim.interfaces.create({'device': device.id, 'name': int_name, 'type': int_type, 'mac_address': eth_mac, 'mtu': eth_mtu})
-            print(f"{interface} has been created with InterfaceID:{interface.id}")
-        except:
-            print(f"Error creating {int_name} eth interface")
+    existing = {interface.name: interface for interface in nb.dcim.interfaces.filter(device_id=device.id)}
 
-    # Add IP Address to ETH interface
-    ip = nb.ipam.ip_addresses.filter(address=ip_addy)
+    # Interface name --> id, or the InterfaceRef standing in for it until the write buffer creates it
+    interface_ids = {}
 
-    for i in ip:
-        try:
-            i.update({'assigned_object_type': 'dcim.interface', "assigned_object_id": interface.id,
-                     "assigned_object": interface.name, 'address': i.address})
+    for nic in nics:
+        interface = existing.get(nic.name)
+        fields = {'type': interface_type(nic), 'mac_address': nic.mac_address, 'mtu': nic.mtu}
 
-            print(f"Successfully added {i.address} to interface {interface.name}")
-        except:
-            print("Error updating the eth IP Address")
+        if interface is None:
+            interface_ids[nic.name] = writes.create_interface(task.host.name, {'device': device.id, 'name': nic.name, **fields})
+            print(f"{nic.name} queued for creation on {device.name}")
+        else:
+            interface_ids[nic.name] = interface.id
+            writes.update_interface(task.host.name, interface, fields)
 
-        device.update({'primary_ip4': {'address': i.address}})
+    for nic in nics:
+        # Bond members point at their bond, set after the creates so the bond can be new as well
+        if nic.master in interface_ids:
+            lag = interface_ids[nic.master]
+            writes.update_interface(task.host.name, existing.get(nic.name) or interface_ids[nic.name],
+                                    {'lag': lag if isinstance(lag, InterfaceRef) else {'id': lag}})
 
-    # get LLDP Neighbor and port
-    lldp = task.run(netmiko_send_command, command_string="sudo lldpcli show neighbors")
+        # Add the IP Addresses to the interface, IPs NetBox does not have yet are created with the assignment
+        for address in nic.addresses:
+            if ipam.get(address):
+                print(f"ETH address: {address} already exists in NetBox")
+            ipam.assign(writes, task.host.name, address, interface_ids[nic.name], status='reserved')
 
-    lldp_mac = lldp[0].result.split("\n")[5].split()[-1].strip()
-    lldp_neighbor = lldp[0].result.split("\n")[6].split(":")[-1].strip()
-    lldp_port = lldp[0].result.split("\n")[12].split(": ")[-1].strip()
+    # connect_cables runs once LLDP has converged and cables these same interfaces
+    task.host.data['interfaces'] = existing
+    task.host.data['interface_ids'] = interface_ids
 
-    # Start the process of connecting to the correct port based of LLDP
-    if lldp_neighbor is None:
-        print("NO LLDP NEIGHBOR FOUND")
-        pass
+    if facts.ip_address:
+        writes.update_device(task.host.name, device, {'primary_ip4': {'address': f"{facts.ip_address}/{facts.prefix_length}"}})
 
-    else:
-        interfaces = nb.dcim.interfaces.all()
+    # remove dummy interface when no longer needed
+    dummy_int = task.host.data.pop('dummy_int', None)
+    if dummy_int is not None:
+        writes.delete_interface(task.host.name, dummy_int)
 
-        for i in interfaces:
-            if i.device.name == lldp_neighbor:
-                if lldp_port in i.name:
-                    print(f"{i.name} RouterID:{i.id} ")
-                    router_int_id = i.id
+    return Result(host=task.host, result=f"{len(nics)} interfaces queued for {device.name}")
+
+
+def lldp_converged(facts, discover=False, previous=None):
+    """
+    True once the host sees the neighbors connect_cables needs.
+
+    Without discover any neighbor will do. With discover every NIC with link needs one, or the neighbors seen
+    must have stopped changing since the previous poll, as some ports face devices that do not speak LLDP
+    """
+    seen = {neighbor.interface for neighbor in facts.lldp_neighbors}
+
+    if not discover:
+        return bool(seen)
+
+    linked = {nic.name for nic in facts.discovered_interfaces() if nic.physical and nic.speed}
+
+    return linked <= seen or (bool(seen) and seen == previous)
+
+
+def wait_for_lldp(task: Task, discover=False, timeout=LLDP_TIMEOUT):
+    """
+    Poll the host's neighbor table until LLDP has converged or timeout seconds have passed since lldpd was enabled.
+
+    The first poll is sent straight away, as the stages before this one have usually given LLDP time to converge.
+    After that the interval doubles from LLDP_POLL_START to LLDP_POLL_MAX, returns the number of polls sent
+    """
+    facts = task.host.data['facts']
+
+    # Replayed hosts can not be polled, their recorded neighbors are all there is
+    if task.host.data.get('replayed'):
+        return 0
+
+    deadline = task.host.data.get('lldp_enabled', time.monotonic()) + timeout
+    delay, previous, polls = LLDP_POLL_START, None, 0
+
+    while not lldp_converged(facts, discover, previous):
+        if polls:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, LLDP_POLL_MAX)
+
+        previous = {neighbor.interface for neighbor in facts.lldp_neighbors}
+        facts.lldp_neighbors = parse_lldp_neighbors(run_probe(task, 'lldp_neighbors', refresh=True))
+        polls += 1
+
+    return polls
+
+
+def connect_cables(task: Task, discover=False, store=None, timeout=LLDP_TIMEOUT) -> Result:
+    """
+    Connect the host interfaces to the switch interfaces once the host's LLDP neighbors have shown up.
+
+    Runs last so the other stages fill the time lldpd takes to hear from the switches, each host is cabled as soon
+    as its own neighbors are there. LLDP Needs to be enabled on the switch AND the host for the connection to be made
+    """
+    facts = task.host.data['facts']
+    polls = wait_for_lldp(task, discover, timeout)
+
+    # The neighbors changed after collect_facts, record them and the fingerprint they give
+    if polls:
+        task.host.data['fingerprint'] = host_fingerprint(task.host, discover)
+        if store and all(name in task.host.data['probes'] for name in PROBES):
+            store.save(task.host.name, task.host.data['probes'])
+
+    existing = task.host.data['interfaces']
+    interface_ids = task.host.data['interface_ids']
+    cables = 0
+
+    for name, interface_id in interface_ids.items():
+        # get LLDP Neighbor and port, only the default interface falls back to whatever neighbor the host sees
+        lldp = facts.lldp_neighbor(name, fallback=not discover)
+
+        # Start the process of connecting to the correct port based of LLDP
+        if lldp is None or lldp.system_name is None or lldp.port is None:
+            print(f"NO LLDP NEIGHBOR FOUND on {name}")
+            continue
+
+        # Only the neighbor switch's interfaces are fetched, and only once per switch
+        switch_int = switch_interfaces.get(lldp.system_name, lldp.port)
+        interface = existing.get(name)
+
+        if switch_int is None:
+            print(f"No interface matching {lldp.port} found on {lldp.system_name}")
+
+        # Interfaces carry their cable, so an existing one needs no extra lookup
+        elif interface is not None and dict(interface).get('cable'):
+            print(f"Connection already found on {name} ")
 
-        if not nb.dcim.cables.get(termination_a_type="dcim.interface", termination_b_type="dcim.interface", termination_a_id=interface.id, termination_b_id=router_int_id):
-            # Make the actual connection between the endpoints
-            try:
-                nb.dcim.cables.create(termination_a_type="dcim.interface", termination_b_type="dcim.interface",
-                                      termination_a_id=interface.id, termination_b_id=router_int_id)
-                print(f"{interface.id} successfully connected to {router_int_id}")
-            except:
-                print(f"Error making the network connection between endpoints {interface.id} {router_int_id} ")
         else:
-            print(f"Connections already found between {interface.id} and {router_int_id} ")
+            print(f"{switch_int.name} RouterID:{switch_int.id} ")
+
+            # Make the actual connection between the endpoints
+            writes.create_cable(task.host.name, interface_id, switch_int.id)
+            cables += 1
+
+    return Result(host=task.host, result=f"{cables} cables queued after {polls} LLDP polls")
 
-    # remove dummy interface when no longer needed
-    dummy_int.delete()
 
 def create_bmc_interface(task: Task) -> Result:
     """
@@ -225,87 +429,73 @@ def create_bmc_interface(task: Task) -> Result:
 
     Create the BMC Interface and add the mac address and IP Address
     """
-    device = nb.dcim.devices.get(name=task.host.name)
+    device = task.host.data['device']
 
-    bmc_ip_address = task.run(netmiko_send_command, command_string="sudo ipmitool lan print | grep 'IP Address'")
-    bmc_ip = bmc_ip_address[0].result.split("\n")[1].split(":")[1]
+    facts = task.host.data['facts']
 
-    bmc_subnet_mask = task.run(netmiko_send_command, command_string="sudo ipmitool lan print | grep 'Subnet Mask'")
-    bmc_netmask = bmc_subnet_mask[0].result.split("\n")[0].split(":")[1].strip()
+    bmc_ip = facts.bmc_ip
+    bmc_mask = facts.bmc_prefix_length
 
-    # convert dotted netmask to proper format for NetBox
-    bmc_mask = IPAddress(bmc_netmask).netmask_bits()
+    if not bmc_ip or bmc_mask is None:
+        return Result(host=task.host, failed=True, result="No BMC IP address reported by ipmitool lan print")
 
     # format IP for NetBox
     nb_bmc_ip = str(bmc_ip) + "/" + str(bmc_mask)
 
-    if not nb.ipam.ip_addresses.get(q=bmc_ip, mask_length=bmc_mask):
-        try:
-            nb.ipam.ip_addresses.create({'address': nb_bmc_ip, 'status': 'dhcp'})
-            print(f"BMC IP Address {nb_bmc_ip} added to NetBox")
-        except:
-            print(f"Error creating BMC {nb_bmc_ip} in NetBox")
-    else:
+    # Exact match on the address, NetBox may have it with another mask than the BMC reports
+    ip = ipam.get(bmc_ip)
+
+    if ip:
         print(f"BMC address: {nb_bmc_ip} already exists in NetBox")
 
-    bmc_mac_address = task.run(netmiko_send_command, command_string="sudo ipmitool lan print | grep 'MAC Address'")
-    bmc_mac = bmc_mac_address[0].result.split(" : ")[1]
+    bmc_mac = facts.bmc_mac
 
     bmc_interface = nb.dcim.interfaces.get(device=device.name, name='bmc')
 
     if bmc_interface is None:
-        try:
-            bmc_interface = nb.dcim.interfaces.create({'device': device.id, 'name': 'bmc', 'type': '1000base-t', 'mac_address': bmc_mac, 'mtu': '1500'})
-            print(f"{bmc_interface} has been created with InterfaceID: {bmc_interface.id}")
-        except:
-            print(f"Error creating {bmc_interface} interface")
+        bmc_interface_id = writes.create_interface(task.host.name, {'device': device.id, 'name': 'bmc', 'type': '1000base-t', 'mac_address': bmc_mac, 'mtu': '1500'})
+        print(f"bmc interface queued for creation on {device.name}")
+    else:
+        bmc_interface_id = bmc_interface.id
 
-    ip = nb.ipam.ip_addresses.get(q=bmc_ip, mask_length=24)
- 
-    try:
-        ip.update({'assigned_object_type': 'dcim.interface', "assigned_object_id": bmc_interface.id,
-                  "assigned_object": bmc_interface.name, 'address': ip.address})
-
-        print(f"Successfully added {ip.address} to interface {bmc_interface.name}")
-    except:
-        print(f"Error updating BMC {bmc_ip} on interface {bmc_interface.name}")
+    ipam.assign(writes, task.host.name, nb_bmc_ip, bmc_interface_id, status='dhcp')
 
 
 def custom_fields(task: Task) -> Result:
     """
     Send commands using netmiko to update all of the custom fields.
 
-    Some of this current info will be going into device inventory and may be removed from here to avoid data duplication
+    The hardware itself (CPUs, DIMMs, disks, NICs) is recorded as inventory items by sync_inventory
     """
-    device = nb.dcim.devices.get(name=task.host.name)
-    # get SKU
-    result = task.run(netmiko_send_command, command_string="sudo dmidecode -t1 | grep SKU")
-    sku = result[0].result.split(":")[-1]
+    device = task.host.data['device']
+    facts = task.host.data['facts']
 
-    # get_bmc_version
-    result = task.run(netmiko_send_command, command_string="sudo ipmitool mc info | grep Version")
-    bmc_ver = result[0].result.split(":")[-1]
+    sku = facts.sku
+    bmc_ver = facts.bmc_version
+    bmc_firm = facts.bmc_firmware
+    bios_ver = facts.bios_version
+    bios_rev = facts.bios_revision
 
-    # get_bmc_Firmware
-    result = task.run(netmiko_send_command, command_string="sudo ipmitool mc info | grep 'Firmware Revision'")
-    bmc_firm = result[0].result.split(":")[-1]
+    # Update all of the custom fields that were gathered above, sent with the other device updates for this host
+    writes.update_device(task.host.name, device, {"custom_fields": {'ebay_sku': sku, 'bios_revision': bios_rev, 'bios_version':
+                                                                    bios_ver, 'bmc_firmware': bmc_firm, 'bmc_version': bmc_ver}})
 
-    # get_bios_version
-    result = task.run(netmiko_send_command, command_string="sudo dmidecode -t0 | grep Version")
-    bios_ver = result[0].result.split(":")[-1]
 
-    # get bios_rev
-    result = task.run(netmiko_send_command, command_string="sudo dmidecode -t 0")
-    bios_rev = result[0].result.split("\n")[-2].split(":")[-1]
+def sync_inventory(task: Task) -> Result:
+    """
+    Make the device's inventory items match the CPUs, DIMMs, disks and NICs lshw reported.
 
-    try:
-        # Update all of the custom fields that were gathered above
-        custom_fields = device.update({"custom_fields": {'ebay_sku': sku, 'bios_revision': bios_rev, 'bios_version':
-                                                         bios_ver, 'bmc_firmware': bmc_firm, 'bmc_version': bmc_ver}})
+    Only the differences are queued, the write buffer sends them for the whole fleet in one bulk request per kind of change
+    """
+    device = task.host.data['device']
+    components = task.host.data['facts'].components
 
-        print(f"Successfully updated custom_fields for {device.name}")
-    except:
-        print(f"Not able to update custom_fields for {device.name}")
+    if not components:
+        return Result(host=task.host, result="No hardware reported by lshw, inventory items left as they are")
+
+    creates, updates, deletes = sync_inventory_items(nb, writes, task.host.name, device, components, references)
+
+    return Result(host=task.host, result=f"Inventory items queued for {device.name}: {creates} new, {updates} changed, {deletes} removed")
 
 
 def update_server(task: Task) -> Result:
@@ -315,27 +505,28 @@ def update_server(task: Task) -> Result:
     Create Manufacturer and Product if it does not already exist
     Update Manufacturer, Product, Serial, Asset_Tag, OS_Version
     """
-    if not nb.dcim.device_roles.get(name=device_role_name):
+    if not references.get('device_roles', device_role_name):
         print(f"Device Role: {device_role_name} is not valid, exiting!")
-        sys.exit()
+        return Result(host=task.host, failed=True, result=f"Device Role: {device_role_name} is not valid")
 
-    if not nb.dcim.devices.filter(value=device_status):
+    if not references.valid_status(device_status):
         print(f"Device Status: {device_status} is not valid, exiting!")
-        sys.exit()
+        return Result(host=task.host, failed=True, result=f"Device Status: {device_status} is not valid")
 
-    if not nb.dcim.platforms.get(name=platform_type):
+    if not references.get('platforms', platform_type):
         print(f"Platform Type: {platform_type} is not valid, exiting!")
-        sys.exit()
+        return Result(host=task.host, failed=True, result=f"Platform Type: {platform_type} is not valid")
 
-    if not nb.tenancy.tenants.get(name=tenant_name):
+    if not references.get('tenants', tenant_name):
         print(f"Tenant Name: {tenant_name} is not valid, exiting!")
-        sys.exit()
+        return Result(host=task.host, failed=True, result=f"Tenant Name: {tenant_name} is not valid")
 
-    # call a device object and then use that object to update a device
-    device = nb.dcim.devices.get(name=task.host.name)
+    # The device check_fingerprint fetched, the update is queued against it
+    device = task.host.data['device']
+
+    facts = task.host.data['facts']
 
-    system_manufacturer = task.run(netmiko_send_command, command_string="sudo dmidecode -s system-manufacturer")
-    manufacturer = system_manufacturer[0].result
+    manufacturer = facts.manufacturer
 
     if 'Dell' in manufacturer:
         manufacturer = 'Dell'
@@ -346,36 +537,28 @@ def update_server(task: Task) -> Result:
     slug_vendor = manufacturer.lower().replace(" ", "-")
 
     try:
-        if nb.dcim.manufacturers.get(name=manufacturer) is None:
-            nb.dcim.manufacturers.create(name=manufacturer, slug=slug_vendor)
+        references.ensure('manufacturers', manufacturer, {'name': manufacturer, 'slug': slug_vendor})
     except:
         print(f"Error Creating the manufacturer {manufacturer} in NetBox")
 
-    system_product_name = task.run(netmiko_send_command, command_string="sudo dmidecode -s system-product-name")
-    device_type = system_product_name[0].result
+    device_type = facts.product_name
 
     slug_name = device_type.lower().replace(" ", "-")
 
     # All devices provisioned through this script should be a child (server) that will go into a parent (chassis)
     try:
-        if nb.dcim.device_types.get(model=device_type) is None:
-            nb.dcim.device_types.create(model=device_type, slug=slug_name, manufacturer={'name': manufacturer}, u_height=0, subdevice_role='child')
+        references.ensure('device_types', device_type, {'model': device_type, 'slug': slug_name, 'manufacturer': {'name': manufacturer},
+                                                        'u_height': 0, 'subdevice_role': 'child'})
     except:
-        print(f"Error Creating {device_types} in NetBox")
+        print(f"Error Creating {device_type} in NetBox")
 
-    system_serial_number = task.run(netmiko_send_command, command_string="sudo dmidecode -s system-serial-number")
-    serial = system_serial_number[0].result
-
-    chassis_serial_number = task.run(netmiko_send_command, command_string="sudo dmidecode -s chassis-serial-number")
-    chassis_serial = chassis_serial_number[0].result
+    serial = facts.serial
 
     # This should always be a child
-    baseboard_asset_tag = task.run(netmiko_send_command, command_string="sudo dmidecode -s baseboard-asset-tag")
-    baseboard_asset = baseboard_asset_tag[0].result
+    baseboard_asset = facts.baseboard_asset_tag or ''
 
     # This should alyways be a parent --> 1RU systems do not have a parent
-    chassis_asset_tag = task.run(netmiko_send_command, command_string="sudo dmidecode -s  chassis-asset-tag")
-    chassis_asset = chassis_asset_tag[0].result
+    chassis_asset = facts.chassis_asset_tag or ''
 
     if baseboard_asset.isdigit():
         asset = baseboard_asset
@@ -387,98 +570,459 @@ def update_server(task: Task) -> Result:
         asset = None
         print(f" Asset Tags are invalid, setting to None --> Baseboard:{baseboard_asset}  Chassis:{chassis_asset} ")
 
-    child = nb.dcim.devices.get(name=device.name)
-
-    # There is no child.parent_device at this point, we still have to set it
-    parent = nb.dcim.devices.get(serial=chassis_serial)
-    
-    if parent:
-        if node is not None:
-            bay = nb.dcim.device_bays.get(device_id=parent.id, name=node)
+    # The parent chassis was looked up once for every host in it by plan_chassis(), which also fills the bays
+    parent = task.host.data.get('parent')
 
-            if bay.installed_device is not None:
-                print(f"Error installing {child} into {parent}, Found existing device: {bay.installed_device}")
+    if not parent:
+        print("No Parent Found to slot Node into, you will have to do this manually!")
 
-            if bay.installed_device is None:
-                bay.installed_device = child
-                if bay.save():
-                    print(f"successfully installed: {child} into: {parent} Slot: {node}")
-    else: 
-        print ("No Parent Found to slot Node into, you will have to do this manually!")
-    
-    release = task.run(netmiko_send_command, command_string="cat /etc/*release* | grep PRETTY_NAME")
-    os_ver = release[0].result.split("=")[-1].replace("(Core)", "").strip('"').strip()
+    os_ver = facts.os_version
 
     slug_os_name = os_ver.lower().replace(".", "-").replace(" ", "-")
 
     try:
-        if not nb.extras.tags.get(name=os_ver):
-            nb.extras.tags.create({'name': os_ver, 'slug': slug_os_name, 'color': '808080'})
+        references.ensure('tags', os_ver, {'name': os_ver, 'slug': slug_os_name, 'color': '808080'})
     except:
         print(f" Could not create the tag for{os_ver} {slug_os_name}")
 
-    try:
-        if parent:
-            device.update({'name': device.name, 'device_role': {'name': device_role_name}, 'device_type': {'model': device_type},
-                           'status': device_status, 'site': {'name': parent.site.name}, 'rack_name': parent.rack,
-                           'serial': serial, 'asset_tag': asset, 'platform': {'name': platform_type},
-                           'tenant': {'name': tenant_name}, 'tags': [{'name': os_ver}]})
-        else: 
-            device.update({'name': device.name, 'device_role': {'name': device_role_name}, 'device_type': {'model': device_type},
-                           'status': device_status, 'site': {'name': "1103 Platform Engineering Lab"},
-                           'serial': serial, 'asset_tag': asset, 'platform': {'name': platform_type},
-                           'tenant': {'name': tenant_name}, 'tags': [{'name': os_ver}]})
-            
-        print(f"Successfully updated Server Info for: {device.name}")
+    server_info = {'name': device.name, 'device_role': {'name': device_role_name}, 'device_type': {'model': device_type},
+                   'status': device_status, 'site': {'name': "1103 Platform Engineering Lab"},
+                   'serial': serial, 'asset_tag': asset, 'platform': {'name': platform_type},
+                   'tenant': {'name': tenant_name}, 'tags': [{'name': os_ver}]}
+
+    # Children take the site and rack of the chassis they are installed in
+    if parent:
+        server_info['site'] = {'name': parent.site.name}
+        server_info['rack'] = {'id': parent.rack.id} if parent.rack else None
+
+    writes.update_device(task.host.name, device, server_info)
 
-    except:
-        print(f"Error updating the device info {device.name} {device_type} {asset} {parent.rack}")
-        
     if not parent:
         print("No parent defined, so no power can be added, Exiting!")
-        sys.exit(0)
-        
-    result = task.run(netmiko_send_command, command_string="sudo dmidecode -t39 | grep 'Power Capacity'")
-    max_power = result[0].result.split(":")[-1].strip('W').strip()
-    
-    if not max_power.isdigit():
-        print("No Power found")
-        sys.exit(0)
-    
-    if not nb.dcim.power_ports.filter(device=parent.name):
-        try: 
-            primary_power = nb.dcim.power_ports.create({"device": parent.id, "name": "Primary Power Supply"})
-            backup_power = nb.dcim.power_ports.create({"device": parent.id, "name": "Backup Power Supply"})
-        except: 
-            print(f"failed to create the power ports on {parent.name}")
-    
-    primary_power = nb.dcim.power_ports.get(q='Primary Power Supply', device=parent.name)
-    
-    if primary_power:
-        primary = nb.dcim.power_ports.get(id=primary_power.id)
-         
-        if primary.maximum_draw is None:
-            allocated_power = int(max_power) / 4
-            primary.update({'maximum_draw': max_power, 'allocated_draw': allocated_power})
-            print(f"Primary power supply updated with max power: {max_power}  allocated power: {allocated_power}") 
+        return Result(host=task.host, result="No parent defined, power not added")
+
+    return Result(host=task.host, result=f"{device.name} queued for update in {parent.name}")
+
+
+def install_children(parent, bays, children):
+    """
+    Queue each child into the bay named by its node, in one pass over the chassis.
+
+    Bays taken by another device, or claimed twice in this run, are reported instead of overwritten
+    """
+    claimed = {}
+
+    for host in children:
+        node = host.data.get('node', default_node)
+        bay = bays.get(node)
+        device_id = host.data['device_id']
+
+        if bay is None:
+            print(f"{parent.name} has no bay {node} for {host.name}")
+
+        elif bay.installed_device is not None and bay.installed_device.id != device_id:
+            print(f"Error installing {host.name} into {parent.name}, Found existing device: {bay.installed_device}")
+
+        elif node in claimed:
+            print(f"Error installing {host.name} into {parent.name}, {node} is also given for {claimed[node]}")
+
         else:
-            print(f"Primary Power already defined Max:{primary.maximum_draw} Allocated: {primary.allocated_draw}")
-    
-    backup_power = nb.dcim.power_ports.get(q='Backup Power Supply', device= parent.name)
-    
-    if backup_power:     
-        backup = nb.dcim.power_ports.get(id=backup_power.id)
-            
-        if backup.maximum_draw is None:
-            backup.update({'maximum_draw': max_power, 'allocated_draw': allocated_power})
-            print(f"Backup power supply updated with max power: {max_power} allocated power: {allocated_power}")
+            claimed[node] = host.name
+            if bay.installed_device is None:
+                writes.install_device(host.name, bay, device_id)
+                print(f"{host.name} queued for install into: {parent.name} Slot: {node}")
+
+    return claimed
+
+
+def allocate_power(parent, ports, bays, children, claimed):
+    """
+    Set the chassis power ports from what its children report.
+
+    Every bay gets an equal share of the supply, the allocated draw is that share times the bays in use after this run
+    """
+    capacities = [host.data['facts'].max_power for host in children if host.data['facts'].max_power is not None]
+
+    if not capacities:
+        print(f"No Power found for {parent.name}")
+        return
+
+    max_power = max(capacities)
+    share = max_power // (len(bays) or 4)
+    occupied = {name for name, bay in bays.items() if bay.installed_device is not None} | set(claimed)
+    allocated_power = share * len(occupied)
+
+    # Writes for the chassis are reported against its first child
+    host = children[0].name
+
+    for name in ('Primary Power Supply', 'Backup Power Supply'):
+        port = ports.get(name)
+
+        if port is None:
+            writes.create_power_port(host, {'device': parent.id, 'name': name, 'maximum_draw': max_power, 'allocated_draw': allocated_power})
+            print(f"{name} queued on {parent.name} with max power: {max_power} allocated power: {allocated_power}")
+
+        elif port.maximum_draw is None or port.allocated_draw != allocated_power:
+            writes.update_power_port(host, port, {'maximum_draw': port.maximum_draw or max_power, 'allocated_draw': allocated_power})
+            print(f"{name} on {parent.name} queued for update with allocated power: {allocated_power}")
+
         else:
-            print(f"Backup Power already defined Max:{backup.maximum_draw} Allocated: {backup.allocated_draw}")
+            print(f"{name} already defined Max:{port.maximum_draw} Allocated: {port.allocated_draw}")
+
+
+def plan_chassis(nr, failed=()):
+    """
+    Group the hosts by chassis serial and resolve parents, device bays and power ports once per chassis.
+
+    Three list queries cover the whole fleet. Each host gets its parent in host.data['parent'] for update_server,
+    bay installs and power for every chassis are queued in one pass so nodes sharing a chassis do not race
+    """
+    chassis = {}
+
+    for name, host in nr.inventory.hosts.items():
+        serial = host.data['facts'].chassis_serial if 'facts' in host.data else None
+
+        if name not in failed and serial:
+            chassis.setdefault(serial, []).append(host)
+
+    parents = {parent.serial: parent for parent in filter_in(nb.dcim.devices, 'serial', chassis)}
+
+    bays, ports = {}, {}
+    for bay in filter_in(nb.dcim.device_bays, 'device_id', [parent.id for parent in parents.values()]):
+        bays.setdefault(bay.device.id, {})[bay.name] = bay
+    for port in filter_in(nb.dcim.power_ports, 'device_id', [parent.id for parent in parents.values()]):
+        ports.setdefault(port.device.id, {})[port.name] = port
+
+    for serial, children in chassis.items():
+        parent = parents.get(serial)
+
+        for host in children:
+            host.data['parent'] = parent
+
+        if parent is None:
+            continue
+
+        claimed = install_children(parent, bays.get(parent.id, {}), children)
+        allocate_power(parent, ports.get(parent.id, {}), bays.get(parent.id, {}), children, claimed)
+
+
+# Order the tasks run in, every host finishes a stage before the next one starts
+# Facts come first so enable_lldp knows the NICs without probing again. connect_cables is last, it polls the neighbors
+# again and the NetBox stages before it run while LLDP converges on the hosts
+STAGES = [prepare_host, replay_facts, collect_facts, enable_lldp, check_fingerprint, create_interface, create_bmc_interface,
+          custom_fields, sync_inventory, update_server, connect_cables]
+
+# Stages that change or probe the host, a resumed run skips them where the journal has them done.
+# The other stages only queue writes, they are done once the flush went through and run again until it has
+HOST_STAGES = (prepare_host, collect_facts, enable_lldp)
+
+# Stages retried when they fail on a host, SSH to a host that is still coming up often fails the first time.
+# NetBox calls are already retried by the client
+RETRIED_STAGES = (collect_facts, enable_lldp)
+
+
+def run_stage(nr, stage, options, retries=0, retry_delay=RETRY_DELAY):
+    """
+    Run a stage on the hosts in nr, hosts that fail a RETRIED_STAGES stage are run again up to retries times.
+
+    Returns ({host: error}, {host: attempts}) for the hosts the stage ran on
+    """
+    # A resumed run can have every host past a stage already
+    if not nr.inventory.hosts:
+        return {}, {}
+
+    result = nr.run(task=stage, **options)
+    attempts = {name: 1 for name in result}
+    failures = {name: result[name].result for name in result.failed_hosts}
+
+    for retry in range(retries if stage in RETRIED_STAGES else 0):
+        if not failures:
+            break
+
+        delay = retry_delay * 2 ** retry
+        print(f"Retrying {stage.__name__} on {len(failures)} hosts in {delay}s")
+        time.sleep(delay)
+
+        for name in failures:
+            nr.data.recover_host(name)
+            attempts[name] += 1
+
+        result = nr.filter(filter_func=lambda h, names=set(failures): h.name in names).run(task=stage, **options)
+        failures = {name: result[name].result for name in result.failed_hosts}
+
+    return failures, attempts
+
+
+def resume_hosts(nr, journal):
+    """Leave out the hosts the journal has complete and restore what their finished host stages left in host.data."""
+    complete = [name for name in nr.inventory.hosts if journal.complete(name)]
+    if complete:
+        print(f"{len(complete)} hosts completed in an earlier run, skipping them")
+
+    nr = nr.filter(filter_func=lambda h: h.name not in complete)
+
+    for name, host in nr.inventory.hosts.items():
+        dummy_id = journal.created(name).get('dummy_int')
+
+        # None when the earlier run got as far as deleting it
+        if journal.done(name, prepare_host.__name__) and dummy_id:
+            dummy_int = nb.dcim.interfaces.get(dummy_id)
+            if dummy_int is not None:
+                host.data['dummy_int'] = dummy_int
+
+        probes = journal.probes(name)
+        if journal.done(name, collect_facts.__name__) and probes:
+            host.data['probes'] = probes
+            host.data['facts'] = build_host_facts(probes)
+
+    return nr
+
+
+def journal_stage(journal, nr, stage, failures, attempts):
+    """Record a stage's outcome per host, with the probes and dummy interface the host stages produced."""
+    for name, count in attempts.items():
+        host = nr.inventory.hosts[name]
+
+        if name in failures:
+            journal.record(name, stage.__name__, 'failed', str(failures[name]), count)
+            continue
+
+        journal.record(name, stage.__name__, 'done' if stage in HOST_STAGES else 'queued', attempts=count)
+
+        if stage is prepare_host and 'dummy_int' in host.data:
+            journal.save_created(name, {'dummy_int': host.data['dummy_int'].id})
+
+        if stage is collect_facts:
+            journal.save_probes(name, host.data['probes'])
+
+
+def flush_writes(nr, failed):
+    """
+    Send the queued writes, then store the new fingerprint on every host that went through without errors.
+
+    The fingerprints go out last and as one bulk update, a host that failed is compared again on the next run
+    """
+    report = writes.flush()
+
+    fingerprints = [{'id': host.data['device_id'], 'custom_fields': {'facts_fingerprint': host.data['fingerprint']}}
+                    for name, host in nr.inventory.hosts.items()
+                    if 'fingerprint' in host.data and name not in failed and not report.get(name, {}).get('errors')]
+
+    if fingerprints:
+        try:
+            nb.dcim.devices.update(fingerprints)
+        except Exception as error:
+            print(f"Could not store the facts fingerprints, is the facts_fingerprint custom field defined? {error}")
+
+    # Hosts that failed a stage are reported with the error even when they queued no writes
+    for name, error in failed.items():
+        report.setdefault(name, {'created': 0, 'updated': 0, 'deleted': 0, 'avoided': 0, 'errors': [], 'ids': {}})['errors'].append(error)
+
+    return report
+
+
+def provision(nr, fact_store=None, instrumentation=None, force=False, discover=False, lldp_timeout=LLDP_TIMEOUT,
+              journal=None, retries=0, retry_delay=RETRY_DELAY):
+    """
+    Run every stage on the hosts in nr and flush the queued NetBox writes.
+
+    setup_netbox() must have been called first, returns the write report per host.
+    Hosts whose facts match the fingerprint from their last run are skipped unless force is set.
+    discover records every NIC and bond instead of only the default route interface.
+    lldp_timeout is how long a host's cables wait for its LLDP neighbors after lldpd is enabled.
+    With an Instrumentation every stage, SSH command and API call is timed.
+    With a RunJournal every stage is recorded, and hosts or host stages it already has done are skipped.
+    retries and retry_delay apply to RETRIED_STAGES
+    """
+    # Stages that record or replay facts need the store, the rest only take the task
+    stage_options = {replay_facts: {'store': fact_store}, collect_facts: {'store': fact_store},
+                     check_fingerprint: {'force': force, 'discover': discover}, create_interface: {'discover': discover},
+                     connect_cables: {'discover': discover, 'store': fact_store, 'timeout': lldp_timeout}}
+    failed = {}
+
+    if instrumentation is not None:
+        nr = nr.with_processors([instrumentation])
+        instrumentation.attach(nb.http_session)
+
+    if journal is not None:
+        nr = resume_hosts(nr, journal)
+        hosts = list(nr.inventory.hosts)
+
+        if not hosts:
+            return {}
+
+    # IPs are looked up again for every run, claims only hold within one batch
+    ipam.clear()
+
+    # One lookup for the whole fleet instead of one per host before the first SSH connection
+    for name, error in find_host_ips(nr).items():
+        print(f"{name} failed: {error}")
+        failed[name] = f"failed: {error}"
+
+        # Nornir leaves failed hosts out of every stage
+        nr.data.failed_hosts.add(name)
+
+    for stage in STAGES:
+        targets = nr
+        if journal is not None and stage in HOST_STAGES:
+            targets = nr.filter(filter_func=lambda h: not journal.done(h.name, stage.__name__))
+
+        failures, attempts = run_stage(targets, stage, stage_options.get(stage, {}), retries, retry_delay)
+
+        # Nornir skips hosts that failed an earlier stage, the rest of the fleet keeps going
+        for name, error in failures.items():
+            print(f"{name} failed {stage.__name__}: {error}")
+            failed[name] = f"failed {stage.__name__}: {error}"
+
+        if journal is not None:
+            journal_stage(journal, targets, stage, failures, attempts)
+
+        # Unchanged hosts are done, the NetBox stages only run for the rest
+        if stage is check_fingerprint:
+            unchanged = [name for name, host in nr.inventory.hosts.items() if host.data.get('unchanged')]
+            if unchanged:
+                print(f"{len(unchanged)} hosts unchanged since their last run, skipping them")
+            nr = nr.filter(filter_func=lambda h: not h.data.get('unchanged'))
+
+            if not nr.inventory.hosts:
+                break
+
+            # Parents, bays and power are worked out per chassis before update_server needs them
+            plan_chassis(nr, failed)
+
+            # Every address the interface stages assign, a few list queries for the whole fleet
+            load_addresses(nr, discover, failed)
+
+    # Everything the tasks queued goes out here as one bulk request per object type
+    if instrumentation is None:
+        report = flush_writes(nr, failed)
+    else:
+        with instrumentation.stage('flush'):
+            report = flush_writes(nr, failed)
+
+    # A host is complete once its writes went through, the stages that queued them are done with it
+    if journal is not None:
+        queued = [stage.__name__ for stage in STAGES if stage not in HOST_STAGES]
+
+        for name in hosts:
+            journal.save_created(name, report.get(name, {}).get('ids', {}))
+            journal.finish(name, queued, "; ".join(report.get(name, {}).get('errors', [])) or None)
+
+    return report
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Provision servers/minios into NetBox")
+    parser.add_argument('username')
+    parser.add_argument('password')
+    parser.add_argument('ip_address', nargs='?', help="IP used to reach a single host")
+    parser.add_argument('hostname', nargs='?', help="NetBox name of a single host")
+    parser.add_argument('node', nargs='?', default=default_node, help="Device bay to install a single host into")
+    parser.add_argument('--fleet', help="CSV of hostname,ip_address,node to provision together")
+    parser.add_argument('--ssh-workers', type=int, default=10, help="Hosts worked on at the same time")
+    parser.add_argument('--netbox-workers', type=int, default=4, help="NetBox requests in flight at the same time")
+    parser.add_argument('--reconcile', action='store_true', help="Only write fields that differ from what NetBox already has")
+    parser.add_argument('--fact-store', default=os.getenv('NB_FACT_STORE'), help="Directory to record host facts in and replay them from")
+    parser.add_argument('--fact-ttl', type=int, default=86400, help="Seconds recorded facts are replayed for, 0 never expires")
+    parser.add_argument('--refresh-facts', action='store_true', help="Drop the recorded facts for these hosts and collect them again")
+    parser.add_argument('--discover-nics', action='store_true', help="Record every NIC and bond, not only the default route interface")
+    parser.add_argument('--lldp-timeout', type=int, default=LLDP_TIMEOUT, help="Seconds to wait for a host's LLDP neighbors before cabling without them")
+    parser.add_argument('--force', action='store_true', help="Provision hosts even when their facts match the last run")
+    parser.add_argument('--journal', default=os.getenv('NB_JOURNAL'), help="SQLite file to record every host's stages in, for --resume")
+    parser.add_argument('--resume', action='store_true', help="Carry on from the journal, only hosts and stages that did not finish are run")
+    parser.add_argument('--retries', type=int, default=2, help="Times a host is retried when enabling LLDP or collecting facts fails")
+    parser.add_argument('--retry-delay', type=float, default=RETRY_DELAY, help="Seconds before the first retry, doubled for every retry after it")
+    parser.add_argument('--metrics-json', help="Write per task, host and call timings to this JSON file")
+    parser.add_argument('--metrics-textfile', help="Write task and call timings to this Prometheus textfile")
+    parser.add_argument('--inventory-cache', default=os.getenv('NB_INVENTORY_CACHE', DEFAULT_CACHE),
+                        help="JSON snapshot of the NetBox devices looked up, reused by later runs")
+    parser.add_argument('--inventory-ttl', type=int, default=3600, help="Seconds a device in the snapshot is used without asking NetBox, 0 always asks")
+    parser.add_argument('--slow-call', type=float, help="Print every SSH command or API call that takes longer than this many seconds")
+
+    args = parser.parse_args(argv)
+
+    if not args.fleet and not args.hostname:
+        parser.error("either ip_address and hostname or --fleet is required")
+
+    if args.resume and not args.journal:
+        parser.error("--resume needs --journal")
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.fleet:
+        fleet = load_fleet(args.fleet)
+    else:
+        fleet = {args.hostname: {'ip_address': args.ip_address, 'node': args.node or default_node}}
+
+    setup_netbox(args.netbox_workers, args.reconcile)
+
+    # Only the hosts asked for are looked up, each one carries its own IP and node instead of sharing globals.
+    # Whatever their status, a rerun on a host that is already active is how its changes get into NetBox
+    inventory = InventoryCache(args.inventory_cache, ttl=args.inventory_ttl)
+    devices = inventory.devices(nb, fleet, match={})
+
+    for name in fleet:
+        if name not in devices:
+            print(f"{name} is not a device in NetBox, skipping")
+
+    register_connections()
+    nr = build_nornir(fleet, devices, args.ssh_workers, args.username, args.password)
+
+    host = nr.inventory.hosts
+
+    # exit if no hosts found
+    if len(host) < 1:
+        print("No Hosts Found!")
+        sys.exit(0)
+    else:
+        print(host)
+
+    fact_store = None
+    if args.fact_store:
+        fact_store = FactStore(args.fact_store, PROBES, ttl=args.fact_ttl)
+
+        if args.refresh_facts:
+            for name in host:
+                fact_store.invalidate(name)
+
+    instrumentation = None
+    if args.metrics_json or args.metrics_textfile or args.slow_call is not None:
+        instrumentation = Instrumentation(slow_call=args.slow_call)
+
+    journal = None
+    if args.journal:
+        journal = RunJournal(args.journal)
+
+        # A new run starts these hosts from the beginning, --resume carries on from what the journal has
+        if not args.resume:
+            journal.reset(host)
+
+    reports = provision(nr, fact_store, instrumentation, args.force, args.discover_nics, args.lldp_timeout,
+                        journal, args.retries, args.retry_delay)
+
+    if journal is not None:
+        print(f"Journal {args.journal}: " + ", ".join(f"{count} stages {status}" for status, count in journal.summary().items()))
+        journal.close()
+
+    # Provisioned hosts changed in NetBox, the next run looks them up again
+    inventory.forget([name for name, report in reports.items() if not report['errors']])
+
+    for name, report in reports.items():
+        print(f"{name}: created {report['created']} updated {report['updated']} deleted {report['deleted']} "
+              f"unchanged writes skipped {report['avoided']}")
+        for error in report['errors']:
+            print(f"{name}: {error}")
+
+    if args.metrics_json:
+        instrumentation.write_json(args.metrics_json)
+
+    if args.metrics_textfile:
+        instrumentation.write_textfile(args.metrics_textfile)
 
 
 if __name__ == "__main__":
-    nr.run(task=enable_lldp)
-    nr.run(task=create_interface)
-    nr.run(task=create_bmc_interface)
-    nr.run(task=custom_fields)
-    nr.run(task=update_server)
+    main()
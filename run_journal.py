@@ -0,0 +1,125 @@
+"""
+Local SQLite journal of a provision run, so a run that stopped part way can be resumed.
+
+1. Every stage a host goes through is recorded with its status, attempts and error
+2. The probe output collected from each host and the NetBox ids created for it are kept with the host
+3. A host is complete once its writes were flushed without errors, --resume leaves complete hosts out and skips the
+   stages that talk to the host (dummy interface, LLDP, probes) where they already succeeded
+"""
+import json
+import time
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    host TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (host, stage)
+);
+CREATE TABLE IF NOT EXISTS hosts (
+    host TEXT PRIMARY KEY,
+    complete INTEGER NOT NULL DEFAULT 0,
+    probes TEXT,
+    created TEXT NOT NULL DEFAULT '{}',
+    updated REAL NOT NULL
+);
+"""
+
+
+class RunJournal:
+    """
+    Journal at path, created on first use.
+
+    Only used from the thread that opened it, provision() records results between stages and not from the workers
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def reset(self, hosts):
+        """Forget everything recorded for hosts, for a run that starts from the beginning."""
+        hosts = [(host,) for host in hosts]
+
+        with self.db:
+            self.db.executemany("DELETE FROM stages WHERE host = ?", hosts)
+            self.db.executemany("DELETE FROM hosts WHERE host = ?", hosts)
+
+    def host(self, host):
+        """Make sure host has a row, the other host updates only change columns."""
+        self.db.execute("INSERT OR IGNORE INTO hosts (host, updated) VALUES (?, ?)", (host, time.time()))
+
+    def record(self, host, stage, status, error=None, attempts=1):
+        """Record how a stage went for host, attempts are added to the ones from earlier runs."""
+        with self.db:
+            self.host(host)
+            self.db.execute("""
+                INSERT INTO stages (host, stage, status, attempts, error, updated) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (host, stage) DO UPDATE SET status = excluded.status, attempts = attempts + excluded.attempts,
+                                                        error = excluded.error, updated = excluded.updated
+            """, (host, stage, status, attempts, error, time.time()))
+
+    def status(self, host, stage):
+        row = self.db.execute("SELECT status FROM stages WHERE host = ? AND stage = ?", (host, stage)).fetchone()
+
+        return row[0] if row else 'pending'
+
+    def done(self, host, stage):
+        return self.status(host, stage) == 'done'
+
+    def finish(self, host, stages, error=None):
+        """
+        Settle the stages whose writes were just flushed.
+
+        Without an error they are done and the host is complete, otherwise they are failed and run again on resume
+        """
+        with self.db:
+            self.host(host)
+            self.db.executemany("UPDATE stages SET status = ?, error = ?, updated = ? WHERE host = ? AND stage = ? AND status = 'queued'",
+                                [('failed' if error else 'done', error, time.time(), host, stage) for stage in stages])
+            self.db.execute("UPDATE hosts SET complete = ?, updated = ? WHERE host = ?", (int(error is None), time.time(), host))
+
+    def complete(self, host):
+        row = self.db.execute("SELECT complete FROM hosts WHERE host = ?", (host,)).fetchone()
+
+        return bool(row and row[0])
+
+    def save_probes(self, host, probes):
+        with self.db:
+            self.host(host)
+            self.db.execute("UPDATE hosts SET probes = ?, updated = ? WHERE host = ?", (json.dumps(probes), time.time(), host))
+
+    def probes(self, host):
+        row = self.db.execute("SELECT probes FROM hosts WHERE host = ?", (host,)).fetchone()
+
+        return json.loads(row[0]) if row and row[0] else None
+
+    def save_created(self, host, ids):
+        """Merge {kind: id or [ids]} into the NetBox ids recorded as created for host."""
+        with self.db:
+            self.host(host)
+            created = self.created(host)
+
+            for kind, value in ids.items():
+                if isinstance(value, list):
+                    created[kind] = created.get(kind, []) + value
+                else:
+                    created[kind] = value
+
+            self.db.execute("UPDATE hosts SET created = ?, updated = ? WHERE host = ?", (json.dumps(created), time.time(), host))
+
+    def created(self, host):
+        row = self.db.execute("SELECT created FROM hosts WHERE host = ?", (host,)).fetchone()
+
+        return json.loads(row[0]) if row else {}
+
+    def summary(self):
+        """Number of stages in each status across every host."""
+        return dict(self.db.execute("SELECT status, COUNT(*) FROM stages GROUP BY status").fetchall())
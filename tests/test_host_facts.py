@@ -0,0 +1,139 @@
+"""Probe parsers in host_facts, against outputs captured from a provisioned node under tests/samples."""
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('netaddr')
+pytest.importorskip('nornir')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from host_facts import (HardwareComponent, LldpNeighbor, parse_dmidecode, parse_ip_addr, parse_key_values,
+                        parse_lldp_neighbors, parse_lshw_components)
+
+SAMPLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'samples')
+
+
+def sample(name):
+    with open(os.path.join(SAMPLES, name)) as f:
+        return f.read()
+
+
+def test_lldp_single_interface_dict_form():
+    assert parse_lldp_neighbors(sample('lldpcli_single.json')) == [
+        LldpNeighbor(interface='eno1', system_name='leaf-03.local.domain', chassis_mac='44:4c:a8:e2:1f:09', port='Ethernet17'),
+    ]
+
+
+def test_lldp_multi_interface_list_form():
+    neighbors = parse_lldp_neighbors(sample('lldpcli_multi.json'))
+
+    assert [(n.interface, n.system_name, n.port) for n in neighbors] == [
+        ('eno1', 'leaf-03.local.domain', 'Ethernet17'),
+        ('eno2', 'leaf-04.local.domain', 'Ethernet17'),
+        ('eno3', None, 'b8:59:9f:10:22:7f'),
+    ]
+    # a neighbor without a system name is still identified by its chassis MAC
+    assert neighbors[2].chassis_mac == 'b8:59:9f:10:22:7e'
+
+
+def test_lldp_without_neighbors():
+    assert parse_lldp_neighbors('{"lldp": {}}') == []
+    assert parse_lldp_neighbors('') == []
+
+
+def test_dmidecode_sections():
+    sections = parse_dmidecode(sample('dmidecode.txt'))
+
+    assert sorted(sections) == [0, 1, 2, 3, 39]
+    assert sections[0][0]['Version'] == '3.4'
+    assert sections[0][0]['BIOS Revision'] == '5.14'
+    assert sections[1][0]['Serial Number'] == 'S349281X0A15723'
+    assert sections[1][0]['SKU Number'] == 'To be filled by O.E.M.'
+    assert sections[2][0]['Asset Tag'] == '104217'
+    assert sections[3][0]['Serial Number'] == 'C2170LJ43AC0312'
+    assert [psu['Max Power Capacity'] for psu in sections[39]] == ['2200 W', '1600 W']
+
+
+def test_dmidecode_skips_nested_lists():
+    sections = parse_dmidecode(sample('dmidecode.txt'))
+
+    # Characteristics and Features only have nested items, neither they nor the items become keys
+    assert 'Characteristics' not in sections[0][0]
+    assert 'PCI is supported' not in sections[0][0]
+    assert 'Features' not in sections[2][0]
+    assert sections[2][0]['Location In Chassis'] == 'Node A'
+
+
+def test_ip_addr_interfaces():
+    interfaces = {i.name: i for i in parse_ip_addr(sample('ip_addr.json'))}
+
+    assert sorted(interfaces) == ['bond0', 'docker0', 'eno1', 'eno2', 'eno3']
+    assert interfaces['eno1'].mac_address == '3c:ec:ef:1a:2b:3c'
+    assert interfaces['eno1'].mtu == 9000
+    assert interfaces['eno1'].addresses == ['10.1.4.117/16']
+    assert interfaces['eno1'].kind is None
+    assert interfaces['bond0'].kind == 'bond'
+    assert interfaces['bond0'].addresses == ['172.16.4.117/24']
+    assert interfaces['docker0'].kind == 'bridge'
+
+
+def test_ip_addr_bond_members():
+    interfaces = {i.name: i for i in parse_ip_addr(sample('ip_addr.json'))}
+
+    # bond members carry info_slave_kind only, they are plain ethernet with a master
+    assert (interfaces['eno2'].kind, interfaces['eno2'].master) == (None, 'bond0')
+    assert (interfaces['eno3'].kind, interfaces['eno3'].master) == (None, 'bond0')
+    assert interfaces['eno2'].addresses == []
+
+
+def test_key_values_ipmitool_lan():
+    values = parse_key_values(sample('ipmi_lan.txt'))
+
+    assert values['IP Address'] == '10.2.4.117'
+    assert values['MAC Address'] == 'ac:1f:6b:9e:42:10'
+    assert values['Subnet Mask'] == '255.255.0.0'
+    # continuation lines have no key and do not replace the first value
+    assert values['Auth Type Enable'] == 'Callback : MD2 MD5 PASSWORD'
+    assert '' not in values
+
+
+def test_lshw_components():
+    components = parse_lshw_components(sample('lshw.json'))
+
+    assert [(c.kind, c.name) for c in components] == [
+        ('memory', 'DIMMA1'), ('memory', 'DIMMB1'),
+        ('cpu', 'CPU1'), ('cpu', 'CPU2'),
+        ('disk', 'sda'),
+        ('nic', 'eno1'), ('nic', 'eno2'),
+        ('disk', 'nvme0n1'),
+    ]
+
+
+def test_lshw_placeholders_and_sizes():
+    components = {c.name: c for c in parse_lshw_components(sample('lshw.json'))}
+
+    assert components['CPU1'].serial is None
+    assert components['DIMMA1'] == HardwareComponent(
+        kind='memory', name='DIMMA1', vendor='Samsung', part_id='M393A4K40DB2-CVF', serial='0387A000',
+        description='DIMM DDR4 Synchronous Registered (Buffered) 2933 MHz (0.3 ns), 32GiB')
+    assert components['sda'].serial == 'S45PNA0MB12345'
+    assert components['sda'].description == 'ATA Disk, 447GiB'
+    assert components['eno1'].serial == '3c:ec:ef:1a:2b:3c'
+
+
+def test_lshw_nvme_namespaces_take_controller_identity():
+    disks = [c for c in parse_lshw_components(sample('lshw.json')) if c.name.startswith('nvme')]
+
+    # both namespaces lack a serial, the controller is listed once under the first namespace
+    assert disks == [
+        HardwareComponent(kind='disk', name='nvme0n1', vendor='Samsung Electronics Co Ltd', part_id='SAMSUNG MZQLB960HAJR-00007',
+                          serial='S437NE0M801234', description='NVMe disk, 894GiB'),
+    ]
+
+
+def test_lshw_list_of_trees():
+    text = sample('lshw.json')
+
+    assert parse_lshw_components(f"[{text}]") == parse_lshw_components(text)
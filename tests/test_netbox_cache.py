@@ -0,0 +1,63 @@
+"""SwitchInterfaceCache lookups of LLDP port names, against a stand-in for the pynetbox api."""
+import os
+import sys
+
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('netaddr')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from netbox_cache import SwitchInterfaceCache, normalize_port_name
+
+
+class Interfaces:
+    def __init__(self, names):
+        self.names = names
+        self.queries = 0
+
+    def filter(self, device):
+        self.queries += 1
+        return [SimpleNamespace(id=number, name=name, device=device) for number, name in enumerate(self.names)]
+
+
+def switch_cache(names):
+    interfaces = Interfaces(names)
+    return SwitchInterfaceCache(SimpleNamespace(dcim=SimpleNamespace(interfaces=interfaces))), interfaces
+
+
+def test_normalize_port_name():
+    assert normalize_port_name('Ethernet1/1') == normalize_port_name('ethernet 1/1') == normalize_port_name('Eth1/1') == 'ethernet1/1'
+    assert normalize_port_name('Te0/1') == 'tengigabitethernet0/1'
+
+
+def test_exact_match():
+    cache, _ = switch_cache(['Ethernet1/1', 'Ethernet1/10'])
+
+    assert cache.get('leaf-00', 'Eth1/1').name == 'Ethernet1/1'
+    assert cache.get('leaf-00', 'Ethernet1/10').name == 'Ethernet1/10'
+
+
+def test_missing_port_does_not_match_a_longer_number():
+    cache, _ = switch_cache(['Ethernet1/10', 'Ethernet1/11', 'Ethernet11/1'])
+
+    assert cache.get('leaf-00', 'Ethernet1/1') is None
+
+
+def test_breakout_and_subinterface_aliases():
+    cache, _ = switch_cache(['Ethernet1/10', 'Ethernet1/1/2', 'Ethernet1/1/1', 'Ethernet2/1.100'])
+
+    assert cache.get('leaf-00', 'Ethernet1/1').name == 'Ethernet1/1/1'
+    assert cache.get('leaf-00', 'Ethernet2/1').name == 'Ethernet2/1.100'
+
+
+def test_one_query_per_switch():
+    cache, interfaces = switch_cache(['Ethernet1/1'])
+
+    for port in ('Ethernet1/1', 'Et1/1', 'Ethernet1/2'):
+        cache.get('leaf-00', port)
+    cache.get('leaf-01', 'Ethernet1/1')
+
+    assert interfaces.queries == 2
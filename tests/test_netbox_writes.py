@@ -0,0 +1,104 @@
+"""Reconcile comparisons in netbox_writes, against pynetbox Records shaped like NetBox API responses."""
+import os
+import sys
+
+import pytest
+
+pynetbox = pytest.importorskip('pynetbox')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pynetbox.core.response import Record
+
+from netbox_writes import changed_fields, field_differs
+
+URL = 'https://netbox.example.com'
+
+
+@pytest.fixture
+def nb():
+    # Nothing is requested, the api object only gives the records their endpoints
+    return pynetbox.api(URL, token='test')
+
+
+def interface(nb, **values):
+    record = {'id': 41, 'url': f"{URL}/api/dcim/interfaces/41/", 'name': 'eno1', 'mac_address': '3C:EC:EF:1A:2B:3C', 'mtu': 9000,
+              'type': {'value': '25gbase-x-sfp28', 'label': 'SFP28 (25GE)'}, 'lag': None,
+              'device': {'id': 7, 'url': f"{URL}/api/dcim/devices/7/", 'name': 'minios-0117'}, **values}
+
+    return Record(record, nb, nb.dcim.interfaces)
+
+
+def device(nb, **values):
+    record = {'id': 7, 'url': f"{URL}/api/dcim/devices/7/", 'name': 'minios-0117', 'serial': 'S349281X0A15723', 'asset_tag': None,
+              'status': {'value': 'active', 'label': 'Active'},
+              'role': {'id': 2, 'url': f"{URL}/api/dcim/device-roles/2/", 'name': 'server', 'slug': 'server'},
+              'tenant': {'id': 1, 'url': f"{URL}/api/tenancy/tenants/1/", 'name': 'HWE', 'slug': 'hwe'},
+              'rack': {'id': 12, 'url': f"{URL}/api/dcim/racks/12/", 'name': 'R12'},
+              'tags': [{'id': 3, 'url': f"{URL}/api/extras/tags/3/", 'name': 'Rocky Linux 8.9', 'slug': 'rocky-linux-8-9'}], **values}
+
+    return Record(record, nb, nb.dcim.devices)
+
+
+@pytest.mark.parametrize('current, desired', [
+    ('3C:EC:EF:1A:2B:3C', '3c:ec:ef:1a:2b:3c'),
+    ('3c:ec:ef:1a:2b:3c', '3C-EC-EF-1A-2B-3C'),
+    ({'value': 'active', 'label': 'Active'}, 'active'),
+    (9000, '9000'),
+    (None, None),
+])
+def test_field_matches(current, desired):
+    assert not field_differs(current, desired)
+
+
+@pytest.mark.parametrize('current, desired', [
+    ('3C:EC:EF:1A:2B:3C', '3c:ec:ef:1a:2b:3d'),
+    ({'value': 'staged', 'label': 'Staged'}, 'active'),
+    (None, '3c:ec:ef:1a:2b:3c'),
+    ('eno1', 'ENO1'),
+])
+def test_field_differs(current, desired):
+    assert field_differs(current, desired)
+
+
+def test_nested_lookup_compares_given_keys():
+    role = {'id': 2, 'name': 'server', 'slug': 'server'}
+
+    assert not field_differs(role, {'name': 'server'})
+    assert field_differs(role, {'name': 'minios'})
+    assert field_differs(None, {'name': 'server'})
+    assert not field_differs(None, {'id': None})
+
+
+def test_tags_compare_by_name():
+    tags = [{'id': 3, 'name': 'Rocky Linux 8.9'}, {'id': 4, 'name': 'lab'}]
+
+    assert not field_differs(tags, [{'name': 'lab'}, {'name': 'Rocky Linux 8.9'}])
+    assert field_differs(tags, [{'name': 'Rocky Linux 8.10'}, {'name': 'lab'}])
+
+
+def test_unchanged_interface_sends_nothing(nb):
+    fields = {'type': '25gbase-x-sfp28', 'mac_address': '3c:ec:ef:1a:2b:3c', 'mtu': 9000}
+
+    assert changed_fields(interface(nb), fields) == {}
+
+
+def test_interface_sends_only_changed_fields(nb):
+    fields = {'type': '25gbase-x-sfp28', 'mac_address': '3c:ec:ef:1a:2b:3c', 'mtu': 1500}
+
+    assert changed_fields(interface(nb), fields) == {'mtu': 1500}
+    assert changed_fields(interface(nb, mac_address=None), fields) == {'mac_address': '3c:ec:ef:1a:2b:3c', 'mtu': 1500}
+
+
+def test_device_update(nb):
+    fields = {'name': 'minios-0117', 'status': 'active', 'role': {'name': 'server'}, 'tenant': {'name': 'HWE'},
+              'serial': 'S349281X0A15723', 'asset_tag': '104217', 'rack': {'id': 12}, 'tags': [{'name': 'Rocky Linux 8.10'}]}
+
+    assert changed_fields(device(nb), fields) == {'asset_tag': '104217', 'tags': [{'name': 'Rocky Linux 8.10'}]}
+
+
+def test_drifted_device(nb):
+    fields = {'status': 'active', 'role': {'name': 'server'}, 'tenant': {'name': 'HWE'}}
+    record = device(nb, status={'value': 'staged', 'label': 'Staged'}, tenant=None)
+
+    assert changed_fields(record, fields) == {'status': 'active', 'tenant': {'name': 'HWE'}}
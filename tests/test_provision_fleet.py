@@ -0,0 +1,110 @@
+"""
+Provision runs against the fake NetBox and simulated hosts from bench/, no lab needed.
+
+python -m pytest tests
+"""
+import os
+import sys
+import contextlib
+
+import pytest
+
+pytest.importorskip('nornir')
+pytest.importorskip('pynetbox')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'bench')]
+
+import sim_fleet
+import provision_server_netbox
+
+from nornir.core.inventory import ConnectionOptions
+from run_bench import FakeNetBoxProcess, server_nornir
+
+HOSTS = 6
+
+
+@pytest.fixture
+def netbox():
+    server = FakeNetBoxProcess(0.0)
+
+    try:
+        sim_fleet.register_connections()
+        sim_fleet.seed_netbox(server.post, HOSTS)
+        sim_fleet.lldp_enabled.clear()
+        provision_server_netbox.setup_netbox(2, url=server.url, token='bench', verify=False)
+        yield server
+    finally:
+        sim_fleet.unreachable.clear()
+        server.close()
+
+
+def provision(nr):
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        return provision_server_netbox.provision(nr)
+
+
+def test_unreachable_host_fails_alone(netbox):
+    sim_fleet.unreachable.add(2)
+
+    report = provision(server_nornir(HOSTS, 4))
+
+    down = sim_fleet.host_name(2)
+    assert any('failed collect_facts' in error for error in report[down]['errors'])
+    assert all(not host['errors'] for name, host in report.items() if name != down)
+    assert len([name for name in report if name != down]) == HOSTS - 1
+
+
+def test_host_without_ip_fails_alone(netbox):
+    nr = server_nornir(HOSTS, 4)
+    missing = sim_fleet.host_name(3)
+    nr.inventory.hosts[missing].data['ip_address'] = ''
+
+    report = provision(nr)
+
+    assert report[missing]['errors']
+    assert all(not host['errors'] for name, host in report.items() if name != missing)
+
+
+def test_drifted_device_is_provisioned_again(netbox):
+    provision(server_nornir(HOSTS, 4))
+
+    reset = sim_fleet.host_name(1)
+    device = provision_server_netbox.nb.dcim.devices.get(name=reset)
+    device.update({'status': 'staged', 'device_role': {'name': 'minios'}})
+
+    nr = server_nornir(HOSTS, 4)
+    provision(nr)
+
+    assert not nr.inventory.hosts[reset].data.get('unchanged')
+    assert all(host.data.get('unchanged') for name, host in nr.inventory.hosts.items() if name != reset)
+    device = dict(provision_server_netbox.nb.dcim.devices.get(name=reset))
+    assert device['status']['value'] == 'active'
+    assert (device.get('role') or device.get('device_role'))['name'] == 'server'
+
+
+def test_cli_rerun_on_provisioned_host(netbox, monkeypatch, tmp_path, capsys):
+    name = sim_fleet.host_name(0)
+    data = sim_fleet.fleet(HOSTS)[name]
+    build_nornir = provision_server_netbox.build_nornir
+
+    def sim_nornir(*args, **kwargs):
+        nr = build_nornir(*args, **kwargs)
+        for host in nr.inventory.hosts.values():
+            host.connection_options['netmiko'] = ConnectionOptions(extras={'index': 0})
+        return nr
+
+    monkeypatch.setenv('NB_URL', netbox.url)
+    monkeypatch.setenv('NB_TOKEN', 'bench')
+    monkeypatch.setattr(provision_server_netbox, 'build_nornir', sim_nornir)
+    argv = ['admin', 'secret', data['ip_address'], name, data['node'], '--inventory-cache', str(tmp_path / 'inventory.json')]
+
+    provision_server_netbox.main(argv)
+    first = capsys.readouterr().out
+    assert f"{name}: created" in first and f"{name}: failed" not in first
+
+    # The device is active now, the second run still finds it and sees nothing changed
+    provision_server_netbox.main(argv)
+    second = capsys.readouterr().out
+    assert "No Hosts Found!" not in second
+    assert "1 hosts unchanged since their last run" in second